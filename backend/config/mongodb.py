@@ -1,5 +1,10 @@
+import logging
 from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
 from .settings import settings
+from utils.tracing import mongo_listener
+from utils.metrics import mongo_metrics_listener, mongo_pool_listener
+
+logger = logging.getLogger(__name__)
 
 # 创建全局数据库客户端
 client: AsyncIOMotorClient = None
@@ -22,11 +27,11 @@ async def connect_to_mongo():
     """连接到MongoDB"""
     global client, db
     try:
-        client = AsyncIOMotorClient(settings.MONGODB_URL)
+        client = AsyncIOMotorClient(settings.MONGODB_URL, event_listeners=[mongo_listener, mongo_metrics_listener, mongo_pool_listener])
         db = client[settings.MONGODB_DB]
         # 测试连接
         await client.admin.command('ping')
-        print("Successfully connected to MongoDB")
+        logger.info("Successfully connected to MongoDB")
     except Exception as e:
-        print(f"Error connecting to MongoDB: {e}")
+        logger.error("Error connecting to MongoDB: %s", e)
         raise e 
\ No newline at end of file
@@ -1,5 +1,5 @@
 from pathlib import Path
-from typing import List, Optional
+from typing import Dict, List, Optional
 
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from pydantic import Field
@@ -70,14 +70,124 @@ class Settings(BaseSettings):
 
     # 对话配置
     DEFAULT_HISTORY_LENGTH: int = 5
-    DEFAULT_SUMMARY_LENGTH: int = 200
+    DEFAULT_SUMMARY_LENGTH: int = 200  # 剧情摘要的最大字数
+
+    # 目录缓存配置（代理、提示词模板、艺术风格、语言等小集合）
+    CATALOG_CACHE_SECONDS: float = 300.0  # 缓存最长使用时间，过期后重新加载
+    CATALOG_WATCH_CHANGES: bool = False  # 是否通过 change stream 监听其他副本的修改（需要MongoDB副本集）
+
+    # 对话摘要配置
+    SUMMARY_ENABLED: bool = True  # 是否把超出历史窗口的消息合并到对话摘要中
+    SUMMARY_MIN_MESSAGES: int = 6  # 超出历史窗口的消息达到该数量时才生成摘要
+    SUMMARY_BATCH_MESSAGES: int = 40  # 每次合并到摘要中的最多消息数
+    SUMMARY_MAX_CONCURRENT: int = 4  # 同时进行的摘要生成数量上限
+
+    # 消息写入配置
+    MESSAGE_CHECKPOINT_SECONDS: float = 2.0  # 流式生成中的回复每隔多少秒写入一次已生成的内容
+
+    # 对话分支配置
+    BRANCH_RETENTION_HOURS: float = 72.0  # 离开的分支保留多少小时后清理其消息
+    BRANCH_GC_INTERVAL_SECONDS: float = 300.0  # 后台清理分支的间隔
+    BRANCH_GC_BATCH: int = 100  # 每次清理的最多对话数
+    BRANCH_GC_DELETE_BATCH: int = 500  # 每次删除的最多消息数，分批删除避免大量删除占用数据库
+
+    # 消息归档配置
+    ARCHIVE_ENABLED: bool = True  # 是否在后台归档闲置对话的消息
+    ARCHIVE_IDLE_DAYS: float = 90.0  # 对话超过多少天没有更新时归档
+    ARCHIVE_INTERVAL_SECONDS: float = 3600.0  # 后台归档的间隔
+    ARCHIVE_BATCH: int = 20  # 每次归档的最多对话数
+    ARCHIVE_CHUNK_MESSAGES: int = 500  # 每个归档分块的消息数
+
+    # 说话角色选择配置
+    SPEAKER_FAST_PATH_ENABLED: bool = True  # 是否启用规则快速路径，关闭后总是调用LLM
+    SPEAKER_NARRATOR_INTERVAL: int = 8  # 单角色故事中旁白最多间隔多少条消息出现一次，0表示不插入
+    SPEAKER_FOLLOW_UP_MAX_CHARS: int = 12  # 视为简短追问的用户消息最大长度，0表示关闭
+
+    # 推测式回复生成配置
+    SPECULATION_MAX_CONCURRENT: int = 20  # 同时进行的推测生成数量上限
+    SPECULATION_MAX_BUFFERED_CHUNKS: int = 256  # 推测未确认前最多缓冲的片段数，超出后暂停生成
+    TURN_MAX_BUFFERED_CHUNKS: int = 1024  # 并行生成时每个角色最多缓冲的片段数
+
+    # 上游LLM容错配置
+    UPSTREAM_MAX_ATTEMPTS: int = 3  # 单次调用最多尝试的次数（含切换模型）
+    UPSTREAM_BACKOFF_BASE: float = 0.2  # 指数退避基础秒数
+    UPSTREAM_BACKOFF_MAX: float = 2.0  # 单次退避最长秒数
+    UPSTREAM_BREAKER_WINDOW: int = 20  # 熔断器统计的最近调用次数
+    UPSTREAM_BREAKER_MIN_CALLS: int = 5  # 窗口内至少多少次调用才判断熔断
+    UPSTREAM_BREAKER_FAILURE_RATE: float = 0.5  # 触发熔断的错误率
+    UPSTREAM_BREAKER_SLOW_CALL_SECONDS: float = 15.0  # 超过该延迟视为慢调用（流式为首个片段延迟）
+    UPSTREAM_BREAKER_SLOW_CALL_RATE: float = 0.8  # 触发熔断的慢调用比例
+    UPSTREAM_BREAKER_OPEN_SECONDS: float = 30.0  # 熔断后多久进入半开状态
+    UPSTREAM_HEDGE_ENABLED: bool = False  # 是否在超过p95延迟后向其他模型发起对冲请求
+    UPSTREAM_HEDGE_MIN_DELAY: float = 1.0  # 对冲请求的最短等待秒数
+
+    # LLM模型路由配置
+    LLM_ROUTER_STRATEGY: str = "p2c"  # 选择策略：p2c（随机两选一）/least_outstanding（最少进行中请求）
+    LLM_ROUTER_CACHE_SECONDS: float = 30.0  # 模型列表缓存时间
+    LLM_ROUTER_EWMA_ALPHA: float = 0.3  # 延迟和错误率的指数加权系数
+    LLM_ROUTER_DEFAULT_LATENCY: float = 2.0  # 没有延迟数据时的预估秒数
+    LLM_ROUTER_ERROR_PENALTY: float = 4.0  # 错误率对代价的放大系数
+    LLM_ROUTER_RATE_LIMIT_COOLDOWN: float = 10.0  # 被限流且没有Retry-After时的回避秒数
+
+    # 上游模型限流配置（限额在各模型的 LLMSettings 中配置）
+    UPSTREAM_LIMIT_BACKEND: str = "local"  # RPM/TPM预算存储：local（进程内）/redis（通过REDIS_URL在worker间共享）
+    UPSTREAM_QUEUE_TIMEOUT_SECONDS: float = 10.0  # 等待上游限额的最长时间，超时后切换模型或返回429
+
+    # 使用量统计配置
+    USAGE_FLUSH_INTERVAL_SECONDS: float = 5.0  # 使用量批量写入数据库的间隔
+    API_KEY_CACHE_SECONDS: float = 30.0  # 活跃API密钥列表的缓存时间，期间按本进程的使用次数轮询
+
+    # 上下文构建配置
+    TOKENIZER_ENCODING: str = "cl100k_base"  # 安装tiktoken时使用的编码，未安装时按字符估算
+    CONTEXT_HISTORY_TOKENS: int = 3000  # 历史消息的默认token预算，可在模型的 LLMSettings.context_tokens 中覆盖
+    LLM_STREAM_INCLUDE_USAGE: bool = True  # 流式请求是否要求上游返回token用量（stream_options.include_usage）
 
     # 限流配置
-    RATE_LIMIT_PER_MINUTE: int = 100
+    RATE_LIMIT_ENABLED: bool = True
+    RATE_LIMIT_PER_MINUTE: int = 100  # 每个用户（未登录时每个IP）每个窗口内的请求代价上限
+    RATE_LIMIT_WINDOW_SECONDS: int = 60  # 滑动窗口长度
+    RATE_LIMIT_BACKEND: str = "local"  # 计数存储：local（进程内）/redis（通过REDIS_URL在worker间共享）
+    RATE_LIMIT_TRUST_FORWARDED: bool = False  # 是否使用X-Forwarded-For识别客户端IP（部署在反向代理之后时开启）
+    RATE_LIMIT_IDENTITY_CACHE_SECONDS: float = 60.0  # 访问令牌到钱包地址的缓存时间
+    # 接口代价（路径不含API前缀），未配置的接口为1
+    RATE_LIMIT_ROUTE_COSTS: Dict[str, int] = {
+        "/character-avatar/generate": 20,
+        "/ai/ai/t2i/submit": 20,
+        "/llm/generate/story-background-image": 20,
+        "/story/publish": 10,
+        "/character-avatar/create": 5,
+        "/story_chat/generate-response": 5,
+        "/story_chat/turn": 5,
+        "/llm/chat/completions": 5,
+        "/ai/i2t/chat/completions": 5,
+        "/story_chat/select-speakers": 2,
+    }
 
     # 日志配置
-    LOG_LEVEL: str = "INFO"
+    LOG_LEVEL: str = "INFO"  # 根级别，可按模块设置，如 "INFO,services.chat=DEBUG,pymongo=WARNING"
     LOG_FORMAT: str = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    LOG_JSON: bool = False  # 是否每条日志输出为一行JSON
+    LOG_DEBUG_SAMPLE_RATE: float = 1.0  # DEBUG日志的采样率，高流量时调低
+    LOG_QUEUE_SIZE: int = 10000  # 日志队列长度，写入跟不上时丢弃新的日志
+
+    # 链路追踪配置
+    TRACE_ENABLED: bool = True  # 是否记录请求链路和 Server-Timing 响应头
+    TRACE_SAMPLE_RATE: float = 1.0  # 记录链路的请求比例
+    TRACE_BUFFER_SIZE: int = 1000  # 进程内保留的最近链路数
+    TRACE_MAX_SPANS: int = 200  # 单条链路最多记录的阶段数，超出的只计数
+    TRACE_OTLP_ENDPOINT: Optional[str] = None  # OTLP/HTTP 采集地址，如 http://localhost:4318/v1/traces，为空时不导出
+    TRACE_OTLP_HEADERS: Dict[str, str] = {}  # 发送到采集器时附加的请求头，如认证信息
+    TRACE_EXPORT_INTERVAL_SECONDS: float = 5  # 导出间隔（秒）
+    TRACE_EXPORT_BATCH: int = 200  # 每次请求导出的最多链路数
+    TRACE_EXPORT_QUEUE: int = 5000  # 等待导出的最多链路数，超出时丢弃最早的
+
+    # 监控指标配置
+    METRICS_ENABLED: bool = True  # 是否统计指标并提供 /metrics 接口
+    METRICS_ALLOWED_IPS: List[str] = ["127.0.0.1", "::1"]  # 允许抓取 /metrics 的客户端IP，为空时不限制
+    METRICS_LOOP_LAG_INTERVAL_SECONDS: float = 0.5  # 事件循环延迟的测量间隔（秒）
+    METRICS_WORKER_PORT_BASE: Optional[int] = None  # 多worker部署时每个worker输出指标的起始端口，如9100，为空时不启动
+    METRICS_WORKER_PORT_COUNT: int = 16  # 可占用的端口数量，不少于worker数
+    METRICS_WORKER_HOST: str = "127.0.0.1"  # worker指标端口的监听地址
 
     # 故事对话 LLM 配置
     DASHSCOPE_API_KEY: Optional[str] = Field(default="")
@@ -1,13 +1,19 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
 from beanie import init_beanie
 
 from config.settings import settings
+from utils.log import setup_logging, stop_logging, stats as log_stats
+
+# 在导入其他模块之前配置日志，日志写入由后台线程完成
+setup_logging()
+
 from config.mongodb import connect_to_mongo, close_mongo_connection
 from models.user import User
 from models.conversation_message import ConversationMessage
 from models.conversation import Conversation
+from models.conversation_archive import ConversationArchive
 from models.story import Story
 from models.character import Character
 from models.story_template import StoryTemplate
@@ -18,6 +24,27 @@ from models.art_style import ArtStyle
 from models.language import Language
 from models.character_system_prompt_post import CharacterSystemPromptPost
 from models.music import Music
+from models.api_key import APIKey
+from services.usage import usage_aggregator
+from services.summarizer import conversation_summarizer
+from services.message_buffer import message_buffer
+from services.branch_gc import branch_collector
+from services.archiver import conversation_archiver
+from services.catalog import catalog
+from services.speculation import speculation_manager
+from utils.rate_limit import RateLimitMiddleware
+from utils.lean import LeanJSONResponse
+from utils.tracing import TracingMiddleware, mongo_listener, tracer
+from utils.metrics import (
+    CONTENT_TYPE as METRICS_CONTENT_TYPE,
+    METRICS_PATH,
+    MetricsMiddleware,
+    event_loop_monitor,
+    mongo_metrics_listener,
+    mongo_pool_listener,
+    registry as metrics_registry,
+    worker_metrics_server
+)
 
 from routes import (
     auth,
@@ -34,7 +61,8 @@ from routes import (
     music,
     story,
     story_chat,
-    conversation
+    conversation,
+    traces
 )
 
 # 创建FastAPI应用
@@ -43,9 +71,13 @@ app = FastAPI(
     version=settings.APP_VERSION,
     docs_url="/api/docs",
     redoc_url="/api/redoc",
-    openapi_url="/api/openapi.json"
+    openapi_url="/api/openapi.json",
+    default_response_class=LeanJSONResponse  # 安装了orjson时使用orjson序列化JSON响应
 )
 
+# 添加限流中间件（先于CORS添加，使429响应也带有CORS头）
+app.add_middleware(RateLimitMiddleware)
+
 # 添加CORS中间件
 app.add_middleware(
     CORSMiddleware,
@@ -53,8 +85,16 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing"],
 )
 
+# 添加指标统计中间件
+if settings.METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+
+# 添加链路追踪中间件（最后添加，位于最外层，耗时包含限流和CORS）
+app.add_middleware(TracingMiddleware)
+
 # 注册路由
 app.include_router(auth.router, prefix=settings.API_V1_PREFIX, tags=["认证"])
 app.include_router(images.router, prefix=settings.API_V1_PREFIX)
@@ -71,6 +111,17 @@ app.include_router(music.router, prefix=settings.API_V1_PREFIX, tags=["music"])
 app.include_router(story.router, prefix=settings.API_V1_PREFIX, tags=["story"])
 app.include_router(story_chat.router, prefix=settings.API_V1_PREFIX, tags=["story_chat"])
 app.include_router(conversation.router, prefix=settings.API_V1_PREFIX, tags=["conversation"])
+app.include_router(traces.router, prefix=settings.API_V1_PREFIX, tags=["traces"])
+
+# 各服务已有的统计在抓取指标时输出为gauge
+metrics_registry.register_stats("message_buffer", message_buffer.stats)
+metrics_registry.register_stats("summarizer", conversation_summarizer.stats)
+metrics_registry.register_stats("branch_gc", branch_collector.stats)
+metrics_registry.register_stats("archiver", conversation_archiver.stats)
+metrics_registry.register_stats("speculation", speculation_manager.stats)
+metrics_registry.register_stats("tracing", tracer.stats)
+metrics_registry.register_stats("log", log_stats)
+metrics_registry.register_stats("worker_metrics", worker_metrics_server.stats)
 
 @app.on_event("startup")
 async def startup_event():
@@ -79,13 +130,14 @@ async def startup_event():
     await connect_to_mongo()
     
     # 初始化Beanie
-    client = AsyncIOMotorClient(settings.MONGODB_URL)
+    client = AsyncIOMotorClient(settings.MONGODB_URL, event_listeners=[mongo_listener, mongo_metrics_listener, mongo_pool_listener])
     await init_beanie(
         database=client[settings.MONGODB_DB],
         document_models=[
             User,
             ConversationMessage,
             Conversation,
+            ConversationArchive,
             Story,
             Character,
             StoryTemplate,
@@ -95,15 +147,50 @@ async def startup_event():
             ArtStyle,
             Language,
             CharacterSystemPromptPost,
-            Music
+            Music,
+            APIKey
         ]
     )
+    
+    # 加载目录缓存
+    await catalog.load_all()
+    catalog.start()
+    
+    # 启动使用量定期写入
+    usage_aggregator.start()
+    
+    # 启动分支后台清理和闲置对话归档
+    branch_collector.start()
+    conversation_archiver.start()
+    
+    # 启动链路导出、事件循环延迟测量和本worker的指标端口
+    tracer.exporter.start()
+    event_loop_monitor.start()
+    await worker_metrics_server.start()
 
 @app.on_event("shutdown")
 async def shutdown_event():
     """关闭事件处理"""
+    # 写入缓冲中的消息，停止摘要任务、分支清理、归档和目录监听，写入剩余的使用量和链路
+    await message_buffer.stop()
+    await conversation_summarizer.stop()
+    await branch_collector.stop()
+    await conversation_archiver.stop()
+    await catalog.stop()
+    await usage_aggregator.stop()
+    await tracer.exporter.stop()
+    await event_loop_monitor.stop()
+    await worker_metrics_server.stop()
     await close_mongo_connection()
 
+@app.get(METRICS_PATH, include_in_schema=False)
+async def metrics(request: Request):
+    """Prometheus 格式的监控指标，只允许 METRICS_ALLOWED_IPS 中的客户端抓取"""
+    client = request.client.host if request.client else None
+    if not settings.METRICS_ENABLED or (settings.METRICS_ALLOWED_IPS and client not in settings.METRICS_ALLOWED_IPS):
+        raise HTTPException(status_code=404, detail="Not Found")
+    return Response(metrics_registry.render(), media_type=METRICS_CONTENT_TYPE)
+
 @app.get("/")
 async def root():
     """根路由"""
@@ -1,9 +1,12 @@
+import time
 from datetime import datetime
-from typing import Optional
+from typing import Dict, List, Optional
 
 from beanie import Document, Indexed
 from pydantic import Field
 
+from config.settings import settings
+
 
 class APIKey(Document):
     """API密钥模型
@@ -29,22 +32,26 @@ class APIKey(Document):
     async def get_next_available_key(cls) -> Optional["APIKey"]:
         """获取下一个可用的API密钥
         
-        使用轮询策略，选择使用次数最少的活跃密钥
+        使用轮询策略，选择使用次数最少的活跃密钥。活跃密钥列表缓存 API_KEY_CACHE_SECONDS 秒，
+        加载时以数据库中的使用次数加上尚未写入的部分为起点，之后按本进程的选择累加，
+        不需要每次请求都读取所有密钥。使用次数记入 usage_aggregator，由其定期批量写入
         
         Returns:
             Optional[APIKey]: 可用的API密钥，如果没有则返回None
         """
-        key = await cls.find(
-            {"status": "active"}
-        ).sort(
-            "usage_count"
-        ).first()
+        from services.usage import usage_aggregator  # 避免循环导入
+        
+        if _active_keys.expired():
+            keys = await cls.find({"status": "active"}).to_list()
+            _active_keys.load(keys, {
+                k.key: k.usage_count + usage_aggregator.pending_api_key_requests(k.key) for k in keys
+            })
+        if not _active_keys.keys:
+            return None
         
-        if key:
-            key.usage_count += 1
-            key.last_used = datetime.utcnow()
-            await key.save()
-            
+        key = min(_active_keys.keys, key=lambda k: _active_keys.counts[k.key])
+        _active_keys.counts[key.key] += 1
+        usage_aggregator.record_api_key(key.key)
         return key
 
     @classmethod
@@ -58,6 +65,8 @@ class APIKey(Document):
         if api_key:
             api_key.status = "inactive"
             await api_key.save()
+        # 其他进程在缓存过期后才会停止使用该密钥
+        _active_keys.invalidate()
 
     @classmethod
     async def reset_usage_counts(cls) -> None:
@@ -65,4 +74,28 @@ class APIKey(Document):
         
         通常在每天开始时调用
         """
-        await cls.find_all().update({"$set": {"usage_count": 0}}) 
\ No newline at end of file
+        await cls.find_all().update({"$set": {"usage_count": 0}})
+        _active_keys.invalidate()
+
+
+class _ActiveKeyCache:
+    """活跃密钥列表及估计的使用次数"""
+
+    def __init__(self):
+        self.loaded_at = 0.0
+        self.keys: List[APIKey] = []
+        self.counts: Dict[str, int] = {}
+
+    def expired(self) -> bool:
+        return not self.loaded_at or time.monotonic() - self.loaded_at >= settings.API_KEY_CACHE_SECONDS
+
+    def load(self, keys: List[APIKey], counts: Dict[str, int]):
+        self.keys = keys
+        self.counts = counts
+        self.loaded_at = time.monotonic()
+
+    def invalidate(self):
+        self.loaded_at = 0.0
+
+
+_active_keys = _ActiveKeyCache() 
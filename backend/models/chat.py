@@ -29,6 +29,10 @@ class HistoryMessage(BaseModel):
     created_at: str = Field(
         description="消息创建时间，ISO格式的UTC时间字符串"
     )  # 消息创建时间
+    token_count: Optional[int] = Field(
+        default=None,
+        description="消息内容的token数，仅在返回历史消息时提供，请求中传入的值会被忽略"
+    )  # 消息内容的token数
 
     class Config:
         json_schema_extra = {
@@ -1,9 +1,11 @@
-from datetime import datetime
-from typing import TYPE_CHECKING, List, Optional, ForwardRef
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, ForwardRef, Set, Tuple
 
 from beanie import Document, Link, Indexed
-from pydantic import Field
+from pydantic import BaseModel, Field
+from pymongo import IndexModel, ReturnDocument
 
+from config.settings import settings
 from .story import Story
 
 if TYPE_CHECKING:
@@ -12,6 +14,148 @@ else:
     ConversationMessage = ForwardRef("ConversationMessage")
 
 
+# 主分支，对话创建时的消息属于主分支
+ROOT_BRANCH = 0
+
+# 消息已归档或正在归档的对话状态，访问前需要恢复消息，见 services.archiver
+ARCHIVED_STATUSES = ("archiving", "archived")
+
+# 分支可见的一段消息：(分支ID, 序号下界（不含），序号上界（含），None表示不限)
+BranchRange = Tuple[int, Optional[int], Optional[int]]
+
+
+class ConversationBranch(BaseModel):
+    """对话分支
+
+    回退时从当前分支分出新分支：新分支继承父分支中序号不大于 fork_sequence 的消息，
+    之后写入的消息属于新分支。原分支的消息保留，可以切换回去。
+    """
+    id: int = Field(description="分支ID")
+    parent: int = Field(description="父分支ID")
+    fork_sequence: int = Field(description="从父分支继承的最后一条消息的序号")
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    last_active_at: datetime = Field(default_factory=datetime.utcnow)  # 最后一次作为当前分支的时间，用于清理
+
+
+def branch_lineage(branches: List[ConversationBranch], branch_id: int) -> List[BranchRange]:
+    """分支上可见的消息所在的分支和序号范围
+
+    Args:
+        branches: 对话的分支列表（不含主分支）
+        branch_id: 分支ID
+
+    Returns:
+        List[BranchRange]: 从该分支到主分支，每个分支可见的序号范围
+    """
+    by_id = {branch.id: branch for branch in branches}
+    ranges = []
+    upper = None
+    current = branch_id
+    while True:
+        branch = by_id.get(current)
+        if branch is None:
+            # 主分支（或已被清理的分支）包含序号上界之前的所有消息
+            ranges.append((ROOT_BRANCH, None, upper))
+            return ranges
+        if upper is None or upper > branch.fork_sequence:
+            ranges.append((current, branch.fork_sequence, upper))
+        upper = branch.fork_sequence if upper is None else min(upper, branch.fork_sequence)
+        current = branch.parent
+
+
+def branch_ancestors(branches: List[ConversationBranch], branch_id: int) -> Set[int]:
+    """分支和沿 parent 可以到达的所有祖先分支
+
+    branch_lineage 会跳过没有可见消息的祖先，但子分支的分叉位置仍然依赖这些祖先，
+    移除它们会使子分支的可见范围回退到主分支。
+
+    Args:
+        branches: 对话的分支列表（不含主分支）
+        branch_id: 分支ID
+
+    Returns:
+        Set[int]: 分支ID集合，包含该分支本身
+    """
+    by_id = {branch.id: branch for branch in branches}
+    ancestors = {branch_id}
+    current = by_id.get(branch_id)
+    while current is not None and current.parent not in ancestors:
+        ancestors.add(current.parent)
+        current = by_id.get(current.parent)
+    return ancestors
+
+
+def branch_message_filter(
+    conversation_id: Any,
+    branches: List[ConversationBranch],
+    branch_id: int,
+    after: Optional[int] = None,
+    before: Optional[int] = None
+) -> Dict[str, Any]:
+    """分支上可见消息的查询条件，每个分支的范围都能使用 (conversation, branch_id, sequence) 索引
+
+    Args:
+        conversation_id: 对话ID
+        branches: 对话的分支列表
+        branch_id: 分支ID
+        after: 只查询序号大于该值的消息
+        before: 只查询序号小于该值的消息
+
+    Returns:
+        Dict[str, Any]: MongoDB查询条件
+    """
+    def sequence_bounds(low: Optional[int], high: Optional[int]) -> Optional[Dict[str, int]]:
+        # 与查询范围取交集，范围为空时返回None
+        lows = [v for v in (low, after) if v is not None]
+        highs = [v for v in (high, before - 1 if before is not None else None) if v is not None]
+        bounds = {}
+        if lows:
+            bounds["$gt"] = max(lows)
+        if highs:
+            bounds["$lte"] = min(highs)
+        if lows and highs and bounds["$gt"] >= bounds["$lte"]:
+            return None
+        return bounds
+
+    query: Dict[str, Any] = {"conversation.$id": conversation_id}
+    # 没有分支时对话的所有消息都在主分支上
+    if not branches:
+        bounds = sequence_bounds(None, None)
+        if bounds:
+            query["sequence"] = bounds
+        return query
+
+    clauses = []
+    for branch, low, high in branch_lineage(branches, branch_id):
+        bounds = sequence_bounds(low, high)
+        if bounds is None:
+            continue
+        # 增加分支之前写入的消息没有 branch_id 字段，属于主分支
+        clause = {"branch_id": {"$in": [ROOT_BRANCH, None]} if branch == ROOT_BRANCH else branch}
+        if bounds:
+            clause["sequence"] = bounds
+        clauses.append(clause)
+
+    if len(clauses) == 1:
+        query.update(clauses[0])
+    else:
+        # 没有可见范围时 $or 为空数组不合法，使用一个不会匹配的条件
+        query["$or"] = clauses or [{"_id": {"$exists": False}}]
+    return query
+
+
+def _shared_until(a: List[BranchRange], b: List[BranchRange]) -> Optional[int]:
+    """两个分支共有的消息的最大序号，None表示可见的消息完全相同"""
+    shared = 0
+    for (branch_a, _, high_a), (branch_b, _, high_b) in zip(reversed(a), reversed(b)):
+        if branch_a != branch_b:
+            return shared
+        if high_a != high_b:
+            return min(h for h in (high_a, high_b) if h is not None)
+        shared = high_a
+    return None
+
+
 class Conversation(Document):
     """对话模型
     
@@ -19,19 +163,30 @@ class Conversation(Document):
     """
     story: Link[Story] = Field(description="关联的故事")  # 关联的故事
     user_id: str = Field(index=True, description="用户ID")  # 用户ID
-    status: str = Field(default="active", description="对话状态")  # 对话状态：active/archived
+    status: str = Field(default="active", description="对话状态")  # 对话状态：active/archiving/archived
     current_context: Optional[str] = None  # 当前上下文摘要
+    summary_sequence: int = Field(default=0, description="已合并到摘要中的最后一条消息的序号")  # 摘要的高水位序号
     created_at: datetime = Field(default_factory=datetime.utcnow)  # 创建时间
     updated_at: datetime = Field(default_factory=datetime.utcnow)  # 更新时间
     last_sequence: int = Field(default=0, description="最后一条消息的序号")  # 最后一条消息的序号
+    active_branch: int = Field(default=ROOT_BRANCH, description="当前分支")  # 历史消息沿当前分支读取
+    branches: List[ConversationBranch] = Field(default_factory=list, description="回退产生的分支，不含主分支")
+    last_branch: int = Field(default=ROOT_BRANCH, description="最后分配的分支ID")  # 分支ID不重复使用
+    branch_gc_at: Optional[datetime] = None  # 下一次检查不再使用的分支的时间，为空时没有需要清理的分支
 
     class Settings:
         name = "conversations"
         indexes = [
-            "story",
+            IndexModel([("story.$id", 1)], name="story_id"),  # story 存储为DBRef，按 story.$id 查询
             "user_id",
             "status",
-            "created_at"
+            "created_at",
+            "branch_gc_at",  # 后台清理分支
+            IndexModel([("status", 1), ("updated_at", 1)], name="status_updated_at"),  # 查找闲置的对话进行归档
+            IndexModel(
+                [("user_id", 1), ("story.$id", 1), ("status", 1), ("created_at", -1)],
+                name="user_story_status_created_at"
+            )  # 查找用户在故事中最新的进行中对话
         ]
         
     class Config:
@@ -39,16 +194,182 @@ class Conversation(Document):
             datetime: lambda v: v.isoformat()
         }
 
+    def branch_guard(self) -> Dict[str, Any]:
+        """分支未被修改的条件，用于条件更新
+        
+        增加分支之前创建的对话没有分支字段，与主分支、没有分支等同。
+        """
+        guard: Dict[str, Any] = {
+            "active_branch": {"$in": [ROOT_BRANCH, None]} if self.active_branch == ROOT_BRANCH else self.active_branch
+        }
+        if self.branches:
+            guard["branches"] = {"$size": len(self.branches)}
+        else:
+            guard["branches.0"] = {"$exists": False}
+        return guard
+
+    def message_filter(self, after: Optional[int] = None, before: Optional[int] = None) -> Dict[str, Any]:
+        """当前分支上的消息的查询条件
+        
+        Args:
+            after: 只查询序号大于该值的消息
+            before: 只查询序号小于该值的消息
+            
+        Returns:
+            Dict[str, Any]: MongoDB查询条件
+        """
+        return branch_message_filter(self.id, self.branches, self.active_branch, after, before)
+
     async def get_messages(self) -> List[ConversationMessage]:
-        """获取对话的所有消息
+        """获取对话当前分支上的所有消息
         
         Returns:
             List[ConversationMessage]: 消息列表，按sequence排序
         """
         from .conversation_message import ConversationMessage
-        return await ConversationMessage.find(
-            ConversationMessage.conversation.id == self.id
-        ).sort("+sequence").to_list()
+        return await ConversationMessage.find(self.message_filter()).sort("+sequence").to_list()
+
+    @classmethod
+    async def rollback(cls, conversation_id: Any, target_sequence: int) -> "Conversation":
+        """回退对话到指定序号的消息
+        
+        从当前分支分出一个新分支并切换过去，不删除消息；原分支可以通过 switch_branch 恢复。
+        
+        Args:
+            conversation_id: 对话ID
+            target_sequence: 回退后保留的最后一条消息的序号
+            
+        Returns:
+            Conversation: 回退后的对话
+            
+        Raises:
+            ValueError: 对话不存在
+        """
+        def fork(conversation: "Conversation") -> Tuple[List[ConversationBranch], int]:
+            now = datetime.utcnow()
+            branch = ConversationBranch(
+                id=conversation.last_branch + 1,
+                parent=conversation.active_branch,
+                fork_sequence=target_sequence,
+                created_at=now,
+                last_active_at=now
+            )
+            return [*conversation.branches, branch], branch.id
+
+        return await cls._move_branch(conversation_id, fork)
+
+    @classmethod
+    async def switch_branch(cls, conversation_id: Any, branch_id: int) -> "Conversation":
+        """切换到对话的另一个分支
+        
+        Args:
+            conversation_id: 对话ID
+            branch_id: 分支ID
+            
+        Returns:
+            Conversation: 切换后的对话
+            
+        Raises:
+            ValueError: 对话或分支不存在
+        """
+        def switch(conversation: "Conversation") -> Tuple[List[ConversationBranch], int]:
+            if branch_id != ROOT_BRANCH and all(branch.id != branch_id for branch in conversation.branches):
+                raise ValueError(f"Branch {branch_id} of conversation {conversation_id} not found")
+            return list(conversation.branches), branch_id
+
+        return await cls._move_branch(conversation_id, switch)
+
+    @classmethod
+    async def _move_branch(cls, conversation_id: Any, move) -> "Conversation":
+        """移动当前分支指针，只更新对话文档
+        
+        以当前分支和分支数量作为条件更新，并发修改时重新读取后重试。
+        """
+        for _ in range(3):
+            conversation = await cls.get(conversation_id)
+            if not conversation:
+                raise ValueError(f"Conversation {conversation_id} not found")
+            branches, active = move(conversation)
+            if active == conversation.active_branch:
+                return conversation
+
+            now = datetime.utcnow()
+            previous = conversation.active_branch
+            for branch in branches:
+                if branch.id in (previous, active):
+                    branch.last_active_at = now
+            # 离开的分支保留 BRANCH_RETENTION_HOURS 小时后清理
+            gc_at = now + timedelta(hours=settings.BRANCH_RETENTION_HOURS)
+            if conversation.branch_gc_at:
+                gc_at = min(gc_at, conversation.branch_gc_at)
+            update = {
+                "active_branch": active,
+                "branches": [branch.model_dump() for branch in branches],
+                "last_branch": max(conversation.last_branch, active),
+                "branch_gc_at": gc_at,
+                "updated_at": now
+            }
+            # 摘要中包含新分支上不可见的消息时清空摘要，由后续消息重新生成
+            shared = _shared_until(
+                branch_lineage(branches, previous),
+                branch_lineage(branches, active)
+            )
+            if shared is not None and conversation.summary_sequence > shared:
+                update.update({"current_context": None, "summary_sequence": 0})
+
+            result = await cls.get_motor_collection().update_one(
+                {"_id": conversation.id, **conversation.branch_guard()},
+                {"$set": update}
+            )
+            if result.modified_count:
+                for key, value in update.items():
+                    setattr(conversation, key, value)
+                conversation.branches = branches
+                return conversation
+        raise RuntimeError(f"Conversation {conversation_id} was modified concurrently")
+
+    @classmethod
+    async def allocate_sequences(cls, conversation_id: Any, count: int = 1) -> int:
+        """原子地预留连续的消息序号，一次往返完成，并发请求不会拿到相同的序号
+        
+        Args:
+            conversation_id: 对话ID
+            count: 预留的序号数量
+            
+        Returns:
+            int: 预留的第一个序号，预留范围为 [返回值, 返回值 + count)
+            
+        Raises:
+            ValueError: 对话不存在
+        """
+        result = await cls.get_motor_collection().find_one_and_update(
+            {"_id": conversation_id},
+            {"$inc": {"last_sequence": count}, "$set": {"updated_at": datetime.utcnow()}},
+            projection={"last_sequence": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if result is None:
+            raise ValueError(f"Conversation {conversation_id} not found")
+        return result["last_sequence"] - count + 1
+
+    @classmethod
+    async def sync_last_sequence(cls, conversation_id: Any) -> None:
+        """把序号计数校正为不小于已有消息的最大序号
+        
+        Args:
+            conversation_id: 对话ID
+        """
+        from .conversation_message import ConversationMessage
+        last = await ConversationMessage.get_motor_collection().find_one(
+            {"conversation.$id": conversation_id},
+            {"sequence": 1},
+            sort=[("sequence", -1)]
+        )
+        if last:
+            await cls.get_motor_collection().update_one(
+                {"_id": conversation_id},
+                {"$max": {"last_sequence": last["sequence"]}}
+            )
 
     async def get_next_sequence(self) -> int:
         """获取下一个消息序号
@@ -56,6 +377,5 @@ class Conversation(Document):
         Returns:
             int: 下一个消息序号
         """
-        self.last_sequence += 1
-        await self.save()
+        self.last_sequence = await self.allocate_sequences(self.id)
         return self.last_sequence 
\ No newline at end of file
@@ -0,0 +1,32 @@
+from datetime import datetime
+
+from beanie import Document, PydanticObjectId
+from pydantic import Field
+from pymongo import IndexModel
+
+
+class ConversationArchive(Document):
+    """归档的对话消息
+
+    闲置对话的消息按序号分块，每块为压缩后的JSON行（bson.json_util 格式，保留ObjectId、DBRef和时间类型），
+    对话被访问时恢复到 conversation_messages 并删除归档。
+    """
+    conversation_id: PydanticObjectId = Field(description="对话ID")
+    chunk: int = Field(description="分块序号，从0开始")
+    codec: str = Field(description="压缩编码：zstd/zlib")
+    data: bytes = Field(description="压缩后的消息")
+    message_count: int = Field(description="消息数量")
+    first_sequence: int = Field(description="第一条消息的序号")
+    last_sequence: int = Field(description="最后一条消息的序号")
+    raw_size: int = Field(description="压缩前的字节数")
+    created_at: datetime = Field(default_factory=datetime.utcnow, description="归档时间")
+
+    class Settings:
+        name = "conversation_archives"
+        indexes = [
+            IndexModel(
+                [("conversation_id", 1), ("chunk", 1)],
+                unique=True,
+                name="conversation_chunk_unique"
+            )
+        ]
@@ -1,9 +1,14 @@
+import re
 from datetime import datetime
 from enum import Enum
-from typing import TYPE_CHECKING, Optional, Any, ForwardRef
+from typing import TYPE_CHECKING, Optional, Any, ForwardRef, List
 
-from beanie import Document, Link, Indexed
+from beanie import Document, Link, Indexed, Insert, PydanticObjectId, before_event
 from pydantic import Field
+from pymongo import IndexModel
+from pymongo.errors import DuplicateKeyError
+
+from utils.tokens import count_tokens
 
 if TYPE_CHECKING:
     from .conversation import Conversation
@@ -29,15 +34,38 @@ class ConversationMessage(Document):
     character: Optional[Link[Character]] = None  # 关联的角色
     character_name: Optional[str] = None  # 角色名称
     content: str  # 消息内容
-    sequence: Indexed(int)  # 消息序号，用于回退
+    sequence: Indexed(int)  # 消息序号，在对话内按写入顺序递增，所有分支共用
+    branch_id: int = 0  # 消息所属的分支，见 Conversation.branches
     role: MessageRole = Field(default=MessageRole.CHARACTER)  # 消息角色
+    token_count: Optional[int] = None  # 消息内容的token数，插入时计算，组装上下文时直接使用
+    request_id: Optional[str] = None  # 客户端请求ID加消息在请求中的位置，重试时用于幂等写入
+    partial: bool = False  # 回复是否未生成完（流式生成的检查点，或生成中断）
+    turn_speakers: Optional[List[str]] = None  # 对话轮次中用户消息上记录的本轮说话角色，重试时按此补全未完成的回复
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
     class Settings:
         name = "conversation_messages"
+        # conversation 存储为DBRef，查询条件使用 conversation.$id，索引也建在 conversation.$id 上
         indexes = [
-            [("conversation", 1), ("sequence", 1)],  # 复合索引
-            [("conversation", 1), ("created_at", -1)]  # 用于按时间查询
+            IndexModel(
+                [("conversation.$id", 1), ("sequence", 1)],
+                unique=True,
+                name="conversation_sequence_unique"
+            ),  # 同一对话中序号唯一，也用于按序号查询和排序
+            IndexModel(
+                [("conversation.$id", 1), ("branch_id", 1), ("sequence", 1)],
+                name="conversation_branch_sequence"
+            ),  # 沿当前分支读取历史消息，清理分支
+            IndexModel(
+                [("conversation.$id", 1), ("created_at", -1)],
+                name="conversation_created_at"
+            ),  # 用于按时间查询
+            IndexModel(
+                [("conversation.$id", 1), ("request_id", 1)],
+                unique=True,
+                partialFilterExpression={"request_id": {"$type": "string"}},
+                name="conversation_request_unique"
+            )  # 同一请求的消息只写入一次
         ]
         
     class Config:
@@ -45,6 +73,68 @@ class ConversationMessage(Document):
             datetime: lambda v: v.isoformat()
         }
 
+    @before_event(Insert)
+    def fill_token_count(self):
+        """插入前计算消息内容的token数"""
+        if self.token_count is None:
+            self.token_count = count_tokens(self.content)
+
+    async def insert_once(self) -> "ConversationMessage":
+        """幂等插入消息
+
+        request_id 相同的消息已存在时返回已有的消息；
+        序号冲突时（对话的序号计数落后于已有消息）先校正计数，重新分配序号后再插入一次。
+
+        Returns:
+            ConversationMessage: 插入的消息或已存在的消息
+
+        Raises:
+            DuplicateKeyError: 重新分配序号后仍然冲突
+        """
+        from .conversation import Conversation  # 避免循环导入
+        conversation_id = self.conversation.ref.id if isinstance(self.conversation, Link) else self.conversation.id
+        for attempt in range(2):
+            try:
+                await self.insert()
+                return self
+            except DuplicateKeyError as e:
+                key_pattern = (e.details or {}).get("keyPattern", {})
+                if self.request_id and "request_id" in key_pattern:
+                    existing = await ConversationMessage.find_one(
+                        {"conversation.$id": conversation_id, "request_id": self.request_id}
+                    )
+                    if existing:
+                        return existing
+                if attempt or "sequence" not in key_pattern:
+                    raise
+                self.id = None
+                await Conversation.sync_last_sequence(conversation_id)
+                self.sequence = await Conversation.allocate_sequences(conversation_id)
+        return self
+
+    @classmethod
+    async def resume_request_messages(cls, conversation_id: Any, request_id: str) -> dict[str, "ConversationMessage"]:
+        """获取一个客户端请求已经完整写入的消息
+
+        未生成完的回复（检查点或中断时写入的部分内容）被删除，重试时重新生成。
+
+        Args:
+            conversation_id: 对话ID
+            request_id: 客户端请求ID
+
+        Returns:
+            dict[str, ConversationMessage]: 以消息的request_id为键
+        """
+        query = {
+            "conversation.$id": conversation_id,
+            # $type 条件与部分索引的过滤条件一致，查询才能使用该索引
+            "request_id": {"$type": "string", "$regex": f"^{re.escape(request_id)}:"}
+        }
+        messages = await cls.find(query).sort("sequence").to_list()
+        if any(message.partial for message in messages):
+            await cls.find({**query, "partial": True}).delete()
+        return {message.request_id: message for message in messages if not message.partial}
+
     @classmethod
     async def get_conversation_messages(
         cls,
@@ -52,7 +142,7 @@ class ConversationMessage(Document):
         limit: int = 20,
         skip: int = 0
     ) -> list["ConversationMessage"]:
-        """获取对话的消息列表
+        """获取对话当前分支上的消息列表
         
         Args:
             conversation_id: 对话ID
@@ -62,8 +152,12 @@ class ConversationMessage(Document):
         Returns:
             list[ConversationMessage]: 消息列表
         """
+        from .conversation import Conversation  # 避免循环导入
+        conversation = await Conversation.get(PydanticObjectId(conversation_id))
+        if not conversation:
+            return []
         return await cls.find(
-            {"conversation._id": conversation_id}
+            conversation.message_filter()
         ).sort(
             "sequence"
         ).skip(skip).limit(limit).to_list()
@@ -73,19 +167,21 @@ class ConversationMessage(Document):
         cls,
         conversation_id: str,
         target_sequence: int
-    ) -> None:
+    ) -> int:
         """回退对话到指定序号的消息
         
+        不删除消息，从当前分支分出新分支，见 Conversation.rollback。
+        
         Args:
             conversation_id: 对话ID
             target_sequence: 目标消息序号
+            
+        Returns:
+            int: 回退后的当前分支ID
         """
-        await cls.find(
-            {
-                "conversation._id": conversation_id,
-                "sequence": {"$gt": target_sequence}
-            }
-        ).delete()
+        from .conversation import Conversation  # 避免循环导入
+        conversation = await Conversation.rollback(PydanticObjectId(conversation_id), target_sequence)
+        return conversation.active_branch
 
     @classmethod
     async def create_character_message(
@@ -144,4 +240,17 @@ class ConversationMessage(Document):
             role=MessageRole.USER
         )
         await message.insert()
-        return message 
\ No newline at end of file
+        return message
+
+
+def message_request_id(request_id: Optional[str], part: Any) -> Optional[str]:
+    """客户端请求中一条消息的幂等键
+
+    Args:
+        request_id: 客户端请求ID，为空时不做幂等
+        part: 消息在请求中的位置，如 "user" 或角色ID
+
+    Returns:
+        Optional[str]: 幂等键
+    """
+    return f"{request_id}:{part}" if request_id else None
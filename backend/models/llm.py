@@ -27,6 +27,10 @@ class LLMSettings(BaseModel):
     steps: Optional[int] = None  # 生成步数，仅用于t2i类型，用于flux-schnell
     n: Optional[int] = None  # 生成步数n，仅用于t2i类型，用于stable diffusion
     guidance: Optional[float] = None  # 指导度量值，仅用于t2i类型
+    rpm: Optional[int] = None  # 每分钟请求数上限，为空表示不限制
+    tpm: Optional[int] = None  # 每分钟token数上限，为空表示不限制
+    max_concurrency: Optional[int] = None  # 同时进行的请求数上限，为空表示不限制
+    context_tokens: Optional[int] = None  # 提示词中历史消息的token预算，为空时使用 CONTEXT_HISTORY_TOKENS
 
 
 class LLM(Document):
@@ -35,6 +39,10 @@ class LLM(Document):
     type: Indexed(str)  # LLM类型
     api_key: str  # API密钥
     usage_count: int = 0  # 使用次数
+    prompt_tokens: int = 0  # 累计输入token数
+    completion_tokens: int = 0  # 累计输出token数
+    total_tokens: int = 0  # 累计token数
+    cached_tokens: int = 0  # 累计命中上游前缀缓存的输入token数
     last_used: Optional[datetime] = None  # 最后使用时间
     settings: LLMSettings  # LLM设置
     status: str = "active"  # 状态：active/inactive
@@ -61,11 +69,13 @@ class LLM(Document):
 
     @classmethod
     async def get_least_used_model(cls, type: str) -> Optional["LLM"]:
-        """获取使用次数最少的指定类型模型"""
-        models = await cls.find(
-            {"type": type, "status": "active"}
-        ).sort("usage_count").to_list()
-        return models[0] if models else None
+        """获取当前负载最低的指定类型模型
+
+        由 llm_router 根据进行中的请求数、延迟、错误率和限流余量选择，
+        不再对整个集合按使用次数排序
+        """
+        from services.llm_router import llm_router  # 避免循环导入
+        return await llm_router.pick(type)
 
     @classmethod
     async def get_least_recent_model(cls, type: str) -> Optional["LLM"]:
@@ -119,9 +129,13 @@ class LLM(Document):
         await llm.insert()
         return llm
 
-    async def increment_usage(self):
-        """增加使用次数"""
-        self.usage_count += 1
-        self.last_used = datetime.utcnow()
-        self.updated_at = datetime.utcnow()
-        await self.save() 
\ No newline at end of file
+    async def increment_usage(self, usage: Optional[Any] = None):
+        """增加使用次数
+
+        只记入内存中的 usage_aggregator，由其定期批量写入数据库
+
+        Args:
+            usage: 上游返回的 usage 字段，用于累计token数
+        """
+        from services.usage import usage_aggregator  # 避免循环导入
+        usage_aggregator.record_llm(self.llm_id, usage)
@@ -1,8 +1,12 @@
 from datetime import datetime
-from typing import Optional
+from typing import Any, Dict, List, Optional, Tuple
 from beanie import Document, Indexed
+from bson import ObjectId
 from pydantic import Field
 
+# 列表接口返回的字段，不加载完整文档
+MUSIC_LIST_PROJECTION = {"name": 1, "url": 1, "type": 1, "created_at": 1, "updated_at": 1}
+
 
 class Music(Document):
     """音乐模型
@@ -19,7 +23,8 @@ class Music(Document):
         name = "music"  # 集合名称
         indexes = [
             "name",  # unique
-            "type"   # 按类型查询
+            "type",  # 按类型查询
+            "updated_at"  # 计算列表版本
         ]
         
     class Config:
@@ -71,4 +76,79 @@ class Music(Document):
         Returns:
             list[Music]: 音乐列表
         """
-        return await cls.find({"type": type}).to_list() 
\ No newline at end of file
+        return await cls.find({"type": type}).to_list()
+
+    @classmethod
+    async def get_music_page(
+        cls,
+        type: Optional[str] = None,
+        cursor: Optional[str] = None,
+        limit: int = 100
+    ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """按ID顺序分页获取音乐，只读取列表字段
+        
+        Args:
+            type: 可选的音乐类型过滤
+            cursor: 上一页最后一条音乐的ID
+            limit: 每页数量
+            
+        Returns:
+            Tuple[List[Dict[str, Any]], Optional[str]]: (音乐列表, 下一页的cursor，没有下一页时为None)
+        """
+        query: Dict[str, Any] = {"type": type} if type else {}
+        if cursor:
+            query["_id"] = {"$gt": ObjectId(cursor)}
+        documents = await cls.get_motor_collection().find(
+            query, MUSIC_LIST_PROJECTION
+        ).sort("_id", 1).limit(limit + 1).to_list(length=limit + 1)
+        
+        items = [{**document, "_id": str(document["_id"])} for document in documents[:limit]]
+        next_cursor = items[-1]["_id"] if len(documents) > limit else None
+        return items, next_cursor
+
+    @classmethod
+    async def count_music(cls, type: Optional[str] = None) -> int:
+        """统计音乐数量
+        
+        Args:
+            type: 可选的音乐类型过滤
+            
+        Returns:
+            int: 音乐数量
+        """
+        return await cls.get_motor_collection().count_documents({"type": type} if type else {})
+
+    @classmethod
+    async def get_types(cls) -> List[str]:
+        """获取所有不重复的音乐类型，使用type索引
+        
+        Returns:
+            List[str]: 排序后的类型列表
+        """
+        return sorted(await cls.get_motor_collection().distinct("type"))
+
+    @classmethod
+    async def get_type_facets(cls) -> List[Dict[str, Any]]:
+        """统计每种类型的音乐数量
+        
+        Returns:
+            List[Dict[str, Any]]: [{"type": 类型, "count": 数量}]，按类型排序
+        """
+        pipeline = [
+            {"$group": {"_id": "$type", "count": {"$sum": 1}}},
+            {"$sort": {"_id": 1}}
+        ]
+        results = await cls.get_motor_collection().aggregate(pipeline).to_list(length=None)
+        return [{"type": result["_id"], "count": result["count"]} for result in results]
+
+    @classmethod
+    async def get_version(cls) -> Tuple[int, Optional[datetime]]:
+        """音乐集合的版本：文档数量和最后更新时间，用于计算ETag
+        
+        Returns:
+            Tuple[int, Optional[datetime]]: (文档数量, 最后更新时间)
+        """
+        collection = cls.get_motor_collection()
+        latest = await collection.find_one({}, {"updated_at": 1}, sort=[("updated_at", -1)])
+        count = await collection.estimated_document_count()
+        return count, latest["updated_at"] if latest else None
@@ -1,3 +1,4 @@
+import logging
 from typing import Optional, Dict, Any, AsyncGenerator, Literal, Union, List
 from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks
 from fastapi.responses import StreamingResponse
@@ -6,12 +7,21 @@ from models.llm import LLM
 from utils.auth import get_current_user
 from utils.image import save_download_file, get_image_url
 from config.settings import settings
+from services.llm_router import llm_router
+from services.usage import usage_aggregator
+from services.rate_limiter import RateLimitTimeout, rate_limiter
+from utils.streaming import prefetch_first
+from utils.metrics import external_request_duration_seconds
+from utils.tracing import span
 import httpx
 import json
 import asyncio
+import math
 from datetime import datetime
 import uuid
 
+logger = logging.getLogger(__name__)
+
 router = APIRouter(prefix="/ai", tags=["ai"])
 
 class ImageUrlContent(BaseModel):
@@ -111,12 +121,24 @@ async def _stream_chat_completion(
         except (httpx.TimeoutException, httpx.RequestError) as e:
             raise HTTPException(status_code=500, detail=f"Stream request error: {str(e)}")
 
-async def _update_usage(llm: LLM):
-    """更新模型使用次数"""
-    try:
-        await llm.increment_usage()
-    except Exception as e:
-        print(f"Error updating usage count: {str(e)}")
+async def _limited_stream_chat_completion(
+    llm: LLM,
+    url: str,
+    headers: Dict[str, str],
+    json_data: Dict[str, Any]
+) -> AsyncGenerator[str, None]:
+    """在模型限额内流式返回chat completion结果，并发许可在流结束时释放"""
+    async with rate_limiter.limit(llm, llm.settings.max_tokens or 0):
+        async for line in _stream_chat_completion(url, headers, json_data):
+            yield line
+
+def _rate_limit_exception(e: RateLimitTimeout) -> HTTPException:
+    """限流排队超时转换为429响应"""
+    return HTTPException(
+        status_code=429,
+        detail=str(e),
+        headers={"Retry-After": str(math.ceil(e.retry_after))}
+    )
 
 @router.post("/i2t/chat/completions")
 async def i2t_chat_completion(
@@ -172,15 +194,15 @@ async def i2t_chat_completion(
     
     try:
         if request.stream:
-            # 流式返回
-            background_tasks.add_task(_update_usage, llm)
-            return StreamingResponse(
-                _stream_chat_completion(url, headers, json_data),
-                media_type="text/event-stream"
+            # 流式返回，在返回响应前取得限额，排队超时时返回429
+            stream = await prefetch_first(
+                _limited_stream_chat_completion(llm, url, headers, json_data)
             )
+            usage_aggregator.record_llm(llm.llm_id)
+            return StreamingResponse(stream, media_type="text/event-stream")
         else:
             # 一次性返回
-            async with httpx.AsyncClient() as client:
+            async with rate_limiter.limit(llm, llm.settings.max_tokens or 0), httpx.AsyncClient() as client:
                 response = await client.post(
                     url,
                     headers=headers,
@@ -194,11 +216,14 @@ async def i2t_chat_completion(
                         detail=f"LLM API error: {response.text}"
                     )
                 
-                # 更新使用次数
-                background_tasks.add_task(_update_usage, llm)
+                # 记录使用次数和token数
+                result = response.json()
+                usage_aggregator.record_llm(llm.llm_id, result.get("usage"))
                 
-                return response.json()
+                return result
                 
+    except RateLimitTimeout as e:
+        raise _rate_limit_exception(e)
     except httpx.TimeoutException:
         raise HTTPException(status_code=504, detail="Request timeout")
     except httpx.RequestError as e:
@@ -305,18 +330,21 @@ async def submit_t2i_task(
     
     url = f"{llm.settings.base_url}/302/submit/{llm.settings.model}"
     
-    print(f"Request URL: {url}")
-    print(f"Request headers: {headers}")
-    print(f"Request JSON: {json_data}")
+    logger.debug("Submitting T2I task to %s: %s", url, json_data)
     
     try:
         async with httpx.AsyncClient() as client:
-            response = await client.post(
-                url,
-                headers=headers,
-                json=json_data,
-                timeout=60.0
-            )
+            async with rate_limiter.limit(llm):
+                with (
+                    span("t2i.submit", llm_id=llm.llm_id),
+                    external_request_duration_seconds.labels(service="t2i", operation="submit").time()
+                ):
+                    response = await client.post(
+                        url,
+                        headers=headers,
+                        json=json_data,
+                        timeout=60.0
+                    )
             
             if response.status_code != 200:
                 raise HTTPException(
@@ -324,8 +352,8 @@ async def submit_t2i_task(
                     detail=f"Task submit error: {response.text}"
                 )
             
-            # 更新使用次数
-            background_tasks.add_task(_update_usage, llm)
+            # 记录使用次数
+            usage_aggregator.record_llm(llm.llm_id)
             
             # 获取响应数据
             response_data = response.json()
@@ -333,7 +361,11 @@ async def submit_t2i_task(
             # 下载并保存图片
             image_url = response_data["images"][0]["url"]
             async with httpx.AsyncClient() as client:
-                img_response = await client.get(image_url)
+                with (
+                    span("t2i.download"),
+                    external_request_duration_seconds.labels(service="t2i", operation="download").time()
+                ):
+                    img_response = await client.get(image_url)
                 if img_response.status_code != 200:
                     raise HTTPException(
                         status_code=img_response.status_code,
@@ -356,6 +388,8 @@ async def submit_t2i_task(
                 
                 return response_data
                 
+    except RateLimitTimeout as e:
+        raise _rate_limit_exception(e)
     except httpx.TimeoutException:
         raise HTTPException(status_code=504, detail="Task submit timeout")
     except httpx.RequestError as e:
@@ -414,7 +448,9 @@ async def get_least_used_model(
     type: str,
     current_user = Depends(get_current_user)
 ) -> ModelResponse:
-    """获取指定类型中最长时间未使用的模型
+    """获取指定类型中当前负载最低的模型
+    
+    由 llm_router 根据进行中的请求数、延迟、错误率和限流余量选择
     
     Args:
         type: 模型类型(chat/other/t2i/i2t)
@@ -423,11 +459,7 @@ async def get_least_used_model(
     Returns:
         模型信息
     """
-    # 查询指定类型的可用模型，按最后使用时间升序排序
-    model = await LLM.find_one(
-        {"type": type, "status": "active"},
-        sort=[("last_used", 1)]  # 1表示升序
-    )
+    model = await llm_router.pick(type)
     
     if not model:
         raise HTTPException(
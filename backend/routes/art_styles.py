@@ -1,8 +1,10 @@
 from typing import List, Optional
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
 from models.art_style import ArtStyle
 from models.user import User
 from utils.auth import get_current_user
+from utils.http_cache import check_etag
+from services.catalog import catalog
 
 router = APIRouter(
     prefix="/art-styles",
@@ -12,23 +14,24 @@ router = APIRouter(
 
 @router.get("/", response_model=List[ArtStyle])
 async def get_art_styles(
+    request: Request,
+    response: Response,
     status: Optional[str] = Query(None, description="筛选状态：active/inactive"),
     current_user: User = Depends(get_current_user)
 ) -> List[ArtStyle]:
     """获取艺术风格列表
     
     Args:
+        request: 请求对象，用于条件请求
+        response: 响应对象，用于设置ETag
         status: 可选，筛选状态 active/inactive
         current_user: 当前用户（通过依赖注入获取）
         
     Returns:
         List[ArtStyle]: 艺术风格列表
     """
-    # 构建查询条件
-    query = {}
-    if status:
-        query["status"] = status
-        
-    # 查询数据库
-    art_styles = await ArtStyle.find(query).to_list()
-    return art_styles 
\ No newline at end of file
+    collection = await catalog.get(ArtStyle)
+    not_modified = check_etag(request, response, collection.etag)
+    if not_modified:
+        return not_modified
+    return collection.find(status=status or None) 
\ No newline at end of file
@@ -1,3 +1,4 @@
+import logging
 import os
 import random
 import traceback
@@ -9,21 +10,59 @@ from PIL import Image
 import face_recognition
 import requests
 from models.character import Character
-from models.character_system_prompt_post import CharacterSystemPromptPost
 from models.llm import LLM
-from models.prompt_template import PromptTemplate
 from models.user import User
 from utils.auth import get_current_user
 from utils.image import save_download_file, get_image_url
 from utils.rmbg import background_remover
+from utils.tracing import span
 from config.settings import settings
 from routes.llm import ChatCompletionRequest, chat_completion
 from routes.ai import T2ISubmitRequest, T2ISubmitResponse, submit_t2i_task
+from services.prompt_templates import compile_template, prompt_templates
 import io
 import numpy as np
 
+logger = logging.getLogger(__name__)
+
 router = APIRouter()
 
+# 角色形象图片提示词的第一阶段输入
+AVATAR_PROMPT_TEMPLATE = compile_template(
+    "Art Style: {art_style}\n"
+    "Character Description: {character_description}\n"
+    "Personality: {personality}\n"
+    "{reference}"
+    "Task: {task}",
+    "avatar_prompt"
+)
+
+# 生成角色系统提示词的LLM输入
+CHARACTER_PROMPT_TEMPLATE = compile_template("""Character Name: {character_name}
+Character Description: {character_description}
+Personality: {personality}
+
+# Reference System Prompt: 
+{reference_system_prompt}
+
+# TASK:
+你要为上面的人物生成一个系统提示词。
+
+# 要求：
+* 系统提示词要符合人物的性格
+* 系统提示词必须！！必须！！严格的遵循参考系统提示词的格式
+* 系统提示词的每个符号都必须严格遵循参考系统提示词的格式
+* 系统提示词的第一行从: Your are {character_name}.开始
+* 如果人物的性格未指定，则随机生成一个人物的性格，根据随机数 {seed}，不要按照参考的来
+* 系统提示词必须使用{language}语言
+""", "character_prompt")
+
+# 追加在生成的系统提示词之后的要求
+CHARACTER_REQUIREMENTS_TEMPLATE = compile_template(
+    "{system_prompt}\n\n{requirements}\n 角色必须说{language}语言!!!!",
+    "character_requirements"
+)
+
 class CreateCharacterRequest(BaseModel):
     """创建角色请求模型"""
     llm_id: str = Field(..., description="LLM ID", example="other-agent")
@@ -98,24 +137,22 @@ async def generate_avatar(
     """
     try:
         # 获取提示词模板
-        prompt_template = await PromptTemplate.find_one({"type": "t2i_character"})
+        prompt_template = await prompt_templates.prompt_template("t2i_character")
         if not prompt_template:
             raise HTTPException(status_code=404, detail="Prompt template not found")
         
         # 构建第一阶段提示词
-        prompt_parts = [
-            f"Art Style: {request.art_style_keyword}",
-            f"Character Description: {request.character_description}",
-            f"Personality: {request.personality}"
-        ]
-        
+        reference = ""
         if request.reference_image_description:
-            prompt_parts.append(f"Reference Image: {request.reference_image_description}")
-            
-        prompt_parts.append(f"Task: {prompt_template.content}")
-        
-        prompt_1st = "\n".join(prompt_parts)
-        print(f"First stage prompt: {prompt_1st}")  # 调试信息
+            reference = f"Reference Image: {request.reference_image_description}\n"
+        prompt_1st = AVATAR_PROMPT_TEMPLATE.render(
+            art_style=request.art_style_keyword,
+            character_description=request.character_description,
+            personality=request.personality,
+            reference=reference,
+            task=prompt_template.source
+        )
+        logger.debug("First stage prompt: %s", prompt_1st)
         
         # 调用LLM生成图片提示词
         chat_request = ChatCompletionRequest(
@@ -129,9 +166,8 @@ async def generate_avatar(
         )
         
         response = await chat_completion(chat_request, background_tasks, current_user)
-        print(f"LLM response: {response}")  # 调试信息
         prompt_image = response["choices"][0]["message"]["content"]
-        print(f"Generated image prompt: {prompt_image}")  # 调试信息
+        logger.debug("Generated image prompt: %s", prompt_image)
 
         # 调用文生图接口生成图片
         t2i_request = T2ISubmitRequest(
@@ -141,7 +177,6 @@ async def generate_avatar(
         
         # 调用文生图接口
         t2i_response = await submit_t2i_task(t2i_request, background_tasks)
-        print(f"T2I response: {t2i_response}")  # 调试信息
         
         # 返回生成的图片URL
         if not t2i_response["images"]:
@@ -174,7 +209,8 @@ async def generate_avatar(
             image_array = np.array(pil_image)
             
             # 检测人脸位置
-            face_locations = face_recognition.face_locations(image_array)
+            with span("face_detection"):
+                face_locations = face_recognition.face_locations(image_array)
             
             if face_locations:
                 # 使用第一个检测到的人脸
@@ -216,7 +252,7 @@ async def generate_avatar(
             
         except Exception as e:
             error_detail = f"Image processing error: {str(e)}\n\nTraceback:\n{traceback.format_exc()}"
-            print(error_detail)  # 打印错误到服务器日志
+            logger.exception("Image processing error")
             raise HTTPException(
                 status_code=500,
                 detail=error_detail
@@ -224,7 +260,7 @@ async def generate_avatar(
         
     except Exception as e:
         error_detail = f"Error generating image: {str(e)}\n\nTraceback:\n{traceback.format_exc()}"
-        print(error_detail)  # 打印错误到服务器日志
+        logger.exception("Error generating image")
         raise HTTPException(
             status_code=500,
             detail=error_detail
@@ -248,46 +284,23 @@ async def create_character(
         CreateCharacterResponse: 创建的角色ID
     """
     # 获取系统提示词
-    system_prompt_post = await CharacterSystemPromptPost.find_one({
-        "type": "description",
-        "language": request.language
-    })
+    system_prompt_post = await prompt_templates.system_prompt_post("description", request.language)
     if not system_prompt_post:
         raise HTTPException(status_code=404, detail=f"System prompt post not found for language {request.language}")
     
-    requirement_prompt_post = await CharacterSystemPromptPost.find_one({
-        "type": "requirements",
-        "language": request.language
-    })
+    requirement_prompt_post = await prompt_templates.system_prompt_post("requirements", request.language)
     if not requirement_prompt_post:
         raise HTTPException(status_code=404, detail=f"Requirement prompt post not found for language {request.language}")
 
-    reference_system_prompt = f"""
-    {system_prompt_post.content}
-    """
-
-
     # 构造LLM输入提示词
-    llm_input = f"""
-    Character Name: {request.character_name}
-    Character Description: {request.character_description}
-    Personality: {request.personality}
-    
-    # Reference System Prompt: 
-    {reference_system_prompt}
-
-    # TASK:
-    你要为上面的人物生成一个系统提示词。
-
-    # 要求：
-    * 系统提示词要符合人物的性格
-    * 系统提示词必须！！必须！！严格的遵循参考系统提示词的格式
-    * 系统提示词的每个符号都必须严格遵循参考系统提示词的格式
-    * 系统提示词的第一行从: Your are {request.character_name}.开始
-    * 如果人物的性格未指定，则随机生成一个人物的性格，根据随机数 {random.randint(1, 100000)}，不要按照参考的来
-    * 系统提示词必须使用{request.language}语言
-
-    """
+    llm_input = CHARACTER_PROMPT_TEMPLATE.render(
+        character_name=request.character_name,
+        character_description=request.character_description,
+        personality=request.personality,
+        reference_system_prompt=system_prompt_post.source,
+        seed=random.randint(1, 100000),
+        language=request.language
+    )
     
     # 调用LLM生成系统提示词
     llm = await LLM.find_one({"llm_id": request.llm_id})
@@ -303,7 +316,11 @@ async def create_character(
     )
     response = await chat_completion(chat_completion_request, background_tasks, current_user)
     system_prompt = response["choices"][0]["message"]["content"]
-    system_prompt += f'\n\n{requirement_prompt_post.content}\n 角色必须说{request.language}语言!!!!'
+    system_prompt = CHARACTER_REQUIREMENTS_TEMPLATE.render(
+        system_prompt=system_prompt,
+        requirements=requirement_prompt_post.source,
+        language=request.language
+    )
     # 创建角色
     character = Character(
         name=request.character_name,
@@ -1,6 +1,6 @@
 from datetime import datetime
 from typing import List, Optional
-from fastapi import APIRouter, HTTPException, Depends, Query
+from fastapi import APIRouter, HTTPException, Depends, Query, Request, Response
 from beanie import PydanticObjectId
 
 from models.character_system_prompt_post import CharacterSystemPromptPost
@@ -9,11 +9,16 @@ from schemas.character_system_prompt_post import (
     CharacterSystemPromptPostResponse
 )
 from utils.auth import get_current_user
+from utils.http_cache import check_etag
+from utils.lean import lean_response
+from services.catalog import catalog
 
 router = APIRouter()
 
 @router.get("/system-prompt-posts", response_model=List[CharacterSystemPromptPostResponse])
 async def get_system_prompt_posts(
+    request: Request,
+    response: Response,
     type: Optional[str] = Query(None, pattern="^(description|requirements)$"),
     language: Optional[str] = Query(None, pattern="^(中文|English)$"),
     current_user = Depends(get_current_user)
@@ -21,6 +26,8 @@ async def get_system_prompt_posts(
     """获取所有角色系统提示词补充
     
     Args:
+        request: 请求对象，用于条件请求
+        response: 响应对象，用于设置ETag
         type: 可选，筛选类型：description/requirements
         language: 可选，筛选语言：中文/English
         current_user: 当前登录用户
@@ -28,26 +35,24 @@ async def get_system_prompt_posts(
     Returns:
         List[CharacterSystemPromptPostResponse]: 提示词补充列表
     """
-    # 构建查询条件
-    query = {}
-    if type:
-        query["type"] = type
-    if language:
-        query["language"] = language
-        
-    posts = await CharacterSystemPromptPost.find(query).to_list()
+    collection = await catalog.get(CharacterSystemPromptPost)
+    not_modified = check_etag(request, response, collection.etag)
+    if not_modified:
+        return not_modified
     
-    return [
-        CharacterSystemPromptPostResponse(
-            id=str(post.id),
-            type=post.type,
-            language=post.language,
-            content=post.content,
-            created_at=post.created_at,
-            updated_at=post.updated_at
-        )
-        for post in posts
-    ]
+    # 同一快照和筛选条件的响应只序列化一次
+    body = collection.encode(("list", type, language), lambda: [
+        {
+            "id": str(post.id),
+            "type": post.type,
+            "language": post.language,
+            "content": post.content,
+            "created_at": post.created_at,
+            "updated_at": post.updated_at
+        }
+        for post in collection.find(type=type, language=language)
+    ])
+    return lean_response(body, response)
 
 @router.post("/system-prompt-posts", response_model=CharacterSystemPromptPostResponse)
 async def create_system_prompt_post(
@@ -72,6 +77,7 @@ async def create_system_prompt_post(
         updated_at=now
     )
     await post.insert()
+    catalog.invalidate(CharacterSystemPromptPost)
     
     return CharacterSystemPromptPostResponse(
         id=str(post.id),
@@ -85,24 +91,28 @@ async def create_system_prompt_post(
 @router.get("/system-prompt-posts/{post_id}", response_model=CharacterSystemPromptPostResponse)
 async def get_system_prompt_post(
     post_id: str,
+    request: Request,
+    response: Response,
     current_user = Depends(get_current_user)
 ):
     """获取单个角色系统提示词补充
     
     Args:
         post_id: 提示词补充ID
+        request: 请求对象，用于条件请求
+        response: 响应对象，用于设置ETag
         current_user: 当前登录用户
         
     Returns:
         CharacterSystemPromptPostResponse: 提示词补充详情
     """
-    try:
-        post = await CharacterSystemPromptPost.get(PydanticObjectId(post_id))
-    except:
-        raise HTTPException(status_code=404, detail="System prompt post not found")
-    
+    collection = await catalog.get(CharacterSystemPromptPost)
+    post = collection.get(post_id)
     if not post:
         raise HTTPException(status_code=404, detail="System prompt post not found")
+    not_modified = check_etag(request, response, collection.etag)
+    if not_modified:
+        return not_modified
     
     return CharacterSystemPromptPostResponse(
         id=str(post.id),
@@ -142,6 +152,7 @@ async def update_system_prompt_post(
     post.content = post_data.content
     post.updated_at = datetime.utcnow()
     await post.save()
+    catalog.invalidate(CharacterSystemPromptPost)
     
     return CharacterSystemPromptPostResponse(
         id=str(post.id),
@@ -171,4 +182,5 @@ async def delete_system_prompt_post(
     if not post:
         raise HTTPException(status_code=404, detail="System prompt post not found")
     
-    await post.delete() 
\ No newline at end of file
+    await post.delete() 
+    catalog.invalidate(CharacterSystemPromptPost)
@@ -9,6 +9,7 @@ from models.conversation_message import ConversationMessage
 from models.user import User
 from models.story import Story
 from utils.auth import get_current_user
+from utils.lean import find_lean, lean_response
 
 router = APIRouter()
 
@@ -57,20 +58,14 @@ async def list_characters(current_user: User = Depends(get_current_user)):
     Returns:
         List[CharacterListResponse]: 角色列表
     """
-    characters = await Character.get_user_characters(current_user.wallet_address)
-    return [
-        CharacterListResponse(
-            id=str(char.id),
-            name=char.name,
-            description=char.description,
-            personality=char.personality,
-            image_prompt=char.image_prompt,
-            image_url=char.image_url,
-            icon_url=char.icon_url,
-            created_at=char.created_at.isoformat(),
-            updated_at=char.updated_at.isoformat()
-        ) for char in characters
-    ]
+    # 只读取列表字段，不读取较大的system_prompt，也不构建完整文档
+    characters = await find_lean(
+        CharacterListResponse,
+        Character.get_motor_collection(),
+        {"created_by": current_user.wallet_address},
+        sort=[("created_at", 1)]
+    )
+    return lean_response(characters)
 
 @router.get("/characters/{character_id}", response_model=CharacterResponse)
 async def get_character(
@@ -3,7 +3,7 @@ from typing import List, Optional
 from fastapi import APIRouter, Depends, HTTPException
 from pydantic import BaseModel, Field
 from beanie import PydanticObjectId
-from models.conversation import Conversation
+from models.conversation import ARCHIVED_STATUSES, ROOT_BRANCH, Conversation
 from models.conversation_message import ConversationMessage
 from models.story import Story
 from models.user import User
@@ -47,6 +47,24 @@ class CreateConversationResponse(BaseModel):
     created_at: datetime = Field(..., description="创建时间")
     last_message_id: str = Field(..., description="最后一条消息ID")
 
+class RollbackRequest(BaseModel):
+    """回退对话请求模型"""
+    sequence: int = Field(..., ge=0, description="回退后保留的最后一条消息的序号")
+
+class BranchResponse(BaseModel):
+    """对话分支响应模型"""
+    id: int = Field(..., description="分支ID，0为主分支")
+    parent: Optional[int] = Field(None, description="父分支ID")
+    fork_sequence: Optional[int] = Field(None, description="从父分支继承的最后一条消息的序号")
+    created_at: Optional[datetime] = Field(None, description="创建时间")
+    last_active_at: Optional[datetime] = Field(None, description="最后一次作为当前分支的时间")
+    active: bool = Field(..., description="是否为当前分支")
+
+class BranchesResponse(BaseModel):
+    """对话分支列表响应模型"""
+    active_branch: int = Field(..., description="当前分支ID")
+    branches: List[BranchResponse] = Field(..., description="分支列表，包含主分支")
+
 @router.post("/conversation", response_model=CreateConversationResponse)
 async def create_conversation(
     request: CreateConversationRequest,
@@ -93,7 +111,8 @@ async def create_conversation(
                 user_id=str(current_user.id),
                 status="active",
                 created_at=datetime.utcnow(),
-                updated_at=datetime.utcnow()
+                updated_at=datetime.utcnow(),
+                last_sequence=max(len(request.messages), 1)  # 初始消息占用的序号
             )
             await conversation.insert()
             logger.info(f"Created conversation: {conversation.dict()}")
@@ -177,7 +196,7 @@ async def check_conversation(
         conversation = await Conversation.find_one({
             "story.$id": story.id,  # 使用 DBRef 的 id 字段
             "user_id": str(current_user.id),  # 确保 user_id 是字符串
-            "status": "active"
+            "status": {"$in": ["active", *ARCHIVED_STATUSES]}  # 已归档的对话在读取消息时恢复
         }, sort=[("created_at", -1)])
         
         logger.info(f"Found conversation: {conversation.id if conversation else None}")
@@ -190,4 +209,96 @@ async def check_conversation(
         raise HTTPException(
             status_code=500,
             detail=f"Failed to check conversation: {str(e)}"
-        ) 
\ No newline at end of file
+        )
+
+async def _get_user_conversation(conversation_id: str, current_user: User) -> Conversation:
+    """获取当前用户的对话，不存在或不属于当前用户时抛出404错误"""
+    conversation = await Conversation.get(conversation_id) if PydanticObjectId.is_valid(conversation_id) else None
+    if not conversation or conversation.user_id != str(current_user.id):
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    return conversation
+
+def _branches_response(conversation: Conversation) -> BranchesResponse:
+    """构建对话分支列表"""
+    branches = [BranchResponse(id=ROOT_BRANCH, created_at=conversation.created_at, active=conversation.active_branch == ROOT_BRANCH)]
+    branches.extend(
+        BranchResponse(**branch.model_dump(), active=conversation.active_branch == branch.id)
+        for branch in conversation.branches
+    )
+    return BranchesResponse(active_branch=conversation.active_branch, branches=branches)
+
+@router.post("/conversation/{conversation_id}/rollback", response_model=BranchesResponse)
+async def rollback_conversation(
+    conversation_id: str,
+    request: RollbackRequest,
+    current_user: User = Depends(get_current_user)
+) -> BranchesResponse:
+    """回退对话
+    
+    从当前分支分出新分支，新分支只包含序号不大于 sequence 的消息，之后的消息写入新分支。
+    原分支的消息保留，可以通过切换分支恢复。
+    
+    Args:
+        conversation_id: 对话ID
+        request: 回退请求
+        current_user: 当前用户
+        
+    Returns:
+        BranchesResponse: 回退后的分支列表
+        
+    Raises:
+        HTTPException: 对话不存在时抛出404错误，并发修改时抛出409错误
+    """
+    conversation = await _get_user_conversation(conversation_id, current_user)
+    try:
+        conversation = await Conversation.rollback(conversation.id, request.sequence)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return _branches_response(conversation)
+
+@router.get("/conversation/{conversation_id}/branches", response_model=BranchesResponse)
+async def get_conversation_branches(
+    conversation_id: str,
+    current_user: User = Depends(get_current_user)
+) -> BranchesResponse:
+    """获取对话的分支列表
+    
+    Args:
+        conversation_id: 对话ID
+        current_user: 当前用户
+        
+    Returns:
+        BranchesResponse: 分支列表
+        
+    Raises:
+        HTTPException: 对话不存在时抛出404错误
+    """
+    return _branches_response(await _get_user_conversation(conversation_id, current_user))
+
+@router.post("/conversation/{conversation_id}/branches/{branch_id}/activate", response_model=BranchesResponse)
+async def activate_conversation_branch(
+    conversation_id: str,
+    branch_id: int,
+    current_user: User = Depends(get_current_user)
+) -> BranchesResponse:
+    """切换对话的当前分支
+    
+    Args:
+        conversation_id: 对话ID
+        branch_id: 分支ID，0为主分支
+        current_user: 当前用户
+        
+    Returns:
+        BranchesResponse: 切换后的分支列表
+        
+    Raises:
+        HTTPException: 对话或分支不存在时抛出404错误，并发修改时抛出409错误
+    """
+    conversation = await _get_user_conversation(conversation_id, current_user)
+    try:
+        conversation = await Conversation.switch_branch(conversation.id, branch_id)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return _branches_response(conversation)
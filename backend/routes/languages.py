@@ -1,6 +1,6 @@
 from datetime import datetime
 from typing import List
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Request, Response
 from beanie import PydanticObjectId
 
 from models.language import Language
@@ -9,32 +9,39 @@ from schemas.language import (
     LanguageResponse
 )
 from utils.auth import get_current_user
+from utils.http_cache import check_etag
+from utils.lean import lean_response
+from services.catalog import catalog
 
 router = APIRouter()
 
 @router.get("/languages", response_model=List[LanguageResponse])
 async def get_languages(
+    request: Request,
+    response: Response,
     current_user = Depends(get_current_user)
 ):
     """获取所有语言
     
     Args:
+        request: 请求对象，用于条件请求
+        response: 响应对象，用于设置ETag
         current_user: 当前登录用户
         
     Returns:
         List[LanguageResponse]: 语言列表
     """
-    languages = await Language.find_all().to_list()
-    
-    return [
-        LanguageResponse(
-            id=str(language.id),
-            language=language.language,
-            created_at=language.created_at,
-            updated_at=language.updated_at
-        )
-        for language in languages
-    ]
+    collection = await catalog.get(Language)
+    not_modified = check_etag(request, response, collection.etag)
+    if not_modified:
+        return not_modified
+    
+    # 同一快照的响应只序列化一次
+    body = collection.encode("list", lambda: [
+        {"id": str(language.id), "language": language.language, "created_at": language.created_at}
+        for language in collection.documents
+    ])
+    return lean_response(body, response)
 
 @router.post("/languages", response_model=LanguageResponse)
 async def create_language(
@@ -63,6 +70,7 @@ async def create_language(
         updated_at=now
     )
     await language.insert()
+    catalog.invalidate(Language)
     
     return LanguageResponse(
         id=str(language.id),
@@ -74,24 +82,28 @@ async def create_language(
 @router.get("/languages/{language_id}", response_model=LanguageResponse)
 async def get_language(
     language_id: str,
+    request: Request,
+    response: Response,
     current_user = Depends(get_current_user)
 ):
     """获取单个语言
     
     Args:
         language_id: 语言ID
+        request: 请求对象，用于条件请求
+        response: 响应对象，用于设置ETag
         current_user: 当前登录用户
         
     Returns:
         LanguageResponse: 语言详情
     """
-    try:
-        language = await Language.get(PydanticObjectId(language_id))
-    except:
-        raise HTTPException(status_code=404, detail="Language not found")
-    
+    collection = await catalog.get(Language)
+    language = collection.get(language_id)
     if not language:
         raise HTTPException(status_code=404, detail="Language not found")
+    not_modified = check_etag(request, response, collection.etag)
+    if not_modified:
+        return not_modified
     
     return LanguageResponse(
         id=str(language.id),
@@ -133,6 +145,7 @@ async def update_language(
     language.language = language_data.language
     language.updated_at = datetime.utcnow()
     await language.save()
+    catalog.invalidate(Language)
     
     return LanguageResponse(
         id=str(language.id),
@@ -160,4 +173,6 @@ async def delete_language(
     if not language:
         raise HTTPException(status_code=404, detail="Language not found")
     
-    await language.delete() 
\ No newline at end of file
+    await language.delete()
+    catalog.invalidate(Language)
+ 
\ No newline at end of file
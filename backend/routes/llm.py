@@ -1,21 +1,38 @@
+import logging
 from typing import Optional, Dict, Any, AsyncGenerator, Literal
 from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
-from models.llm import LLM
-from models.prompt_template import PromptTemplate
+from models.llm import LLM, LLMType
 from config.settings import settings
 from utils.auth import get_current_user
 from utils.image import save_download_file, get_image_url
 from routes.ai import T2ISubmitRequest, submit_t2i_task
+from services.upstream import upstream_manager
+from services.llm_router import llm_router
+from services.usage import usage_aggregator
+from services.rate_limiter import RateLimitTimeout, estimate_tokens, rate_limiter
+from services.prompt_layout import prefix_cache_stats
+from services.prompt_templates import compile_template, prompt_templates
+from utils.streaming import prefetch_first
 import httpx
 import json
 import asyncio
 import base64
 import traceback
+import math
+from contextlib import suppress
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/llm", tags=["llm"])
 
+# 故事背景图片提示词生成的输入
+BACKGROUND_IMAGE_PROMPT_TEMPLATE = compile_template(
+    "art style: {style_keyword}\n{background_description}\n{task}",
+    "background_image_prompt"
+)
+
 class ChatMessage(BaseModel):
     """OpenAI格式的聊天消息"""
     role: Literal["system", "user", "assistant", "function"] = Field(
@@ -69,7 +86,8 @@ class GenerateBackgroundResponse(BaseModel):
 async def _stream_chat_completion(
     url: str,
     headers: Dict[str, str],
-    json_data: Dict[str, Any]
+    json_data: Dict[str, Any],
+    llm_id: Optional[str] = None
 ) -> AsyncGenerator[str, None]:
     """流式返回chat completion结果
     
@@ -77,16 +95,21 @@ async def _stream_chat_completion(
         url: API URL
         headers: 请求头
         json_data: 请求数据
+        llm_id: 模型ID，用于记录上游的限流余量和使用量
     """
     async with httpx.AsyncClient() as client:
         try:
             async with client.stream('POST', url, headers=headers, json=json_data, timeout=60.0) as response:
+                if llm_id:
+                    llm_router.observe_headers(llm_id, response.headers)
                 if response.status_code != 200:
                     error_detail = await response.aread()
                     raise HTTPException(
                         status_code=response.status_code,
                         detail=f"LLM API error: {error_detail.decode()}"
                     )
+                if llm_id:
+                    usage_aggregator.record_llm(llm_id)
                 
                 async for line in response.aiter_lines():
                     if line.strip():
@@ -94,6 +117,10 @@ async def _stream_chat_completion(
                             line = line[6:]  # 移除'data: '前缀
                         if line.strip() == '[DONE]':
                             break
+                        # 最后一个片段可能带有token用量
+                        if llm_id and '"usage"' in line:
+                            with suppress(ValueError):
+                                usage_aggregator.record_tokens(llm_id, json.loads(line).get("usage"))
                         try:
                             yield line + '\n'
                         except Exception as e:
@@ -104,36 +131,16 @@ async def _stream_chat_completion(
         except (httpx.TimeoutException, httpx.RequestError) as e:
             raise HTTPException(status_code=500, detail=f"Stream request error: {str(e)}")
 
-async def _update_usage(llm: LLM):
-    """更新模型使用次数"""
-    try:
-        await llm.increment_usage()
-    except Exception as e:
-        print(f"Error updating usage count: {str(e)}")
-
-@router.post("/chat/completions")
-async def chat_completion(
-    request: ChatCompletionRequest,
-    background_tasks: BackgroundTasks,
-    current_user = Depends(get_current_user)
-) -> Any:
-    """Chat completion接口
+def _build_completion_request(llm: LLM, request: ChatCompletionRequest) -> tuple[str, Dict[str, str], Dict[str, Any]]:
+    """使用指定模型的配置构建上游请求
     
     Args:
+        llm: LLM模型
         request: 请求数据
-        background_tasks: 后台任务
-        current_user: 当前用户
         
     Returns:
-        如果stream=True，返回StreamingResponse
-        否则返回完整的响应数据
+        tuple: (API URL, 请求头, 请求数据)
     """
-    # 获取LLM模型配置
-    llm = await LLM.find_one({"llm_id": request.model_id})
-    if not llm:
-        raise HTTPException(status_code=404, detail="LLM model not found")
-    
-    # 构建请求数据
     json_data = {
         "model": llm.settings.model,
         "messages": [msg.dict(exclude_none=True) for msg in request.messages],
@@ -154,40 +161,115 @@ async def chat_completion(
     }
     
     url = f"{llm.settings.base_url}/chat/completions"
+    return url, headers, json_data
+
+async def _post_chat_completion(llm: LLM, request: ChatCompletionRequest) -> Dict[str, Any]:
+    """使用指定模型一次性请求chat completion
+    
+    Args:
+        llm: LLM模型
+        request: 请求数据
+        
+    Returns:
+        Dict[str, Any]: 上游返回的响应数据
+        
+    Raises:
+        HTTPException: 上游返回非200状态码时
+    """
+    url, headers, json_data = _build_completion_request(llm, request)
+    async with httpx.AsyncClient() as client:
+        response = await client.post(
+            url,
+            headers=headers,
+            json=json_data,
+            timeout=60.0
+        )
+        llm_router.observe_headers(llm.llm_id, response.headers)
+        
+        if response.status_code != 200:
+            raise HTTPException(
+                status_code=response.status_code,
+                detail=f"LLM API error: {response.text}"
+            )
+        
+        return response.json()
+
+@router.post("/chat/completions")
+async def chat_completion(
+    request: ChatCompletionRequest,
+    background_tasks: BackgroundTasks,
+    current_user = Depends(get_current_user)
+) -> Any:
+    """Chat completion接口
+    
+    优先使用请求指定的模型，该模型熔断或失败时切换到同类型的其他模型
+    
+    Args:
+        request: 请求数据
+        background_tasks: 后台任务
+        current_user: 当前用户
+        
+    Returns:
+        如果stream=True，返回StreamingResponse
+        否则返回完整的响应数据
+    """
+    # 获取LLM模型配置
+    llm = await LLM.find_one({"llm_id": request.model_id})
+    if not llm:
+        raise HTTPException(status_code=404, detail="LLM model not found")
+    
+    prompt_tokens = estimate_tokens("".join(msg.content for msg in request.messages))
     
     try:
         if request.stream:
-            # 流式返回
-            background_tasks.add_task(_update_usage, llm)
-            return StreamingResponse(
-                _stream_chat_completion(url, headers, json_data),
-                media_type="text/event-stream"
+            # 流式返回，输出第一行之前的失败会切换模型重试，使用量在流中记录
+            stream = await prefetch_first(
+                upstream_manager.stream(
+                    llm.type,
+                    lambda candidate: _stream_chat_completion(
+                        *_build_completion_request(candidate, request), llm_id=candidate.llm_id
+                    ),
+                    preferred=llm,
+                    prompt_tokens=prompt_tokens
+                )
             )
+            return StreamingResponse(stream, media_type="text/event-stream")
         else:
             # 一次性返回
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    url,
-                    headers=headers,
-                    json=json_data,
-                    timeout=60.0
-                )
-                
-                if response.status_code != 200:
-                    raise HTTPException(
-                        status_code=response.status_code,
-                        detail=f"LLM API error: {response.text}"
-                    )
-                
-                # 更新使用次数
-                background_tasks.add_task(_update_usage, llm)
-                
-                return response.json()
+            used_llm, result = await upstream_manager.call(
+                llm.type,
+                lambda candidate: _post_chat_completion(candidate, request),
+                preferred=llm,
+                prompt_tokens=prompt_tokens
+            )
+            
+            # 记录实际使用模型的使用次数和token数
+            usage_aggregator.record_llm(used_llm.llm_id, result.get("usage"))
+            
+            return result
                 
+    except RateLimitTimeout as e:
+        raise HTTPException(
+            status_code=429,
+            detail=str(e),
+            headers={"Retry-After": str(math.ceil(e.retry_after))}
+        )
     except httpx.TimeoutException:
         raise HTTPException(status_code=504, detail="Request timeout")
     except httpx.RequestError as e:
-        raise HTTPException(status_code=500, detail=f"Request error: {str(e)}") 
+        raise HTTPException(status_code=500, detail=f"Request error: {str(e)}")
+
+@router.get("/upstream/stats")
+async def get_upstream_stats(
+    current_user = Depends(get_current_user)
+) -> dict:
+    """获取各上游模型的熔断器状态、路由负载、限流排队和前缀缓存命中统计"""
+    return {
+        "breakers": upstream_manager.stats(),
+        "router": llm_router.stats(),
+        "limiter": rate_limiter.stats(),
+        "prompt_cache": prefix_cache_stats.stats(),
+    }
 
 @router.post("/generate/story-background-image", response_model=GenerateBackgroundResponse)
 async def generate_story_background_image(
@@ -207,17 +289,21 @@ async def generate_story_background_image(
     """
     try:
         # 1. 获取用于构建提示词的LLM模型
-        prompt_llm = await LLM.find_one({"type": "other", "status": "active"})
+        prompt_llm = await llm_router.pick(LLMType.OTHER)
         if not prompt_llm:
             raise HTTPException(status_code=404, detail="No active prompt generation model found")
 
         # 2. 获取背景图片生成的提示词模板
-        prompt_template = await PromptTemplate.find_one({"type": "t2i_background"})
+        prompt_template = await prompt_templates.prompt_template("t2i_background")
         if not prompt_template:
             raise HTTPException(status_code=404, detail="No active background prompt template found")
 
         # 3. 构建并获取图片生成提示词
-        prompt_input = f"art style: {request.style_keyword}\n{request.background_description}\n{prompt_template.content}"
+        prompt_input = BACKGROUND_IMAGE_PROMPT_TEMPLATE.render(
+            style_keyword=request.style_keyword,
+            background_description=request.background_description,
+            task=prompt_template.source
+        )
         chat_request = ChatCompletionRequest(
             model_id=prompt_llm.llm_id,
             messages=[{
@@ -233,7 +319,7 @@ async def generate_story_background_image(
         t2i_prompt = prompt_response["choices"][0]["message"]["content"]
 
         # 4. 获取可用的T2I模型
-        t2i_model = await LLM.find_one({"type": "t2i", "status": "active"})
+        t2i_model = await llm_router.pick(LLMType.T2I)
         if not t2i_model:
             raise HTTPException(status_code=404, detail="No active T2I model found")
 
@@ -270,7 +356,7 @@ async def generate_story_background_image(
 
     except Exception as e:
         error_detail = f"Error generating image: {str(e)}\n\nTraceback:\n{traceback.format_exc()}"
-        print(error_detail)  # 打印错误到服务器日志
+        logger.exception("Error generating image")
         raise HTTPException(
             status_code=500,
             detail=error_detail
@@ -1,11 +1,13 @@
 from typing import Optional, List
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Query, Request, Response
 from pydantic import BaseModel
+from bson import ObjectId
 from datetime import datetime
 
 from models.music import Music
 from models.user import User
 from utils.auth import get_current_user
+from utils.http_cache import check_etag, make_etag
 
 router = APIRouter()
 
@@ -33,45 +35,85 @@ class MusicResponse(BaseModel):
     class Config:
         from_attributes = True
 
+async def _music_etag(request: Request, response: Response) -> Optional[Response]:
+    """按音乐集合版本和查询参数设置ETag，未变化时返回304响应"""
+    count, updated_at = await Music.get_version()
+    etag = make_etag("music", count, updated_at, request.url.path, request.url.query)
+    return check_etag(request, response, etag)
+
 @router.get("/music", response_model=dict)
-async def get_music_list(type: Optional[str] = None):
+async def get_music_list(
+    request: Request,
+    response: Response,
+    type: Optional[str] = None,
+    cursor: Optional[str] = Query(None, description="上一页返回的next_cursor"),
+    limit: int = Query(100, ge=1, le=500, description="每页数量")
+):
     """获取音乐列表
     
     Args:
+        request: 请求对象，用于条件请求
+        response: 响应对象，用于设置ETag
         type: 可选的音乐类型过滤
+        cursor: 上一页返回的next_cursor，为空时从第一条开始
+        limit: 每页数量
         
     Returns:
-        包含音乐列表的字典
+        包含音乐总数、本页音乐列表和下一页cursor的字典
     """
-    if type:
-        music_list = await Music.get_music_by_type(type)
-    else:
-        music_list = await Music.get_all_music()
+    if cursor and not ObjectId.is_valid(cursor):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    not_modified = await _music_etag(request, response)
+    if not_modified:
+        return not_modified
     
+    music_list, next_cursor = await Music.get_music_page(type=type, cursor=cursor, limit=limit)
     return {
-        "total": len(music_list),
-        "items": music_list
+        "total": await Music.count_music(type),
+        "items": music_list,
+        "next_cursor": next_cursor
     }
 
 @router.get("/music/types", response_model=dict)
-async def get_music_types():
+async def get_music_types(request: Request, response: Response):
     """获取所有音乐类型
     
+    Args:
+        request: 请求对象，用于条件请求
+        response: 响应对象，用于设置ETag
+    
     Returns:
         包含音乐类型列表的字典
     """
-    # 从数据库中获取所有音乐
-    music_list = await Music.get_all_music()
-    # 提取所有不重复的类型
-    types = list(set(music.type for music in music_list))
-    return {"types": sorted(types)}
+    not_modified = await _music_etag(request, response)
+    if not_modified:
+        return not_modified
+    return {"types": await Music.get_types()}
+
+@router.get("/music/facets", response_model=dict)
+async def get_music_facets(request: Request, response: Response):
+    """获取每种音乐类型的数量
+    
+    Args:
+        request: 请求对象，用于条件请求
+        response: 响应对象，用于设置ETag
+    
+    Returns:
+        包含各类型音乐数量的字典
+    """
+    not_modified = await _music_etag(request, response)
+    if not_modified:
+        return not_modified
+    return {"types": await Music.get_type_facets()}
 
 @router.get("/music/{music_id}", response_model=MusicResponse)
-async def get_music_detail(music_id: str):
+async def get_music_detail(music_id: str, request: Request, response: Response):
     """获取音乐详情
     
     Args:
         music_id: 音乐ID
+        request: 请求对象，用于条件请求
+        response: 响应对象，用于设置ETag
         
     Returns:
         音乐详情
@@ -82,6 +124,9 @@ async def get_music_detail(music_id: str):
     music = await Music.get(music_id)
     if not music:
         raise HTTPException(status_code=404, detail="Music not found")
+    not_modified = check_etag(request, response, make_etag("music", music.id, music.updated_at))
+    if not_modified:
+        return not_modified
     return music
 
 @router.post("/music", response_model=MusicResponse, status_code=201)
@@ -98,11 +143,12 @@ async def create_music(
     Returns:
         创建的音乐详情
     """
-    return await Music.create_music(
+    created = await Music.create_music(
         name=music.name,
         url=music.url,
         type=music.type
     )
+    return created
 
 @router.put("/music/{music_id}", response_model=MusicResponse)
 async def update_music(
@@ -155,4 +201,5 @@ async def delete_music(
     if not music:
         raise HTTPException(status_code=404, detail="Music not found")
     
-    await music.delete() 
\ No newline at end of file
+    await music.delete()
+ 
\ No newline at end of file
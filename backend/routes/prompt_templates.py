@@ -1,26 +1,36 @@
 from typing import List
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
 from models.prompt_template import PromptTemplate
 from schemas.prompt_template import PromptTemplateResponse
 from utils.auth import get_current_user
+from utils.http_cache import check_etag
+from services.catalog import catalog
 
 router = APIRouter()
 
 @router.get("/prompt-templates/{type}", response_model=List[PromptTemplateResponse])
 async def get_prompt_templates_by_type(
     type: str,
+    request: Request,
+    response: Response,
     current_user = Depends(get_current_user)
 ):
     """获取指定类型的提示词模板
     
     Args:
         type: 模板类型
+        request: 请求对象，用于条件请求
+        response: 响应对象，用于设置ETag
         current_user: 当前登录用户
         
     Returns:
         List[PromptTemplateResponse]: 提示词模板列表
     """
-    templates = await PromptTemplate.find({"type": type}).to_list()
+    collection = await catalog.get(PromptTemplate)
+    not_modified = check_etag(request, response, collection.etag)
+    if not_modified:
+        return not_modified
+    templates = collection.find(type=type)
     
     return [
         PromptTemplateResponse(
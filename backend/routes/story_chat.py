@@ -3,23 +3,42 @@ from fastapi import APIRouter, HTTPException, Depends, Security, Query
 from fastapi.responses import StreamingResponse, JSONResponse
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from beanie import PydanticObjectId
+from bson import ObjectId
 from models.story import Story
 from models.character import Character
-from models.conversation import Conversation
-from models.conversation_message import ConversationMessage, MessageRole
+from models.conversation import ARCHIVED_STATUSES, ROOT_BRANCH, Conversation, ConversationBranch, branch_message_filter
+from models.conversation_message import ConversationMessage, MessageRole, message_request_id
 from models.chat import HistoryMessage
 from services.chat import ChatService
+from services.turn import TurnService
+from services.speculation import speculation_manager
+from services.summarizer import conversation_summarizer
+from services.message_buffer import message_buffer
+from services.archiver import conversation_archiver
+from services.prompt_layout import story_context
 from utils.auth import get_current_user
+from utils.lean import dumps, lean_response
+from utils.sse import SSE_HEADERS, sse_frame, sse_text
 from models.user import User
 from pydantic import BaseModel, Field
 from typing import Dict
-import json
+import itertools
 from datetime import datetime
 from pydantic import validator
 
 
 router = APIRouter(prefix="/story_chat", tags=["story_chat"])
 
+# 历史消息接口读取的字段
+HISTORY_MESSAGE_PROJECTION = {
+    "role": 1,
+    "content": 1,
+    "character_name": 1,
+    "sequence": 1,
+    "created_at": 1,
+    "token_count": 1
+}
+
 # 创建安全依赖
 oauth2_scheme = HTTPBearer()
 
@@ -30,6 +49,7 @@ class SelectSpeakersRequest(BaseModel):
     user_message: str  # 用户消息
     history_messages: List[HistoryMessage]  # 历史消息列表
     character_names: List[str]  # 可选的角色名称列表
+    conversation_id: Optional[str] = None  # 对话ID，提供时使用对话的剧情摘要
 
     class Config:
         json_schema_extra = {
@@ -59,11 +79,13 @@ class SelectSpeakersRequest(BaseModel):
 class SelectSpeakersResponse(BaseModel):
     """选择说话角色响应模型"""
     speakers: List[str]  # 说话角色名称列表
+    strategy: Optional[str] = None  # 做出决策的策略：mention/single_candidate/follow_up/llm/round_robin
 
     class Config:
         json_schema_extra = {
             "example": {
-                "speakers": ["小静", "旁白"]
+                "speakers": ["小静", "旁白"],
+                "strategy": "llm"
             }
         }
 
@@ -75,8 +97,9 @@ class GenerateResponseRequest(BaseModel):
     user_message: str  # 用户消息
     history_messages: List[HistoryMessage]  # 历史消息列表
     conversation_id: str  # 对话ID
-    last_message_id: str  # 最后一条消息的ID
+    last_message_id: Optional[str] = None  # 最后一条消息的ID（已不用于计算序号，保留兼容）
     is_first_response: bool = Field(default=False)  # 是否是第一个回复角色
+    request_id: Optional[str] = None  # 客户端请求ID，重试时使用相同的ID避免重复写入消息
 
     class Config:
         json_schema_extra = {
@@ -106,6 +129,33 @@ class GenerateResponseRequest(BaseModel):
         }
 
 
+class GenerateTurnRequest(BaseModel):
+    """生成完整对话轮次请求模型"""
+    history_length: int = Field(default=25, ge=1)  # 历史消息长度限制
+    user_message: str  # 用户消息
+    history_messages: List[HistoryMessage]  # 历史消息列表
+    conversation_id: str  # 对话ID
+    last_message_id: Optional[str] = None  # 最后一条消息的ID（已不用于计算序号，保留兼容）
+    request_id: Optional[str] = None  # 客户端请求ID，重试时使用相同的ID避免重复写入消息
+    speculative: bool = Field(default=False)  # 是否在选择角色的同时推测生成第一个角色的回复
+    concurrent: bool = Field(default=False)  # 是否同时生成所有角色的回复（按顺序输出）
+    pipelined: bool = Field(default=False)  # 并行模式下后面的角色是否参考之前角色的回复
+
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "history_length": 25,
+                "user_message": "小惠，你最近在忙些什么呢？",
+                "history_messages": [],
+                "conversation_id": "1234567890",
+                "last_message_id": "0987654321",
+                "speculative": True,
+                "concurrent": True,
+                "pipelined": False
+            }
+        }
+
+
 class ErrorResponse(BaseModel):
     """错误响应模型"""
     detail: str  # 错误详情
@@ -123,15 +173,20 @@ class ErrorResponse(BaseModel):
 class GetHistoryMessagesRequest(BaseModel):
     """获取历史消息的请求模型"""
     conversation_id: str
-    last_message_time: datetime = Field(
-        default_factory=datetime.utcnow,
-        description="ISO格式的UTC时间字符串，例如：2024-01-21T17:34:40.312Z"
+    before_sequence: Optional[int] = Field(
+        default=None,
+        description="只返回序号小于该值的消息，为空时返回最新的消息；向前翻页时传入上一页第一条消息的sequence"
+    )
+    limit: int = Field(default=25, ge=1, le=200, description="返回的消息数量上限")
+    last_message_time: Optional[datetime] = Field(
+        default=None,
+        description="（兼容旧客户端）只返回不晚于该时间的消息，ISO格式的UTC时间字符串，例如：2024-01-21T17:34:40.312Z"
     )
 
     @validator('last_message_time')
     def ensure_naive_utc(cls, v):
         """确保时间是UTC naive datetime"""
-        if v.tzinfo is not None:
+        if v is not None and v.tzinfo is not None:
             # 如果有时区信息，转换为UTC naive datetime
             return v.replace(tzinfo=None)
         return v
@@ -172,16 +227,26 @@ async def select_speakers(
         # 验证用户身份
         await get_current_user(auth)
         
+        # 提供对话ID时，以剧情摘要代替已合并的历史消息
+        history_messages = request.history_messages
+        summary = None
+        if request.conversation_id:
+            conversation = await Conversation.get(request.conversation_id)
+            if conversation:
+                history_messages = conversation_summarizer.unsummarized(conversation, history_messages)
+                summary = conversation.current_context
+
         # 选择说话角色
         chat_service = ChatService()
-        speakers = await chat_service.select_next_speakers(
+        decision = await chat_service.select_next_speakers_decision(
             history_length=request.history_length,
-            history_messages=request.history_messages,
+            history_messages=history_messages,
             user_message=request.user_message,
-            character_names=request.character_names
+            character_names=request.character_names,
+            summary=summary
         )
         
-        return SelectSpeakersResponse(speakers=speakers)
+        return SelectSpeakersResponse(speakers=decision.speakers, strategy=decision.strategy)
         
     except Exception as e:
         # 获取错误栈信息
@@ -237,35 +302,30 @@ async def generate_response(
         conversation = await Conversation.get(request.conversation_id)
         if not conversation:
             raise HTTPException(status_code=404, detail="Conversation not found")
+        await conversation_archiver.ensure_hot(conversation)
 
-        # 获取last_message_id对应的消息，以获取其sequence
-        last_message = await ConversationMessage.get(PydanticObjectId(request.last_message_id))
-        if not last_message:
-            raise HTTPException(status_code=404, detail="Last message not found")
-        
-        # 根据is_first_response决定sequence的计算方式
-        if request.is_first_response:
-            # 第一个回复角色，需要保存用户消息
-            user_sequence = last_message.sequence + 1
-            # 创建用户消息
-            user_message = ConversationMessage(
-                conversation=conversation,
-                content=request.user_message,
-                role=MessageRole.USER,
-                sequence=user_sequence
+        # 同一请求重试时，已经写入的消息不再重复写入
+        user_request_id = message_request_id(request.request_id, "user")
+        character_request_id = message_request_id(request.request_id, request.character_id)
+        written = {}
+        if request.request_id:
+            written = await ConversationMessage.resume_request_messages(conversation.id, request.request_id)
+        if character_request_id in written:
+            # 回复已经保存，直接返回保存的内容
+            return StreamingResponse(
+                iter([sse_text(written[character_request_id].content)]),
+                media_type="text/event-stream",
+                headers=SSE_HEADERS
             )
-            await user_message.create()
-            # 角色消息的sequence在用户消息之后
-            character_sequence = user_sequence + 1
-        else:
-            # 不是第一个回复角色，不保存用户消息
-            # 角色消息的sequence直接在上一条消息之后
-            character_sequence = last_message.sequence + 1
-
-        # 获取关联的故事
-        story = await conversation.story.fetch()
-        if not story:
-            raise HTTPException(status_code=404, detail="Story not found")
+        
+        # 第一个回复角色需要保存用户消息，一次预留用户消息和角色消息的序号
+        save_user_message = request.is_first_response and user_request_id not in written
+        first_sequence = await Conversation.allocate_sequences(conversation.id, 2 if save_user_message else 1)
+        character_sequence = first_sequence + 1 if save_user_message else first_sequence
+
+        # 获取关联的故事及其角色
+        story = await _get_story(conversation)
+        story_characters = await _get_story_characters(story)
 
         # 获取角色信息
         character = await Character.get(PydanticObjectId(request.character_id))
@@ -278,28 +338,48 @@ async def generate_response(
         chat_service = ChatService()
         
         async def generate():
+            # 用户消息和角色回复在流结束时一起写入，生成过程中定期写入已生成的内容
+            buffer = message_buffer.open(conversation.id)
+            if save_user_message:
+                buffer.add(ConversationMessage(
+                    conversation=conversation,
+                    content=request.user_message,
+                    role=MessageRole.USER,
+                    sequence=first_sequence,
+                    branch_id=conversation.active_branch,
+                    request_id=user_request_id
+                ))
+            character_message = buffer.start(ConversationMessage(
+                conversation=conversation,  # 使用conversation对象
+                role=MessageRole.CHARACTER if character.name != "Narrator" else MessageRole.NARRATOR,
+                content="",
+                character_name=character.name,  # 总是设置角色名称
+                character=character,  # 添加角色引用
+                sequence=character_sequence,  # 使用预留的sequence
+                branch_id=conversation.active_branch,
+                request_id=character_request_id
+            ))
             full_response = ""  # 用于累积完整的响应
             try:
                 async for chunk in chat_service.generate_character_response(
                     character_name=character.name,
                     character_system_prompt=character.system_prompt,
                     history_length=request.history_length,
-                    history_messages=request.history_messages,
-                    user_message=request.user_message
+                    history_messages=conversation_summarizer.unsummarized(conversation, request.history_messages),
+                    user_message=request.user_message,
+                    summary=conversation.current_context,
+                    story_context=story_context(story, story_characters.values())
                 ):
                     full_response += chunk
-                    yield f"data: {chunk}\n\n"
+                    buffer.update(character_message, full_response)
+                    yield sse_text(chunk)
                     
-                # 生成完成后，保存角色回复
-                character_message = ConversationMessage(
-                    conversation=conversation,  # 使用conversation对象
-                    role=MessageRole.CHARACTER if character.name != "Narrator" else MessageRole.NARRATOR,
-                    content=full_response,
-                    character_name=character.name,  # 总是设置角色名称
-                    character=character,  # 添加角色引用
-                    sequence=character_sequence  # 使用计算好的sequence
-                )
-                await character_message.create()
+                # 生成完成后，保存用户消息和角色回复
+                buffer.finish(character_message, full_response)
+                await buffer.flush()
+
+                # 后台把滑出历史窗口的消息合并到剧情摘要中
+                conversation_summarizer.schedule(conversation.id, chat_service.history_start)
                 
             except Exception as e:
                 # 获取错误栈信息
@@ -311,17 +391,17 @@ async def generate_response(
                     detail=str(e),
                     traceback=error_stack
                 )
-                yield f"data: ERROR: {error_response.json()}\n\n"
+                yield sse_text(f"ERROR: {dumps(error_response.dict()).decode()}")
+            finally:
+                # 出错或客户端断开时保存已生成的部分，没有开始生成的回复不保存
+                if not character_message.content:
+                    buffer.discard(character_message)
+                await buffer.close()
                 
         return StreamingResponse(
             generate(),
             media_type="text/event-stream",
-            headers={
-                "Cache-Control": "no-cache",
-                "Connection": "keep-alive",
-                "Content-Type": "text/event-stream",
-                "X-Accel-Buffering": "no"  # 禁用nginx缓冲
-            }
+            headers=SSE_HEADERS
         )
         
     except HTTPException as e:
@@ -339,11 +419,203 @@ async def generate_response(
             traceback=error_stack
         )
         return StreamingResponse(
-            iter([f"ERROR: {error_response.json()}"]),
+            iter([b"ERROR: " + dumps(error_response.dict())]),
             media_type="text/event-stream"
         ) 
 
 
+async def _get_story(conversation: Conversation) -> Story:
+    """获取对话所属的故事"""
+    story = await conversation.story.fetch()
+    if not story:
+        raise HTTPException(status_code=404, detail="Story not found")
+    return story
+
+
+async def _get_story_characters(story: Story) -> Dict[str, Character]:
+    """获取故事的角色，以角色名称为键"""
+    character_ids = [link.ref.id for link in story.characters]
+    characters = await Character.find({"_id": {"$in": character_ids}}).to_list()
+    return {character.name: character for character in characters}
+
+
+def _sse_event(frame_id: int, payload: dict) -> bytes:
+    """构建SSE数据帧，事件类型与payload中的type一致"""
+    return sse_frame(payload, event=payload["type"], id=frame_id)
+
+
+@router.post(
+    "/turn",
+    responses={
+        200: {
+            "description": "成功生成本轮所有角色回复（流式响应）",
+            "content": {
+                "text/event-stream": {
+                    "example": 'id: 1\nevent: speakers\ndata: {"type":"speakers","speakers":["小惠"],"strategy":"mention"}\n\n'
+                               'id: 2\nevent: chunk\ndata: {"type":"chunk","speaker":"小惠","content":"最近在"}\n\n'
+                               'id: 3\nevent: end\ndata: {"type":"end","speaker":"小惠"}\n\n'
+                               'id: 4\nevent: done\ndata: {"type":"done"}\n\n'
+                }
+            }
+        },
+        404: {
+            "description": "对话或消息不存在",
+            "model": Dict[str, str]
+        }
+    }
+)
+async def generate_turn(
+    request: GenerateTurnRequest,
+    current_user: User = Depends(get_current_user)
+):
+    """生成完整的对话轮次
+
+    在一个流中完成说话角色选择和所有角色回复，并保存用户消息和角色回复
+    """
+    conversation = await Conversation.get(request.conversation_id)
+    if not conversation:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    await conversation_archiver.ensure_hot(conversation)
+
+    written = {}
+    if request.request_id:
+        written = await ConversationMessage.resume_request_messages(conversation.id, request.request_id)
+    user_request_id = message_request_id(request.request_id, "user")
+    user_written = written.get(user_request_id)
+
+    story = await _get_story(conversation)
+    characters = await _get_story_characters(story)
+
+    # 之前的请求已经选定说话角色时，按原计划补全缺少的回复；位置从0开始
+    planned = user_written.turn_speakers if user_written else None
+    if planned is not None and any(name not in characters for name in planned):
+        planned = None
+    completed = {}
+    for index, name in enumerate(planned or []):
+        message = written.get(message_request_id(request.request_id, index + 1))
+        if message:
+            completed[index] = message.content
+    turn_service = TurnService(
+        summary=conversation.current_context,
+        story_context=story_context(story, characters.values())
+    )
+
+    async def replay():
+        """同一请求重试且角色回复已经保存时，按保存的内容重放本轮"""
+        frame_ids = itertools.count(1)
+        replies = [message for key, message in written.items() if key != user_request_id]
+        yield _sse_event(next(frame_ids), {"type": "speakers", "speakers": [m.character_name for m in replies], "strategy": "replay"})
+        for message in replies:
+            yield _sse_event(next(frame_ids), {"type": "chunk", "speaker": message.character_name, "content": message.content})
+            yield _sse_event(next(frame_ids), {"type": "end", "speaker": message.character_name})
+        yield _sse_event(next(frame_ids), {"type": "done"})
+
+    async def generate():
+        frame_ids = itertools.count(1)
+        # 用户消息和角色回复在本轮结束时一起写入，生成过程中定期写入已生成的内容
+        buffer = message_buffer.open(conversation.id)
+        save_user_message = user_written is None
+        replies = []  # 按本轮中的位置排列的回复消息，同一角色可能多次说话；已保存的回复为None
+        try:
+            async for event in turn_service.run(
+                history_length=request.history_length,
+                history_messages=conversation_summarizer.unsummarized(conversation, request.history_messages),
+                user_message=request.user_message,
+                characters=characters,
+                speculative=request.speculative,
+                concurrent=request.concurrent,
+                pipelined=request.pipelined,
+                planned=planned,
+                completed=completed
+            ):
+                if event.type == "speakers":
+                    if planned is not None:
+                        # 续写：沿用原来紧跟在用户消息之后预留的序号
+                        sequence = user_written.sequence + 1
+                    else:
+                        # 一次预留用户消息和所有角色回复的序号
+                        count = len(event.speakers) + (1 if save_user_message else 0)
+                        sequence = await Conversation.allocate_sequences(conversation.id, count) if count else 0
+                        if save_user_message:
+                            # 记录本轮说话角色，客户端中断后重试时据此补全缺少的回复
+                            buffer.add(ConversationMessage(
+                                conversation=conversation,
+                                content=request.user_message,
+                                role=MessageRole.USER,
+                                sequence=sequence,
+                                branch_id=conversation.active_branch,
+                                request_id=user_request_id,
+                                turn_speakers=event.speakers
+                            ))
+                            sequence += 1
+                    for index, name in enumerate(event.speakers, 1):
+                        if index - 1 in completed:
+                            replies.append(None)
+                            continue
+                        character = characters[name]
+                        replies.append(buffer.start(ConversationMessage(
+                            conversation=conversation,
+                            role=MessageRole.CHARACTER if character.name != "Narrator" else MessageRole.NARRATOR,
+                            content="",
+                            character_name=character.name,
+                            character=character,
+                            sequence=sequence + index - 1,
+                            branch_id=conversation.active_branch,
+                            request_id=message_request_id(request.request_id, index)  # 回复在本轮中的位置
+                        )))
+                    yield _sse_event(next(frame_ids), {"type": "speakers", "speakers": event.speakers, "strategy": event.strategy})
+                elif event.type == "chunk":
+                    message = replies[event.index]
+                    if message:
+                        buffer.update(message, message.content + event.content)
+                    yield _sse_event(next(frame_ids), {"type": "chunk", "speaker": event.speaker, "content": event.content})
+                elif event.type == "end":
+                    if replies[event.index]:
+                        buffer.finish(replies[event.index], event.content)
+                    yield _sse_event(next(frame_ids), {"type": "end", "speaker": event.speaker})
+
+            # 保存本轮的所有消息
+            await buffer.flush()
+            yield _sse_event(next(frame_ids), {"type": "done"})
+
+            # 后台把滑出历史窗口的消息合并到剧情摘要中
+            conversation_summarizer.schedule(conversation.id, turn_service.chat_service.history_start)
+
+        except Exception as e:
+            import traceback
+            error_response = ErrorResponse(
+                detail=str(e),
+                traceback=traceback.format_exc()
+            )
+            yield _sse_event(next(frame_ids), {"type": "error", **error_response.dict()})
+        finally:
+            # 出错或客户端断开时保存已生成的部分，没有开始生成的回复不保存
+            for message in replies:
+                if message and message.partial and not message.content:
+                    buffer.discard(message)
+            await buffer.close()
+
+    # 客户端重试时，本轮所有回复都已保存才重放；只保存了部分回复时由 generate 补全缺少的回复。
+    # 没有记录说话角色的旧消息无法得知缺少哪些回复，只重放已保存的部分
+    if planned is not None:
+        replayed = len(completed) == len(planned)
+    else:
+        replayed = any(key != user_request_id for key in written)
+    return StreamingResponse(
+        replay() if replayed else generate(),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS
+    )
+
+
+@router.get("/speculation/stats")
+async def get_speculation_stats(
+    current_user: User = Depends(get_current_user)
+) -> dict:
+    """获取推测式回复生成的预算与命中率统计"""
+    return speculation_manager.stats()
+
+
 @router.post("/history-messages", response_model=List[HistoryMessage])
 async def get_history_messages(
     request: GetHistoryMessagesRequest,
@@ -351,53 +623,55 @@ async def get_history_messages(
 ) -> List[HistoryMessage]:
     """获取历史消息
     
+    沿对话的当前分支按序号倒序读取一页消息，只读取返回的字段
+    
     Args:
-        request: 请求参数，包含对话ID和最后消息时间
+        request: 请求参数，包含对话ID、翻页位置和数量
     
     Returns:
-        List[HistoryMessage]: 历史消息列表
+        List[HistoryMessage]: 历史消息列表，按序号正序
+        
+    Raises:
+        HTTPException: 对话不存在时抛出404错误
     """
-    # 获取对话
-    conversation = await Conversation.get(request.conversation_id)
-    if not conversation:
+    if not ObjectId.is_valid(request.conversation_id):
         raise HTTPException(status_code=404, detail="Conversation not found")
     
-    # 获取故事
-    story = await conversation.story.fetch()
-    
-    # 构建查询条件
-    query = {
-        "conversation.$id": PydanticObjectId(conversation.id),  # 使用$id来查询DBRef引用
-        "created_at": {"$lte": request.last_message_time}  # MongoDB中存储的是naive UTC datetime
-    }
-    
-    print(f"查询历史消息参数: conversation_id={conversation.id}, last_message_time={request.last_message_time}")
-    print(f"查询条件: {query}")
+    # 只读取分支信息和状态，沿当前分支读取消息
+    conversation = await Conversation.get_motor_collection().find_one(
+        {"_id": ObjectId(request.conversation_id)},
+        {"active_branch": 1, "branches": 1, "status": 1}
+    )
+    if not conversation:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    if conversation.get("status") in ARCHIVED_STATUSES:
+        # 已归档的对话先恢复消息
+        await conversation_archiver.rehydrate(conversation["_id"])
     
-    # 获取消息并按时间排序，限制返回条数
-    messages = await ConversationMessage.find(query).sort(-ConversationMessage.created_at).limit(story.history_length).to_list()
+    query = branch_message_filter(
+        conversation["_id"],
+        [ConversationBranch(**branch) for branch in conversation.get("branches", [])],
+        conversation.get("active_branch", ROOT_BRANCH),
+        before=request.before_sequence
+    )
+    if request.last_message_time is not None:
+        query["created_at"] = {"$lte": request.last_message_time}  # MongoDB中存储的是naive UTC datetime
     
-    print(f"查询到消息数量: {len(messages)}")
-    for msg in messages:
-        print(f"消息: id={msg.id}, created_at={msg.created_at}, content={msg.content[:50]}...")
-        # 确保比较的两个时间都是naive datetime
-        msg_time = msg.created_at.replace(tzinfo=None) if msg.created_at.tzinfo else msg.created_at
-        query_time = request.last_message_time.replace(tzinfo=None) if request.last_message_time.tzinfo else request.last_message_time
-        print(f"消息时间比较: message_time={msg_time}, query_time={query_time}, is_less={msg_time <= query_time}")
+    messages = await ConversationMessage.get_motor_collection().find(
+        query, HISTORY_MESSAGE_PROJECTION
+    ).sort("sequence", -1).limit(request.limit).to_list(length=request.limit)
     
-    # 返回消息时按时间正序
+    # 返回消息时按序号正序
     messages.reverse()
-    
-    # 转换消息格式
-    formatted_messages = []
-    for msg in messages:
-        formatted_messages.append({
-            "id": str(msg.id),  # 将ObjectId转换为字符串
-            "role": msg.role,
-            "content": msg.content,
-            "character_name": msg.character_name,
-            "sequence": msg.sequence,
-            "created_at": msg.created_at.isoformat()  # 将datetime转换为ISO格式字符串
-        })
-    
-    return formatted_messages 
\ No newline at end of file
+    return lean_response([
+        {
+            "id": str(msg["_id"]),
+            "role": msg["role"],
+            "content": msg["content"],
+            "character_name": msg.get("character_name"),
+            "sequence": msg["sequence"],
+            "created_at": msg["created_at"].isoformat(),
+            "token_count": msg.get("token_count")
+        }
+        for msg in messages
+    ])
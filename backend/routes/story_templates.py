@@ -4,6 +4,7 @@ from datetime import datetime
 from models.story_template import StoryTemplate
 from config.mongodb import get_database
 from bson import ObjectId
+from utils.lean import find_lean, lean_response
 
 router = APIRouter()
 
@@ -17,8 +18,15 @@ async def get_story_templates(
     if status:
         query["status"] = status
 
-    templates = await db.story_templates.find(query).to_list(length=None)
-    return [StoryTemplate.from_mongo(template) for template in templates]
+    # 原始文档直接序列化，不逐个构建和校验模板文档
+    templates = await find_lean(
+        StoryTemplate,
+        db.story_templates,
+        query,
+        exclude=("revision_id",),
+        id_key="_id"
+    )
+    return lean_response(templates)
 
 @router.get("/story-templates/{template_id}", response_model=StoryTemplate)
 async def get_story_template(template_id: str):
@@ -0,0 +1,28 @@
+from typing import Any, Dict
+from fastapi import APIRouter, Depends, Query
+from models.user import User
+from utils.auth import get_current_user
+from utils.tracing import tracer
+
+router = APIRouter(prefix="", tags=["traces"])
+
+
+@router.get("/traces")
+async def get_recent_traces(
+    limit: int = Query(20, ge=1, le=200, description="最多返回的链路数"),
+    min_duration_ms: float = Query(0, ge=0, description="只返回总耗时不低于该值的链路"),
+    current_user: User = Depends(get_current_user)
+) -> Dict[str, Any]:
+    """获取本进程最近完成的请求链路，最新的在前"""
+    return {
+        "stats": tracer.stats(),
+        "traces": tracer.recent(limit, min_duration_ms)
+    }
+
+
+@router.get("/traces/stages")
+async def get_trace_stages(
+    current_user: User = Depends(get_current_user)
+) -> Dict[str, Dict[str, float]]:
+    """获取本进程缓冲中各阶段耗时的分位数，按p99从高到低排列"""
+    return tracer.stages()
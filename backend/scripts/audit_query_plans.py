@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""查询计划审计
+
+对高频查询的形状执行 explain()，检查查询是否使用了索引：
+- 获胜计划中出现 COLLSCAN（全集合扫描）的查询视为失败，脚本以非0状态退出，可在CI中运行
+- 需要内存排序（SORT 阶段）的查询只给出警告
+- 链接字段（DBRef）上直接建立的索引无法被 "xxx.$id" 查询使用，作为过期索引列出，
+  加 --drop-stale 时删除
+
+脚本先通过 init_beanie 创建模型声明的索引，查询条件中的ID等取值是占位值，
+空数据库中也能得到与线上一致的查询计划。
+
+新增高频查询时在 QUERY_SHAPES 中登记对应的查询形状。
+
+用法：python scripts/audit_query_plans.py [--drop-stale]
+"""
+import argparse
+import asyncio
+import sys
+from dataclasses import dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Type
+
+# 添加backend目录到Python路径
+BACKEND_DIR = Path(__file__).parent.parent
+sys.path.insert(0, str(BACKEND_DIR))
+
+from beanie import Document, init_beanie
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from config.settings import settings
+from models.conversation import Conversation
+from models.conversation_archive import ConversationArchive
+from models.conversation_message import ConversationMessage
+from models.music import Music
+from models.story import Story
+
+# 占位取值
+CONVERSATION_ID = ObjectId()
+STORY_ID = ObjectId()
+USER_ID = str(ObjectId())
+WALLET = "0x0000000000000000000000000000000000000001"
+
+# 链接字段，直接建在这些字段上的索引不能被 "字段.$id" 查询使用
+LINK_FIELDS = {
+    "conversation_messages": {"conversation", "character"},
+    "conversations": {"story"},
+    "stories": {"characters", "background_music"},
+}
+
+
+@dataclass
+class QueryShape:
+    """一个需要走索引的查询形状"""
+    model: Type[Document]
+    name: str  # 查询所在的位置
+    filter: Dict[str, Any]
+    sort: Optional[List[Tuple[str, int]]] = None
+    limit: int = 0
+    projection: Optional[Dict[str, int]] = None
+
+
+@dataclass
+class AuditResult:
+    shape: QueryShape
+    stages: List[str] = field(default_factory=list)
+    indexes: List[str] = field(default_factory=list)
+
+    @property
+    def collscan(self) -> bool:
+        return "COLLSCAN" in self.stages
+
+    @property
+    def in_memory_sort(self) -> bool:
+        return "SORT" in self.stages
+
+
+QUERY_SHAPES = [
+    # 对话消息
+    QueryShape(
+        ConversationMessage, "story_chat.get_history_messages",
+        {"conversation.$id": CONVERSATION_ID, "sequence": {"$lt": 100}},
+        sort=[("sequence", -1)], limit=25,
+        projection={"role": 1, "content": 1, "sequence": 1, "created_at": 1}
+    ),
+    QueryShape(
+        ConversationMessage, "story_chat.get_history_messages(branch)",
+        {"conversation.$id": CONVERSATION_ID, "$or": [
+            {"branch_id": 2, "sequence": {"$gt": 12, "$lte": 99}},
+            {"branch_id": 1, "sequence": {"$gt": 4, "$lte": 12}},
+            {"branch_id": {"$in": [0, None]}, "sequence": {"$lte": 4}}
+        ]},
+        sort=[("sequence", -1)], limit=25
+    ),
+    QueryShape(
+        ConversationMessage, "story_chat.get_history_messages(last_message_time)",
+        {"conversation.$id": CONVERSATION_ID, "created_at": {"$lte": datetime.utcnow()}},
+        sort=[("sequence", -1)], limit=25
+    ),
+    QueryShape(
+        ConversationMessage, "ConversationMessage.get_conversation_messages",
+        {"conversation.$id": CONVERSATION_ID},
+        sort=[("sequence", 1)], limit=20
+    ),
+    QueryShape(
+        ConversationMessage, "ConversationMessage.insert_once",
+        {"conversation.$id": CONVERSATION_ID, "request_id": "request:user"}
+    ),
+    QueryShape(
+        ConversationMessage, "ConversationMessage.resume_request_messages",
+        {"conversation.$id": CONVERSATION_ID, "request_id": {"$type": "string", "$regex": "^request:"}},
+        sort=[("sequence", 1)]
+    ),
+    QueryShape(
+        ConversationMessage, "Conversation.sync_last_sequence",
+        {"conversation.$id": CONVERSATION_ID},
+        sort=[("sequence", -1)], limit=1
+    ),
+    QueryShape(
+        ConversationMessage, "summarizer.recent_window",
+        {"conversation.$id": CONVERSATION_ID, "sequence": {"$gt": 0}},
+        sort=[("sequence", -1)], limit=25
+    ),
+    QueryShape(
+        ConversationMessage, "summarizer.batch",
+        {"conversation.$id": CONVERSATION_ID, "sequence": {"$gt": 0, "$lt": 50}},
+        sort=[("sequence", 1)], limit=40
+    ),
+    QueryShape(
+        ConversationMessage, "branch_gc._delete_messages",
+        {"conversation.$id": CONVERSATION_ID, "branch_id": {"$in": [1, 2]}},
+        limit=500, projection={"_id": 1}
+    ),
+    # 对话
+    QueryShape(
+        Conversation, "branch_gc.collect",
+        {"branch_gc_at": {"$lte": datetime.utcnow()}, "status": "active"}, limit=100
+    ),
+    QueryShape(
+        Conversation, "conversation.check_story_conversation",
+        {"story.$id": STORY_ID, "user_id": USER_ID, "status": {"$in": ["active", "archiving", "archived"]}},
+        sort=[("created_at", -1)], limit=1
+    ),
+    QueryShape(
+        Conversation, "archiver.archive_idle",
+        {"status": "active", "updated_at": {"$lt": datetime.utcnow()}}, limit=20, projection={"_id": 1}
+    ),
+    QueryShape(
+        Conversation, "story_feed.started_story_ids",
+        {"user_id": USER_ID}, projection={"story": 1}
+    ),
+    # 故事
+    QueryShape(
+        Story, "story_feed.find_feed_stories",
+        {"_id": {"$nin": [STORY_ID]}}, sort=[("_id", 1)], limit=10
+    ),
+    QueryShape(
+        Story, "story.created_by",
+        {"created_by": WALLET}
+    ),
+    # 消息归档
+    QueryShape(
+        ConversationArchive, "archiver.rehydrate",
+        {"conversation_id": CONVERSATION_ID}, sort=[("chunk", 1)]
+    ),
+    # 背景音乐
+    QueryShape(
+        Music, "Music.get_music_page",
+        {"type": "bgm", "_id": {"$gt": ObjectId("000000000000000000000000")}},
+        sort=[("_id", 1)], limit=101
+    ),
+]
+
+
+def _plan_nodes(node: Any) -> Iterator[Dict[str, Any]]:
+    """遍历查询计划中的所有阶段"""
+    if isinstance(node, dict):
+        if "stage" in node:
+            yield node
+        for value in node.values():
+            yield from _plan_nodes(value)
+    elif isinstance(node, list):
+        for value in node:
+            yield from _plan_nodes(value)
+
+
+async def explain(shape: QueryShape) -> AuditResult:
+    """执行 explain() 并取出获胜计划的各个阶段"""
+    cursor = shape.model.get_motor_collection().find(shape.filter, shape.projection)
+    if shape.sort:
+        cursor = cursor.sort(shape.sort)
+    if shape.limit:
+        cursor = cursor.limit(shape.limit)
+    plan = await cursor.explain()
+    winning = plan["queryPlanner"]["winningPlan"]
+    # 新版本的执行引擎把计划放在 queryPlan 中
+    winning = winning.get("queryPlan", winning)
+    result = AuditResult(shape)
+    for node in _plan_nodes(winning):
+        result.stages.append(node["stage"])
+        if node.get("indexName"):
+            result.indexes.append(node["indexName"])
+    return result
+
+
+async def find_stale_indexes(db) -> List[Tuple[str, str]]:
+    """直接建在链接字段上的索引"""
+    stale = []
+    for collection, link_fields in LINK_FIELDS.items():
+        indexes = await db[collection].index_information()
+        for name, info in indexes.items():
+            if any(key in link_fields for key, _ in info["key"]):
+                stale.append((collection, name))
+    return stale
+
+
+async def main(drop_stale: bool) -> int:
+    client = AsyncIOMotorClient(settings.MONGODB_URL)
+    db = client[settings.MONGODB_DB]
+    try:
+        # 创建模型声明的索引
+        await init_beanie(database=db, document_models=[ConversationMessage, Conversation, ConversationArchive, Story, Music])
+
+        print("\n=== 查询计划审计 ===\n")
+        failures = 0
+        for shape in QUERY_SHAPES:
+            result = await explain(shape)
+            collection = shape.model.get_settings().name
+            if result.collscan:
+                failures += 1
+                status = "FAIL"
+            elif result.in_memory_sort:
+                status = "WARN"
+            else:
+                status = "OK  "
+            print(f"[{status}] {collection:<22} {shape.name}")
+            print(f"       {' <- '.join(result.stages)}  索引: {', '.join(result.indexes) or '无'}")
+
+        stale = await find_stale_indexes(db)
+        if stale:
+            print("\n建在链接字段上的索引（查询使用 \"字段.$id\"，这些索引不会被使用，只增加写入开销）：")
+            for collection, name in stale:
+                print(f"  {collection}.{name}")
+                if drop_stale:
+                    await db[collection].drop_index(name)
+                    print("    已删除")
+
+        print(f"\n共 {len(QUERY_SHAPES)} 个查询形状，{failures} 个全集合扫描")
+        return 1 if failures else 0
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="查询计划审计")
+    parser.add_argument("--drop-stale", action="store_true", help="删除建在链接字段上的过期索引")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main(args.drop_stale)))
@@ -0,0 +1,129 @@
+"""序列化开销基准测试
+
+比较故事列表一页和流式片段在原有路径与新路径下的序列化耗时：
+- 故事列表：Pydantic响应模型 + jsonable_encoder + json.dumps（FastAPI默认路径）
+  对比 原始字典 + utils.lean.dumps（安装了orjson时使用orjson）
+- 流式片段：f-string 构建的字符串帧（json.dumps）对比 utils.sse 的字节帧
+
+用法：python scripts/benchmark_serialization.py [--page-size 10] [--chunks 2000] [--repeat 200]
+不需要连接数据库。
+"""
+import argparse
+import json
+import sys
+import timeit
+from datetime import datetime
+from pathlib import Path
+
+# 将backend目录添加到Python路径
+backend_dir = Path(__file__).resolve().parent.parent
+sys.path.append(str(backend_dir))
+
+from bson import ObjectId
+from fastapi.encoders import jsonable_encoder
+
+from services.story_feed import GetStoriesResponse
+from utils.lean import dumps, orjson
+from utils.sse import sse_frame, sse_text
+
+
+def build_feed_page(page_size: int) -> list:
+    """构建一页与 /story/get_unstarted_stories 结构相同的列表项"""
+    items = []
+    for i in range(page_size):
+        details = [
+            {
+                "id": str(ObjectId()),
+                "name": "Narrator" if j == 0 else f"角色{j}",
+                "description": "一位在雪山脚下经营旅店的老板，热情好客，知道很多关于山中的传说。" * 2,
+                "image_url": f"https://cdn.example.com/characters/{i}-{j}.png",
+                "icon_url": f"https://cdn.example.com/characters/{i}-{j}-icon.png",
+                "character_type": "narrator" if j == 0 else "character"
+            }
+            for j in range(4)
+        ]
+        items.append({
+            "id": str(ObjectId()),
+            "title": f"雪山旅店的第{i}个夜晚",
+            "intro": "暴风雪封住了下山的路，旅店里的每个人似乎都藏着秘密。" * 8,
+            "messages": [{"content": "欢迎来到雪山旅店。" * 3, "character_id": details[1]["id"]}],
+            "likes": "128",
+            "rewards": "16",
+            "background": f"https://cdn.example.com/backgrounds/{i}.png",
+            "date": datetime.utcnow().strftime("%Y-%m-%d"),
+            "characters": 3,
+            "avatar_url": details[1]["image_url"],
+            "characterIcons": [detail["icon_url"] for detail in details[1:]],
+            "characterDetails": details,
+            "backgroundMusic": "https://cdn.example.com/music/snow.mp3",
+            "created_by": "0x" + "ab" * 20,
+            "creator_name": "snowfox",
+            "comments_count": "7"
+        })
+    return items
+
+
+def feed_default(items: list) -> bytes:
+    """原有路径：构建响应模型后由FastAPI默认编码"""
+    models = [GetStoriesResponse(**item) for item in items]
+    return json.dumps(jsonable_encoder(models), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def feed_lean(items: list) -> bytes:
+    """新路径：原始字典直接序列化"""
+    return dumps(items)
+
+
+def stream_default(chunks: list) -> list:
+    """原有路径：字符串帧，由StreamingResponse逐个编码"""
+    frames = [f"data: {chunk}\n\n".encode("utf-8") for chunk in chunks]
+    frames += [
+        f"data: {json.dumps({'type': 'chunk', 'speaker': '小惠', 'content': chunk}, ensure_ascii=False)}\n\n".encode("utf-8")
+        for chunk in chunks
+    ]
+    return frames
+
+
+def stream_bytes(chunks: list) -> list:
+    """新路径：预编码的字节帧"""
+    frames = [sse_text(chunk) for chunk in chunks]
+    frames += [
+        sse_frame({"type": "chunk", "speaker": "小惠", "content": chunk}, event="chunk", id=i)
+        for i, chunk in enumerate(chunks, 1)
+    ]
+    return frames
+
+
+def measure(label: str, fn, arg, repeat: int, per: int, unit: str) -> float:
+    """多次运行取最好的一轮，返回每个单位的微秒数"""
+    best = min(timeit.repeat(lambda: fn(arg), number=repeat, repeat=5)) / repeat
+    per_unit = best / per * 1e6
+    print(f"  {label:<32} {per_unit:>10.2f} us/{unit}")
+    return per_unit
+
+
+def main():
+    parser = argparse.ArgumentParser(description="序列化开销基准测试")
+    parser.add_argument("--page-size", type=int, default=10, help="每页故事数量")
+    parser.add_argument("--chunks", type=int, default=2000, help="流式片段数量")
+    parser.add_argument("--repeat", type=int, default=200, help="每轮重复次数")
+    args = parser.parse_args()
+
+    print(f"\n=== 序列化基准测试（JSON后端：{'orjson ' + orjson.__version__ if orjson else '标准库json'}）===\n")
+
+    items = build_feed_page(args.page_size)
+    print(f"故事列表（每页{args.page_size}个，{len(feed_lean(items))}字节）：")
+    before = measure("响应模型 + jsonable_encoder", feed_default, items, args.repeat, 1, "page")
+    after = measure("原始字典 + lean.dumps", feed_lean, items, args.repeat, 1, "page")
+    print(f"  加速 {before / after:.1f}x\n")
+
+    chunks = [f"片段{i}：雪越下越大了，" for i in range(args.chunks)]
+    repeat = max(1, args.repeat // 20)
+    print(f"流式片段（{args.chunks}个纯文本帧 + {args.chunks}个JSON帧）：")
+    before = measure("字符串帧 + json.dumps", stream_default, chunks, repeat, args.chunks * 2, "chunk")
+    after = measure("字节帧 + sse_frame", stream_bytes, chunks, repeat, args.chunks * 2, "chunk")
+    print(f"  加速 {before / after:.1f}x\n")
+
+
+if __name__ == "__main__":
+    main()
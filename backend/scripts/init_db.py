@@ -402,6 +402,22 @@ async def init_other_agents():
         ).insert()
         print("创建对话选择器")
 
+    # 创建对话摘要生成器
+    summarizer = await OtherAgent.find_one({"agent_id": "conversation_summarizer"})
+    if not summarizer:
+        await OtherAgent(
+            agent_id="conversation_summarizer",
+            name="conversation_summarizer",
+            description="用于把超出历史窗口的对话合并到剧情摘要中",
+            system_prompt=read_system_prompt("conversation_summarizer.txt"),
+            settings={
+                "model": "deepseek-chat",
+                "temperature": 0.3,
+                "max_tokens": 600
+            }
+        ).insert()
+        print("创建对话摘要生成器")
+
 
 async def init_prompt_templates():
     """初始化提示词模板数据"""
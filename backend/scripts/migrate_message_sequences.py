@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""迁移对话消息序号
+
+消息序号改为由 Conversation.last_sequence 原子分配，并增加了 (conversation, sequence) 唯一索引。
+在部署新版本之前运行一次：
+- 存在重复或缺失序号的对话按 (sequence, created_at) 顺序重新编号为 1..n
+- 所有对话的 last_sequence 设置为消息的最大序号
+
+用法：python scripts/migrate_message_sequences.py [--dry-run]
+"""
+import argparse
+import asyncio
+import sys
+from collections import defaultdict
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Tuple
+
+# 添加backend目录到Python路径
+BACKEND_DIR = Path(__file__).parent.parent
+sys.path.insert(0, str(BACKEND_DIR))
+
+from bson import DBRef
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+
+from config.settings import settings
+
+
+def conversation_key(message: Dict[str, Any]) -> Any:
+    """消息所属对话的ID
+
+    conversation 字段以 DBRef 保存，聚合管道中字段路径不能以 $ 开头（无法使用 "$conversation.$id"），
+    因此在 Python 中读取
+    """
+    conversation = message.get("conversation")
+    return conversation.id if isinstance(conversation, DBRef) else conversation
+
+
+def plan_migration(messages: Iterable[Dict[str, Any]]) -> Tuple[List[UpdateOne], Dict[Any, int], int]:
+    """根据所有消息计算需要执行的更新
+
+    存在重复或缺失序号的对话按 (sequence, created_at, _id) 顺序重新编号为 1..n
+
+    Args:
+        messages: 包含 _id、conversation、sequence、created_at 字段的消息
+
+    Returns:
+        Tuple: (消息序号的更新操作, 每个对话的最大序号, 重新编号的对话数量)
+    """
+    conversations: Dict[Any, List[Dict[str, Any]]] = defaultdict(list)
+    for message in messages:
+        conversations[conversation_key(message)].append(message)
+
+    updates: List[UpdateOne] = []
+    last_sequences: Dict[Any, int] = {}
+    renumbered = 0
+    for conversation_id, items in conversations.items():
+        sequences = [item.get("sequence") for item in items]
+        if None not in sequences and len(set(sequences)) == len(sequences):
+            last_sequences[conversation_id] = max(sequences)
+            continue
+
+        renumbered += 1
+        print(f"对话 {conversation_id}：{len(items)} 条消息存在重复或缺失的序号，重新编号")
+        items.sort(key=lambda item: (
+            item.get("sequence") is not None,  # 缺失序号的消息排在最前
+            item.get("sequence") or 0,
+            item.get("created_at") or datetime.min,
+            item["_id"]
+        ))
+        for sequence, item in enumerate(items, 1):
+            if item.get("sequence") != sequence:
+                updates.append(UpdateOne({"_id": item["_id"]}, {"$set": {"sequence": sequence}}))
+        last_sequences[conversation_id] = len(items)
+    return updates, last_sequences, renumbered
+
+
+async def migrate(db, dry_run: bool) -> Tuple[int, int]:
+    """重新编号消息序号并同步对话的 last_sequence
+
+    Returns:
+        Tuple[int, int]: (重新编号的对话数量, 更新 last_sequence 的对话数量)
+    """
+    messages = await db.conversation_messages.find(
+        {}, {"conversation": 1, "sequence": 1, "created_at": 1}
+    ).to_list(length=None)
+    updates, last_sequences, renumbered = plan_migration(messages)
+    if dry_run:
+        return renumbered, len(last_sequences)
+
+    if updates:
+        await db.conversation_messages.bulk_write(updates, ordered=False)
+    synced = 0
+    if last_sequences:
+        result = await db.conversations.bulk_write([
+            UpdateOne({"_id": conversation_id}, {"$set": {"last_sequence": last_sequence}})
+            for conversation_id, last_sequence in last_sequences.items()
+            if conversation_id is not None
+        ], ordered=False)
+        synced = result.modified_count
+    return renumbered, synced
+
+
+async def main(dry_run: bool):
+    client = AsyncIOMotorClient(settings.MONGODB_URL)
+    db = client[settings.MONGODB_DB]
+    try:
+        renumbered, synced = await migrate(db, dry_run)
+        print(f"\n重新编号 {renumbered} 个对话，更新 {synced} 个对话的 last_sequence{'（dry run，未写入）' if dry_run else ''}")
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="迁移对话消息序号")
+    parser.add_argument("--dry-run", action="store_true", help="只检查，不写入")
+    args = parser.parse_args()
+    asyncio.run(main(args.dry_run))
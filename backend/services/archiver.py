@@ -0,0 +1,270 @@
+"""闲置对话消息的归档
+
+超过 ARCHIVE_IDLE_DAYS 天没有更新的对话，其消息由后台任务移出 conversation_messages，
+按序号分块压缩后写入 conversation_archives，对话状态标记为 archived。
+热集合和索引只保留近期使用的对话。
+
+对话被访问时通过 ensure_hot() 恢复消息并标记为 active，调用方不需要关心消息是否被归档。
+
+归档步骤：对话标记为 archiving -> 写入归档 -> 删除热集合中的消息 -> 标记为 archived。
+归档期间对话被访问时，访问方从已写入的归档恢复并标记为 active，归档任务发现状态变化后
+用内存中的消息补回被删除的部分，不会丢失消息。恢复时按 _id 插入并忽略重复，可以重复执行。
+"""
+import asyncio
+import logging
+from contextlib import suppress
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from bson import json_util
+from pymongo.errors import BulkWriteError
+
+from config.settings import settings
+from models.conversation import ARCHIVED_STATUSES, Conversation
+from models.conversation_archive import ConversationArchive
+from models.conversation_message import ConversationMessage
+from utils.compression import compress, decompress
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+def _encode(messages: List[Dict[str, Any]]) -> bytes:
+    """消息编码为JSON行"""
+    return "\n".join(
+        json_util.dumps(message, json_options=json_util.RELAXED_JSON_OPTIONS, ensure_ascii=False)
+        for message in messages
+    ).encode("utf-8")
+
+
+def _decode(data: bytes) -> List[Dict[str, Any]]:
+    """JSON行解码为消息"""
+    return [json_util.loads(line) for line in data.decode("utf-8").splitlines() if line]
+
+
+async def _insert_messages(messages: List[Dict[str, Any]]) -> int:
+    """按 _id 插入消息，已存在的消息跳过
+
+    Returns:
+        int: 插入的消息数量
+    """
+    if not messages:
+        return 0
+    try:
+        result = await ConversationMessage.get_motor_collection().insert_many(messages, ordered=False)
+        return len(result.inserted_ids)
+    except BulkWriteError as e:
+        if any(error.get("code") != DUPLICATE_KEY_ERROR for error in e.details.get("writeErrors", [])):
+            raise
+        return e.details.get("nInserted", 0)
+
+
+class ConversationArchiver:
+    """对话消息的归档和恢复"""
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+        self._locks: Dict[Any, asyncio.Lock] = {}
+        self.archived_conversations = 0
+        self.archived_messages = 0
+        self.rehydrated_conversations = 0
+        self.rehydrated_messages = 0
+        self.archived_bytes = 0
+        self.raw_bytes = 0
+
+    async def archive_idle(self) -> int:
+        """归档一批闲置的对话
+
+        Returns:
+            int: 完成归档的对话数量
+        """
+        cutoff = datetime.utcnow() - timedelta(days=settings.ARCHIVE_IDLE_DAYS)
+        conversations = await Conversation.get_motor_collection().find(
+            {"status": "active", "updated_at": {"$lt": cutoff}}, {"_id": 1}
+        ).limit(settings.ARCHIVE_BATCH).to_list(length=settings.ARCHIVE_BATCH)
+        archived = 0
+        for conversation in conversations:
+            try:
+                archived += await self.archive(conversation["_id"], cutoff)
+            except Exception as e:
+                logger.error("Failed to archive conversation %s: %s", conversation["_id"], e)
+        return archived
+
+    async def archive(self, conversation_id: Any, idle_before: datetime) -> bool:
+        """归档一个对话的消息
+
+        Args:
+            conversation_id: 对话ID
+            idle_before: 对话最后更新时间早于该时间时才归档
+
+        Returns:
+            bool: 是否完成归档
+        """
+        conversations = Conversation.get_motor_collection()
+        claimed = await conversations.update_one(
+            {"_id": conversation_id, "status": "active", "updated_at": {"$lt": idle_before}},
+            {"$set": {"status": "archiving"}}
+        )
+        if not claimed.modified_count:
+            return False
+
+        messages = []
+        try:
+            messages = await ConversationMessage.get_motor_collection().find(
+                {"conversation.$id": conversation_id}
+            ).sort("sequence", 1).to_list(length=None)
+            await self._write_chunks(conversation_id, messages)
+            await self._delete_messages([message["_id"] for message in messages])
+            finished = await conversations.update_one(
+                {"_id": conversation_id, "status": "archiving"},
+                {"$set": {"status": "archived"}}
+            )
+        except Exception:
+            await self._abort(conversation_id, messages)
+            raise
+
+        if not finished.modified_count:
+            # 归档期间对话被访问并已恢复，补回被删除的消息
+            await self._abort(conversation_id, messages)
+            return False
+
+        self.archived_conversations += 1
+        self.archived_messages += len(messages)
+        logger.info("Archived conversation %s (%s messages)", conversation_id, len(messages))
+        return True
+
+    async def _write_chunks(self, conversation_id: Any, messages: List[Dict[str, Any]]):
+        """按 ARCHIVE_CHUNK_MESSAGES 分块压缩写入归档"""
+        collection = ConversationArchive.get_motor_collection()
+        size = settings.ARCHIVE_CHUNK_MESSAGES
+        for chunk, start in enumerate(range(0, len(messages), size)):
+            batch = messages[start:start + size]
+            raw = _encode(batch)
+            codec, data = compress(raw)
+            await collection.replace_one(
+                {"conversation_id": conversation_id, "chunk": chunk},
+                {
+                    "conversation_id": conversation_id,
+                    "chunk": chunk,
+                    "codec": codec,
+                    "data": data,
+                    "message_count": len(batch),
+                    "first_sequence": batch[0]["sequence"],
+                    "last_sequence": batch[-1]["sequence"],
+                    "raw_size": len(raw),
+                    "created_at": datetime.utcnow()
+                },
+                upsert=True
+            )
+            self.raw_bytes += len(raw)
+            self.archived_bytes += len(data)
+
+    async def _delete_messages(self, message_ids: List[Any]):
+        """分批删除热集合中已归档的消息"""
+        collection = ConversationMessage.get_motor_collection()
+        size = settings.ARCHIVE_CHUNK_MESSAGES
+        for start in range(0, len(message_ids), size):
+            await collection.delete_many({"_id": {"$in": message_ids[start:start + size]}})
+            await asyncio.sleep(0)
+
+    async def _abort(self, conversation_id: Any, messages: List[Dict[str, Any]]):
+        """放弃归档：补回消息，删除归档，恢复为 active"""
+        await _insert_messages(messages)
+        await ConversationArchive.get_motor_collection().delete_many({"conversation_id": conversation_id})
+        await Conversation.get_motor_collection().update_one(
+            {"_id": conversation_id, "status": "archiving"},
+            {"$set": {"status": "active"}}
+        )
+
+    async def rehydrate(self, conversation_id: Any) -> int:
+        """恢复对话的归档消息
+
+        Args:
+            conversation_id: 对话ID
+
+        Returns:
+            int: 恢复的消息数量
+        """
+        lock = self._locks.setdefault(conversation_id, asyncio.Lock())
+        try:
+            async with lock:
+                conversation = await Conversation.get_motor_collection().find_one(
+                    {"_id": conversation_id}, {"status": 1}
+                )
+                if not conversation or conversation.get("status") not in ARCHIVED_STATUSES:
+                    return 0
+
+                archives = ConversationArchive.get_motor_collection()
+                chunks = await archives.find({"conversation_id": conversation_id}).sort("chunk", 1).to_list(length=None)
+                restored = 0
+                for chunk in chunks:
+                    restored += await _insert_messages(_decode(decompress(chunk["codec"], chunk["data"])))
+
+                # 先标记为 active 再删除归档，中途失败时下次访问重新恢复
+                await Conversation.get_motor_collection().update_one(
+                    {"_id": conversation_id, "status": {"$in": list(ARCHIVED_STATUSES)}},
+                    {"$set": {"status": "active", "updated_at": datetime.utcnow()}}
+                )
+                await archives.delete_many({"conversation_id": conversation_id})
+        finally:
+            if not lock.locked():
+                self._locks.pop(conversation_id, None)
+
+        self.rehydrated_conversations += 1
+        self.rehydrated_messages += restored
+        logger.info("Rehydrated conversation %s (%s messages)", conversation_id, restored)
+        return restored
+
+    async def ensure_hot(self, conversation: Conversation) -> Conversation:
+        """访问对话前调用，已归档的对话先恢复消息
+
+        Args:
+            conversation: 对话
+
+        Returns:
+            Conversation: 对话，状态为 active
+        """
+        if conversation.status in ARCHIVED_STATUSES:
+            await self.rehydrate(conversation.id)
+            conversation.status = "active"
+        return conversation
+
+    async def _run(self):
+        """定期归档"""
+        while True:
+            await asyncio.sleep(settings.ARCHIVE_INTERVAL_SECONDS)
+            try:
+                # 一批全部完成归档时继续下一批
+                while await self.archive_idle() >= settings.ARCHIVE_BATCH:
+                    pass
+            except Exception as e:
+                logger.error("Archiving failed: %s", e)
+
+    def start(self):
+        """启动后台归档任务"""
+        if not settings.ARCHIVE_ENABLED:
+            return
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """停止后台归档任务"""
+        if self._task:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "archived_conversations": self.archived_conversations,
+            "archived_messages": self.archived_messages,
+            "rehydrated_conversations": self.rehydrated_conversations,
+            "rehydrated_messages": self.rehydrated_messages,
+            "compression_ratio": round(self.raw_bytes / self.archived_bytes, 2) if self.archived_bytes else None,
+        }
+
+
+# 创建全局实例
+conversation_archiver = ConversationArchiver()
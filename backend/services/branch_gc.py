@@ -0,0 +1,138 @@
+"""对话分支的后台清理
+
+回退和切换分支只移动 Conversation.active_branch，不删除消息。
+离开超过 BRANCH_RETENTION_HOURS 小时、且不是保留分支祖先的分支，由后台任务从对话中移除并分批删除其消息。
+Conversation.branch_gc_at 记录对话下一次需要检查的时间，没有离开的分支时为空。
+"""
+import asyncio
+import logging
+from contextlib import suppress
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Set
+
+from config.settings import settings
+from models.conversation import Conversation, branch_ancestors
+from models.conversation_message import ConversationMessage
+
+logger = logging.getLogger(__name__)
+
+
+class BranchCollector:
+    """不再使用的对话分支的清理任务"""
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+        self.branches = 0
+        self.messages = 0
+
+    async def collect(self) -> int:
+        """清理一批到期的对话
+
+        Returns:
+            int: 检查的对话数量
+        """
+        now = datetime.utcnow()
+        conversations = await Conversation.find(
+            {"branch_gc_at": {"$lte": now}, "status": "active"}  # 已归档的对话恢复后再清理
+        ).limit(settings.BRANCH_GC_BATCH).to_list()
+        for conversation in conversations:
+            try:
+                await self.collect_conversation(conversation, now)
+            except Exception as e:
+                logger.error("Failed to collect branches of conversation %s: %s", conversation.id, e)
+        return len(conversations)
+
+    async def collect_conversation(self, conversation: Conversation, now: datetime) -> int:
+        """清理一个对话中过期的分支
+
+        Args:
+            conversation: 对话
+            now: 当前时间
+
+        Returns:
+            int: 删除的消息数量
+        """
+        retention = timedelta(hours=settings.BRANCH_RETENTION_HOURS)
+        cutoff = now - retention
+
+        # 当前分支和保留期内用过的分支，连同沿 parent 到达的所有祖先分支一起保留
+        # （没有可见消息的祖先也要保留，子分支的分叉位置依赖它们）
+        recent = [branch for branch in conversation.branches if branch.last_active_at >= cutoff]
+        keep: Set[int] = branch_ancestors(conversation.branches, conversation.active_branch)
+        for branch in recent:
+            keep.update(branch_ancestors(conversation.branches, branch.id))
+        expired = [branch.id for branch in conversation.branches if branch.id not in keep]
+
+        # 下一次检查时间：最早离开的保留期内分支到期时
+        leaving = [branch.last_active_at for branch in recent if branch.id != conversation.active_branch]
+        next_gc = min(leaving) + retention if leaving else None
+
+        # 先从对话中移除分支，之后不会再切换到这些分支
+        result = await Conversation.get_motor_collection().update_one(
+            {"_id": conversation.id, **conversation.branch_guard()},
+            {
+                "$pull": {"branches": {"id": {"$in": expired}}},
+                "$set": {"branch_gc_at": next_gc}
+            }
+        )
+        if not result.modified_count or not expired:
+            # 分支被并发修改时留到下一次检查
+            return 0
+
+        deleted = await self._delete_messages(conversation.id, expired)
+        self.branches += len(expired)
+        self.messages += deleted
+        logger.info(
+            "Collected %s branches of conversation %s (%s messages)",
+            len(expired), conversation.id, deleted
+        )
+        return deleted
+
+    async def _delete_messages(self, conversation_id, branch_ids) -> int:
+        """分批删除分支上的消息，每批之间让出事件循环"""
+        collection = ConversationMessage.get_motor_collection()
+        query = {"conversation.$id": conversation_id, "branch_id": {"$in": branch_ids}}
+        deleted = 0
+        while True:
+            batch = await collection.find(query, {"_id": 1}).limit(settings.BRANCH_GC_DELETE_BATCH).to_list(
+                length=settings.BRANCH_GC_DELETE_BATCH
+            )
+            if not batch:
+                return deleted
+            result = await collection.delete_many({"_id": {"$in": [item["_id"] for item in batch]}})
+            deleted += result.deleted_count
+            await asyncio.sleep(0)
+
+    async def _run(self):
+        """定期清理"""
+        while True:
+            await asyncio.sleep(settings.BRANCH_GC_INTERVAL_SECONDS)
+            try:
+                # 一批清理满时继续下一批
+                while await self.collect() >= settings.BRANCH_GC_BATCH:
+                    pass
+            except Exception as e:
+                logger.error("Branch collection failed: %s", e)
+
+    def start(self):
+        """启动后台清理任务"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """停止后台清理任务"""
+        if self._task:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "collected_branches": self.branches,
+            "deleted_messages": self.messages,
+        }
+
+
+# 创建全局实例
+branch_collector = BranchCollector()
@@ -0,0 +1,177 @@
+"""小型目录集合的内存缓存
+
+代理、提示词模板、角色系统提示词补充、艺术风格和语言等集合很小且很少变化，
+启动时整体加载到内存，之后按需读取缓存：
+- 通过本服务的增删改接口修改时立即失效
+- 开启 CATALOG_WATCH_CHANGES 时通过 MongoDB change stream 监听其他副本或脚本的修改（需要副本集）
+- 兜底每 CATALOG_CACHE_SECONDS 秒重新加载一次
+每个集合的 ETag 由全部文档内容计算，各副本加载相同数据时 ETag 相同，可用于条件请求。
+"""
+import asyncio
+import hashlib
+import logging
+import time
+from contextlib import suppress
+from typing import Any, Callable, Dict, Generic, Hashable, List, Optional, Type, TypeVar
+
+from beanie import Document
+
+from config.settings import settings
+from models.art_style import ArtStyle
+from models.character_system_prompt_post import CharacterSystemPromptPost
+from models.language import Language
+from models.other_agent import OtherAgent
+from models.prompt_template import PromptTemplate
+from utils.lean import dumps
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T", bound=Document)
+
+
+class CatalogCollection(Generic[T]):
+    """一个集合的缓存快照，加载后不再修改"""
+
+    def __init__(self, documents: List[T]):
+        self.documents = documents
+        self.loaded_at = time.monotonic()
+        digest = hashlib.sha1()
+        for document in documents:
+            digest.update(document.model_dump_json().encode("utf-8"))
+        self.etag = f'"{digest.hexdigest()[:20]}"'
+        self._by_id = {str(document.id): document for document in documents}
+        self._encoded: Dict[Hashable, bytes] = {}
+
+    def encode(self, key: Hashable, build: Callable[[], Any]) -> bytes:
+        """获取列表响应的JSON字节串，同一快照和同一参数只构建和序列化一次
+
+        Args:
+            key: 响应的参数，如筛选条件
+            build: 构建响应内容的函数
+
+        Returns:
+            bytes: JSON字节串
+        """
+        encoded = self._encoded.get(key)
+        if encoded is None:
+            encoded = self._encoded[key] = dumps(build())
+        return encoded
+
+    def get(self, document_id: str) -> Optional[T]:
+        """按ID获取文档"""
+        return self._by_id.get(str(document_id))
+
+    def find(self, **filters: Any) -> List[T]:
+        """按字段相等条件筛选文档，值为None的条件被忽略"""
+        conditions = {key: value for key, value in filters.items() if value is not None}
+        return [
+            document for document in self.documents
+            if all(getattr(document, key) == value for key, value in conditions.items())
+        ]
+
+    def find_one(self, **filters: Any) -> Optional[T]:
+        """按字段相等条件获取第一个文档"""
+        matches = self.find(**filters)
+        return matches[0] if matches else None
+
+
+class Catalog:
+    """目录缓存"""
+
+    def __init__(self, models: List[Type[Document]]):
+        self.models: Dict[str, Type[Document]] = {model.Settings.name: model for model in models}
+        self._collections: Dict[str, CatalogCollection] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._generations: Dict[str, int] = {}  # 每次失效加一，用于丢弃失效前开始的加载结果
+        self._watchers: List[asyncio.Task] = []
+        self.loads = 0
+        self.invalidations = 0
+
+    async def _load(self, name: str) -> CatalogCollection:
+        generation = self._generations.get(name, 0)
+        documents = await self.models[name].find_all().to_list()
+        collection = CatalogCollection(documents)
+        if self._generations.get(name, 0) == generation:
+            self._collections[name] = collection
+        self.loads += 1
+        return collection
+
+    async def get(self, model: Type[T]) -> CatalogCollection[T]:
+        """获取集合的缓存，未加载、已失效或过期时重新加载
+
+        Args:
+            model: 文档模型
+
+        Returns:
+            CatalogCollection: 集合快照
+        """
+        name = model.Settings.name
+        collection = self._collections.get(name)
+        if collection and time.monotonic() - collection.loaded_at < settings.CATALOG_CACHE_SECONDS:
+            return collection
+        # 同一集合同时只加载一次
+        lock = self._locks.setdefault(name, asyncio.Lock())
+        async with lock:
+            collection = self._collections.get(name)
+            if collection and time.monotonic() - collection.loaded_at < settings.CATALOG_CACHE_SECONDS:
+                return collection
+            return await self._load(name)
+
+    def invalidate(self, model: Type[Document]):
+        """使集合的缓存失效，下次读取时重新加载"""
+        name = model.Settings.name
+        self._collections.pop(name, None)
+        self._generations[name] = self._generations.get(name, 0) + 1
+        self.invalidations += 1
+
+    async def load_all(self):
+        """加载所有集合"""
+        for name in self.models:
+            await self._load(name)
+
+    async def _watch(self, model: Type[Document]):
+        """监听集合的修改，不支持 change stream 时退回定期重新加载"""
+        while True:
+            try:
+                async with model.get_motor_collection().watch() as stream:
+                    async for _ in stream:
+                        self.invalidate(model)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if getattr(e, "code", None) == 40573:  # 非副本集部署
+                    logger.warning("Change streams unavailable, catalog %s uses periodic reload", model.Settings.name)
+                    return
+                logger.warning("Catalog watcher for %s failed: %s", model.Settings.name, e)
+                # 断开期间的修改无法得知，重新加载后再继续监听
+                self.invalidate(model)
+                await asyncio.sleep(5)
+
+    def start(self):
+        """按配置启动 change stream 监听"""
+        if settings.CATALOG_WATCH_CHANGES and not self._watchers:
+            self._watchers = [asyncio.create_task(self._watch(model)) for model in self.models.values()]
+
+    async def stop(self):
+        """停止监听"""
+        for task in self._watchers:
+            task.cancel()
+        for task in self._watchers:
+            with suppress(asyncio.CancelledError):
+                await task
+        self._watchers = []
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "collections": {
+                name: {"documents": len(collection.documents), "etag": collection.etag}
+                for name, collection in self._collections.items()
+            },
+            "loads": self.loads,
+            "invalidations": self.invalidations,
+            "watching": bool(self._watchers),
+        }
+
+
+# 创建全局实例
+catalog = Catalog([OtherAgent, PromptTemplate, CharacterSystemPromptPost, ArtStyle, Language])
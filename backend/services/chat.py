@@ -1,16 +1,43 @@
-from typing import List, Dict, Any, Optional, AsyncGenerator
+import logging
+from typing import List, Dict, Any, Optional, AsyncGenerator, Callable, Tuple
 from datetime import datetime
 import traceback
-import random
-from models.other_agent import OtherAgent
 from models.chat import HistoryMessage
 from models.llm import LLM, LLMType
 from openai import AsyncOpenAI
 from openai.types.chat import ChatCompletionChunk
 from models.conversation_message import MessageRole
+from config.settings import settings
+from services.upstream import upstream_manager
+from services.llm_router import llm_router
+from services.usage import usage_aggregator
+from services.rate_limiter import estimate_tokens
+from services.context import ContextWindow, history_budget, pack_history
+from services.prompt_layout import PromptLayout, prefix_cache_stats
+from services.prompt_templates import prompt_templates
+from utils.tracing import span, start_span
+from utils.metrics import (
+    llm_stream_duration_seconds,
+    llm_stream_tokens_per_second,
+    llm_stream_tokens_total,
+    llm_time_to_first_token_seconds,
+)
+from services.speaker_selection import (
+    SpeakerSelector,
+    SpeakerSelectionContext,
+    SpeakerDecision,
+    MentionStrategy,
+    SingleCandidateStrategy,
+    FollowUpStrategy,
+    LLMStrategy,
+    RoundRobinStrategy,
+)
 import re
+import time
 import asyncio
 
+logger = logging.getLogger(__name__)
+
 
 class ChatService:
     """对话服务
@@ -21,31 +48,24 @@ class ChatService:
     def __init__(self):
         """初始化对话服务"""
         self.max_retries = 3  # 最大重试次数
+        self.speaker_selector = self._build_speaker_selector()
+        # 角色回复提示词中历史窗口的起点，序号更小的消息已滑出窗口，需要合并到摘要中
+        self.history_start: Optional[int] = None
 
-    async def _get_llm_client(self, llm_type: LLMType) -> tuple[AsyncOpenAI, Dict[str, Any]]:
+    def _get_llm_client(self, llm: LLM) -> tuple[AsyncOpenAI, Dict[str, Any]]:
         """获取LLM客户端和配置
         
         Args:
-            llm_type: LLM类型（other或chat）
+            llm: 由 llm_router 选出的LLM模型
             
         Returns:
             tuple: (OpenAI客户端, 模型参数字典)
-            
-        Raises:
-            ValueError: 当找不到可用的LLM模型时
         """
-        # 获取指定类型的所有LLM模型
-        llms = await LLM.find({"type": llm_type}).to_list()
-        if not llms:
-            raise ValueError(f"No available LLM model found for type: {llm_type}")
-        
-        # 随机选择一个模型（简单的负载均衡）
-        llm = random.choice(llms)
-        
-        # 创建OpenAI客户端
+        # 创建OpenAI客户端，重试与切换模型由 upstream_manager 负责
         client = AsyncOpenAI(
             api_key=llm.api_key,
-            base_url=llm.settings.base_url or "https://api.openai.com/v1"
+            base_url=llm.settings.base_url or "https://api.openai.com/v1",
+            max_retries=0
         )
         
         # 构建模型参数
@@ -60,12 +80,72 @@ class ChatService:
         
         return client, model_params
 
+    async def _complete(
+        self,
+        build_prompt: Callable[[LLM], str],
+        purpose: str,
+        prefix_hash: str,
+        prompt_tokens: int
+    ) -> Any:
+        """以单条系统提示词调用辅助模型，重试与切换模型由 upstream_manager 负责
+
+        Args:
+            build_prompt: 根据选出的模型构建提示词的函数
+            purpose: 调用用途，记录在链路追踪中
+            prefix_hash: 提示词模板的前缀哈希，用于统计上游前缀缓存命中
+            prompt_tokens: 预估的输入token数，用于预扣TPM限额
+
+        Returns:
+            模型的完整响应
+        """
+        async def request(llm: LLM):
+            client, model_params = self._get_llm_client(llm)
+            with span("llm.call", llm_id=llm.llm_id, purpose=purpose):
+                raw_response = await client.chat.completions.with_raw_response.create(
+                    messages=[
+                        {"role": "system", "content": build_prompt(llm)}
+                    ],
+                    **model_params
+                )
+            llm_router.observe_headers(llm.llm_id, raw_response.headers)
+            response = raw_response.parse()
+            usage_aggregator.record_llm(llm.llm_id, response.usage)
+            prefix_cache_stats.record(prefix_hash, llm.llm_id, response.usage)
+            return response
+
+        _, response = await upstream_manager.call(LLMType.OTHER, request, prompt_tokens=prompt_tokens)
+        return response
+
+    def _record_history_start(self, window: ContextWindow):
+        """记录角色回复提示词的历史窗口起点，多次生成时取最早的，只有所有提示词都不包含的消息才会被摘要"""
+        if window.start_sequence is None:
+            return
+        if self.history_start is None or window.start_sequence < self.history_start:
+            self.history_start = window.start_sequence
+
+    def _build_speaker_selector(self) -> SpeakerSelector:
+        """构建说话角色选择策略链
+
+        规则快速路径在前，LLM只在无法确定时调用，轮询兜底
+        """
+        strategies = []
+        if settings.SPEAKER_FAST_PATH_ENABLED:
+            strategies.extend([
+                MentionStrategy(),
+                SingleCandidateStrategy(narrator_interval=settings.SPEAKER_NARRATOR_INTERVAL),
+                FollowUpStrategy(max_chars=settings.SPEAKER_FOLLOW_UP_MAX_CHARS),
+            ])
+        strategies.append(LLMStrategy(self._select_speakers_by_llm))
+        strategies.append(RoundRobinStrategy())
+        return SpeakerSelector(strategies=strategies)
+
     async def select_next_speakers(
         self,
         history_length: int,
         history_messages: List[HistoryMessage],
         user_message: str,
-        character_names: List[str]
+        character_names: List[str],
+        summary: Optional[str] = None
     ) -> List[str]:
         """选择下一组说话的角色
         
@@ -74,54 +154,104 @@ class ChatService:
             history_messages: 历史消息列表
             user_message: 用户输入的消息
             character_names: 可选的角色名称列表
+            summary: 历史消息之前的剧情摘要
+            
+        Returns:
+            List[str]: 角色名称列表
+        """
+        decision = await self.select_next_speakers_decision(
+            history_length=history_length,
+            history_messages=history_messages,
+            user_message=user_message,
+            character_names=character_names,
+            summary=summary
+        )
+        return decision.speakers
+
+    async def select_next_speakers_decision(
+        self,
+        history_length: int,
+        history_messages: List[HistoryMessage],
+        user_message: str,
+        character_names: List[str],
+        summary: Optional[str] = None
+    ) -> SpeakerDecision:
+        """选择下一组说话的角色，并返回做出决策的策略
+        
+        Args:
+            history_length: 历史消息长度限制
+            history_messages: 历史消息列表
+            user_message: 用户输入的消息
+            character_names: 可选的角色名称列表
+            summary: 历史消息之前的剧情摘要
+            
+        Returns:
+            SpeakerDecision: 角色名称列表及策略名称
+        """
+        ctx = SpeakerSelectionContext(
+            history_length=history_length,
+            history_messages=history_messages,
+            user_message=user_message,
+            character_names=character_names,
+            summary=summary
+        )
+        with span("speaker_selection"):
+            return await self.speaker_selector.select(ctx)
+
+    async def _select_speakers_by_llm(self, ctx: SpeakerSelectionContext) -> List[str]:
+        """使用LLM选择说话角色
+        
+        Args:
+            ctx: 选择上下文
             
         Returns:
             List[str]: 角色名称列表
             
         Raises:
-            Exception: 当所有重试都失败时抛出异常
+            Exception: 当所有重试都失败时抛出最后一个错误
         """
-        # 获取对话选择器的提示词
-        speaker_selector = await OtherAgent.find_one({"agent_id": "speaker_selector"})
+        # 获取对话选择器的提示词模板
+        speaker_selector = await prompt_templates.other_agent(
+            "speaker_selector", names=("context", "character_names")
+        )
         if not speaker_selector:
             raise ValueError("Speaker selection agent not found")
             
-        # 构建对话历史
-        context = []
-        for msg in history_messages[-history_length:]:
-            if msg.role == MessageRole.USER:
-                context.append(f"User: {msg.content}")
-            elif msg.role == MessageRole.NARRATOR:
-                context.append(f"Narrator: ({msg.content})")
-            else:  # character
-                context.append(f"{msg.character_name}: {msg.content}")
-        
-        # 添加用户最新消息
-        context.append(f"User: {user_message}")
-            
-        # 替换提示词中的变量
-        prompt = speaker_selector.system_prompt.replace(
-            "{context}", "\n".join(context)
-        ).replace(
-            "{character_names}", f"[{', '.join(character_names)}]"
-        )
+        def build_prompt(budget: int) -> str:
+            # 构建对话历史，从最新的消息开始装入token预算
+            window = pack_history(ctx.recent_messages, budget)
+            context = []
+            if ctx.summary:
+                context.append(f"Summary of earlier story: {ctx.summary}")
+            for msg in window.messages:
+                if msg.role == MessageRole.USER:
+                    context.append(f"User: {msg.content}")
+                elif msg.role == MessageRole.NARRATOR:
+                    context.append(f"Narrator: ({msg.content})")
+                else:  # character
+                    context.append(f"{msg.character_name}: {msg.content}")
+
+            # 添加用户最新消息
+            context.append(f"User: {ctx.user_message}")
+
+            # 替换提示词中的变量
+            return speaker_selector.render(
+                context="\n".join(context),
+                character_names=f"[{', '.join(ctx.character_names)}]"
+            )
         
         last_error = None
         for attempt in range(self.max_retries):
+            # 上游错误的重试与切换由 upstream_manager 处理，这里只重试无法解析的结果
+            response = await self._complete(
+                lambda llm: build_prompt(history_budget(llm)),
+                purpose="speaker_selection",
+                prefix_hash=speaker_selector.prefix_hash,
+                prompt_tokens=estimate_tokens(build_prompt(history_budget(None)))
+            )
+            result = response.choices[0].message.content.strip()
+            
             try:
-                # 获取LLM客户端和配置
-                client, model_params = await self._get_llm_client(LLMType.OTHER)
-                
-                # 调用LLM选择说话角色
-                response = await client.chat.completions.create(
-                    messages=[
-                        {"role": "system", "content": prompt}
-                    ],
-                    **model_params
-                )
-                
-                result = response.choices[0].message.content.strip()
-                
                 # 使用正则表达式提取[]中的内容
                 pattern = r'\[(.*?)\]'
                 matches = re.findall(pattern, result)
@@ -132,36 +262,76 @@ class ChatService:
                     selected_names = [name.strip().strip('"\'') for name in matches[0].split(',')]
                     
                     # 验证返回的角色名称是否都在可选列表中
-                    if all(name in character_names for name in selected_names):
+                    if all(name in ctx.character_names for name in selected_names):
                         return selected_names
                     else:
-                        print(f"Available character names: {character_names}")
-                        print(f"Selected names after processing: {selected_names}")
                         raise ValueError(f"Invalid character names in response: {selected_names}")
                 else:
                     raise ValueError(f"No character names found in brackets in response: {result}")
                     
-            except Exception as e:
+            except ValueError as e:
                 last_error = e
-                error_stack = traceback.format_exc()
-                print(f"Attempt {attempt + 1} failed with error:\n{error_stack}")
-                
-                # 如果是最后一次尝试，使用备选方案
-                if attempt == self.max_retries - 1:
-                    print("All attempts failed, using fallback solution")
-                    # 返回 Narrator 作为备选方案
-                    return ["Narrator"]
+                logger.warning("Speaker selection attempt %s failed: %s", attempt + 1, e)
         
-        # 如果所有尝试都失败，抛出最后一个错误
+        # 所有尝试都失败，由策略链的轮询兜底处理
         raise last_error
 
+    async def summarize_messages(
+        self,
+        summary: Optional[str],
+        messages: List[Any]
+    ) -> str:
+        """把新消息合并到剧情摘要中
+        
+        Args:
+            summary: 已有的剧情摘要
+            messages: 按序号排列的需要合并的消息（HistoryMessage 或 ConversationMessage）
+            
+        Returns:
+            str: 新的剧情摘要
+            
+        Raises:
+            ValueError: 摘要生成代理不存在
+        """
+        summarizer = await prompt_templates.other_agent(
+            "conversation_summarizer", names=("summary", "messages", "max_length")
+        )
+        if not summarizer:
+            raise ValueError("Conversation summarizer agent not found")
+        
+        lines = []
+        for msg in messages:
+            if msg.role == MessageRole.USER:
+                lines.append(f"用户：{msg.content}")
+            elif msg.role == MessageRole.NARRATOR:
+                lines.append(f"Narrator：（{msg.content.strip('（）()')}）")
+            else:  # character
+                lines.append(f"{msg.character_name}：{msg.content}")
+        
+        prompt = summarizer.render(
+            summary=summary or "（无）",
+            messages="\n".join(lines),
+            max_length=settings.DEFAULT_SUMMARY_LENGTH
+        )
+        
+        response = await self._complete(
+            lambda llm: prompt,
+            purpose="summary",
+            prefix_hash=summarizer.prefix_hash,
+            prompt_tokens=estimate_tokens(prompt)
+        )
+        return response.choices[0].message.content.strip()
+
     async def generate_character_response(
         self,
         character_name: str,
         character_system_prompt: str,
         history_length: int,
         history_messages: List[HistoryMessage],
-        user_message: str
+        user_message: str,
+        preceding_replies: Optional[List[Tuple[str, str]]] = None,
+        summary: Optional[str] = None,
+        story_context: Optional[str] = None
     ) -> AsyncGenerator[str, None]:
         """生成角色回复
         
@@ -171,97 +341,144 @@ class ChatService:
             history_length: 历史消息长度限制
             history_messages: 历史消息列表
             user_message: 用户输入的消息
+            preceding_replies: 本轮在该角色之前已回复的(角色名称, 内容)列表
+            summary: 历史消息之前的剧情摘要
+            story_context: 故事背景和角色列表，见 prompt_layout.story_context
             
         Yields:
             str: 生成的回复内容片段
             
         Raises:
-            Exception: 当所有重试都失败时抛出异常
+            Exception: 所有可用模型都失败，或输出开始后上游出错时抛出异常
         """
-        # 构建历史对话上下文
-        context_messages = []
-        
-        # 添加历史消息
-        for msg in history_messages[-history_length:]:
-            if msg.role == MessageRole.USER:
-                context_messages.append(f"用户：{msg.content}")
-            elif msg.role == MessageRole.NARRATOR:
-                # 移除已有的括号（如果有的话）
-                content = msg.content.strip('（）()')
-                context_messages.append(f"Narrator：（{content}）")
-            else:  # character
-                context_messages.append(f"{msg.character_name}：{msg.content}")
+        def pack(budget: int) -> ContextWindow:
+            # 在history_length条以内从最新的消息开始装入token预算
+            return pack_history(history_messages, budget, history_length)
+
+        def build_prompt(window: ContextWindow) -> PromptLayout:
+            # 不变的系统块在前，使同一角色的连续请求能命中上游的前缀缓存
+            layout = PromptLayout()
+            layout.add_static(character_system_prompt)
+            layout.add_static(story_context)
+
+            # 剧情摘要和历史消息按时间顺序追加
+            if summary:
+                layout.add_message("user", f"（之前的剧情摘要：{summary}）")
+            for msg in window.messages:
+                if msg.role == MessageRole.USER:
+                    layout.add_message("user", f"用户：{msg.content}")
+                elif msg.role == MessageRole.NARRATOR:
+                    # 移除已有的括号（如果有的话）
+                    content = msg.content.strip('（）()')
+                    layout.add_message("user", f"Narrator：（{content}）")
+                elif msg.character_name == character_name:
+                    layout.add_message("assistant", msg.content)
+                else:  # 其他角色
+                    layout.add_message("user", f"{msg.character_name}：{msg.content}")
+            
+            # 用户最新消息、本轮之前角色的回复和本轮指令放在最后
+            latest = [f"用户：{user_message}"]
+            latest.extend(f"{name}：{content}" for name, content in preceding_replies or [])
+            latest.append(
+                f"\n你就是{character_name}，你直接生成需要说的话就行，要回应用户所说的最新的话（称呼用户应该是“你”或者'You'），不需要输出其他内容，也不需要{character_name}:来开头"
+            )
+            layout.add_message("user", "\n".join(latest))
+            return layout
         
-        # 添加用户最新消息
-        context_messages.append(f"用户：{user_message}")
+        # 整个流记录为一个阶段：首个内容片段的时间、输出token数和每秒token数
+        stream_span = start_span("llm.stream", character=character_name)
+        stream_started = time.perf_counter()
+        stream_llm_id = None
+        completion_tokens = 0
+        content_chunks = 0
+        first_token_ms = None
+
+        async def open_stream(llm: LLM) -> AsyncGenerator[ChatCompletionChunk, None]:
+            nonlocal stream_llm_id, completion_tokens
+            client, model_params = self._get_llm_client(llm)
+            window = pack(history_budget(llm))
+            self._record_history_start(window)
+            layout = build_prompt(window)
+            if settings.LLM_STREAM_INCLUDE_USAGE:
+                # 让上游在最后一个片段中返回token用量（含缓存命中数），openai 1.3 还不支持 stream_options 参数
+                model_params["extra_body"] = {"stream_options": {"include_usage": True}}
+            stream = await client.chat.completions.create(
+                messages=layout.build(),
+                stream=True,
+                **model_params
+            )
+            llm_router.observe_headers(llm.llm_id, stream.response.headers)
+            usage_aggregator.record_llm(llm.llm_id)
+            async for chunk in stream:
+                # 最后一个片段可能带有token用量
+                usage = getattr(chunk, "usage", None)
+                usage_aggregator.record_tokens(llm.llm_id, usage)
+                prefix_cache_stats.record(layout.prefix_hash, llm.llm_id, usage)
+                if usage is not None:
+                    completion_tokens = getattr(usage, "completion_tokens", None) or 0
+                # 对冲时落选的流只产生第一个片段，最后写入的是实际使用的模型
+                stream_llm_id = llm.llm_id
+                yield chunk
         
-        # 将历史对话上下文拼接到character_prompt
-        full_prompt = (
-            f"{character_system_prompt}\n\n"
-            "# 历史对话上下文\n"
-            f"{chr(10).join(context_messages)}\n\n"
-            f"你就是{character_name}，你直接生成需要说的话就行，要回应用户所说的最新的话（称呼用户应该是“你”或者'You'），不需要输出其他内容，也不需要{character_name}:来开头"
-        )
+        # 用于累积完整的回复
+        full_response = ""
         
-        last_error = None
-        for attempt in range(self.max_retries):
-            try:
-                # 获取LLM客户端和配置
-                client, model_params = await self._get_llm_client(LLMType.CHAT)
+        # 流式接收回复，收到第一个片段前的失败由 upstream_manager 切换模型重试
+        error = None
+        try:
+            async for chunk in upstream_manager.stream(
+                LLMType.CHAT, open_stream, prompt_tokens=estimate_tokens(build_prompt(pack(history_budget(None))).text)
+            ):
+                if chunk.choices and chunk.choices[0].delta.content:
+                    content = chunk.choices[0].delta.content
+                    content_chunks += 1
+                    if first_token_ms is None:
+                        first_token_ms = (time.perf_counter() - stream_started) * 1000
+                    full_response += content
                 
-                # 调用LLM生成回复
-                stream = await client.chat.completions.create(
-                    messages=[
-                        {"role": "system", "content": full_prompt}
-                    ],
-                    stream=True,
-                    **model_params
-                )
+                    # 检测语言
+                    is_english = bool(re.search(r'[a-zA-Z]', content))
                 
-                # 用于累积完整的回复
-                full_response = ""
                 
-                # 流式接收回复
-                async for chunk in stream:
-                    if chunk.choices[0].delta.content:
-                        content = chunk.choices[0].delta.content
-                        full_response += content
-                        
-                        # 检测语言
-                        is_english = bool(re.search(r'[a-zA-Z]', content))
-                        
-                        
-                        # 对每个chunk进行处理
-                        # 如果是英文，保留空格，如果是中文，去除空格
-                        # if not is_english:
-                        #     content = re.sub(r'\s+', '', content)
-                        content = re.sub(r'\[[^\]]*\]', '', content)
-                        
-                        # 如果是旁白，且这是第一个chunk，添加开始括号
-                        if character_name == "Narrator" and not full_response.startswith("（"):
-                            content = f"（{content}"
-                            
-                        # 如果是最后一个chunk且是旁白，添加结束括号
-                        if character_name == "Narrator" and chunk.choices[0].finish_reason == "stop":
-                            content = f"{content}）"
-                            
-                        # 发送处理后的chunk
-                        yield content
-                        
-                        # 添加延迟以模拟打字效果
-                        await asyncio.sleep(0.03)
+                    # 对每个chunk进行处理
+                    # 如果是英文，保留空格，如果是中文，去除空格
+                    # if not is_english:
+                    #     content = re.sub(r'\s+', '', content)
+                    content = re.sub(r'\[[^\]]*\]', '', content)
                 
-                # 成功完成后返回
-                return
+                    # 如果是旁白，且这是第一个chunk，添加开始括号
+                    if character_name == "Narrator" and not full_response.startswith("（"):
+                        content = f"（{content}"
                     
-            except Exception as e:
-                last_error = e
-                error_stack = traceback.format_exc()
-                print(f"Attempt {attempt + 1} failed with error:\n{error_stack}")
-                
-                # 如果不是最后一次尝试，继续重试
-                if attempt < self.max_retries - 1:
-                    continue
+                    # 如果是最后一个chunk且是旁白，添加结束括号
+                    if character_name == "Narrator" and chunk.choices[0].finish_reason == "stop":
+                        content = f"{content}）"
                     
-                # 如果是最后一次尝试，抛出错误
-                raise last_error 
\ No newline at end of file
+                    # 发送处理后的chunk
+                    yield content
+                
+                    # 添加延迟以模拟打字效果
+                    await asyncio.sleep(0.03)
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            # 没有返回token用量时按内容片段数估算
+            tokens = completion_tokens or content_chunks
+            total_ms = (time.perf_counter() - stream_started) * 1000
+            generation_ms = total_ms - (first_token_ms or 0)
+            tokens_per_sec = tokens * 1000 / generation_ms if generation_ms > 0 and tokens else None
+            stream_span.set(
+                llm_id=stream_llm_id,
+                ttft_ms=round(first_token_ms, 1) if first_token_ms is not None else None,
+                tokens=tokens,
+                tokens_per_sec=round(tokens_per_sec, 1) if tokens_per_sec is not None else None
+            )
+            stream_span.end(error=error, duration_ms=total_ms)
+            if stream_llm_id:
+                llm_stream_duration_seconds.labels(llm_id=stream_llm_id).observe(total_ms / 1000)
+                llm_stream_tokens_total.labels(llm_id=stream_llm_id).inc(tokens)
+                if first_token_ms is not None:
+                    llm_time_to_first_token_seconds.labels(llm_id=stream_llm_id).observe(first_token_ms / 1000)
+                if tokens_per_sec is not None:
+                    llm_stream_tokens_per_second.labels(llm_id=stream_llm_id).observe(tokens_per_sec)
@@ -0,0 +1,87 @@
+"""对话上下文组装
+
+按token预算而不是消息条数截取历史消息：从最新的消息开始向前装入，直到超出预算。
+每条消息的token数优先使用服务端写入 ConversationMessage 的 token_count，
+请求中传入的历史消息由客户端提供，一律重新计算。
+"""
+from dataclasses import dataclass
+from typing import List, Optional, Union
+
+from config.settings import settings
+from models.chat import HistoryMessage
+from models.conversation_message import ConversationMessage
+from models.llm import LLM
+from utils.tokens import count_tokens
+
+# 每条消息除内容外的格式开销（角色名称、换行等）
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+@dataclass
+class ContextWindow:
+    """装入预算的历史消息"""
+    messages: List[HistoryMessage]
+    tokens: int  # 装入消息的token总数
+    dropped: int  # 因预算或条数限制被丢弃的消息数
+    start_sequence: Optional[int] = None  # 窗口起点，序号小于它的消息不在窗口中；没有历史消息时为空
+
+
+def history_budget(llm: Optional[LLM]) -> int:
+    """模型的历史消息token预算
+
+    Args:
+        llm: 模型，为空时使用默认预算
+
+    Returns:
+        int: token预算
+    """
+    if llm and llm.settings.context_tokens:
+        return llm.settings.context_tokens
+    return settings.CONTEXT_HISTORY_TOKENS
+
+
+def message_tokens(message: Union[HistoryMessage, ConversationMessage]) -> int:
+    """单条历史消息的token数"""
+    tokens = message.token_count if isinstance(message, ConversationMessage) else None
+    if tokens is None:
+        tokens = count_tokens(message.content)
+    return tokens + count_tokens(message.character_name) + MESSAGE_OVERHEAD_TOKENS
+
+
+def pack_history(
+    messages: List[HistoryMessage],
+    budget: int,
+    max_messages: Optional[int] = None
+) -> ContextWindow:
+    """从最新的消息开始装入预算
+
+    Args:
+        messages: 按时间正序排列的历史消息
+        budget: token预算
+        max_messages: 最多装入的消息条数
+
+    Returns:
+        ContextWindow: 按时间正序排列的装入消息
+    """
+    candidates = messages[-max_messages:] if max_messages else messages
+    packed: List[HistoryMessage] = []
+    used = 0
+    for message in reversed(candidates):
+        tokens = message_tokens(message)
+        if used + tokens > budget:
+            break
+        packed.append(message)
+        used += tokens
+    packed.reverse()
+    if packed:
+        start_sequence = packed[0].sequence
+    elif messages:
+        start_sequence = messages[-1].sequence + 1
+    else:
+        start_sequence = None
+    return ContextWindow(
+        messages=packed,
+        tokens=used,
+        dropped=len(messages) - len(packed),
+        start_sequence=start_sequence
+    )
@@ -1,4 +1,6 @@
+import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Tuple, Optional
 from openai import OpenAI
 from sqlalchemy.orm import Session
@@ -15,6 +17,8 @@ from config.settings import (
     OTHER_AGENT_TEMPERATURE
 )
 
+logger = logging.getLogger(__name__)
+
 class LLMService:
     def __init__(self, story_setting: dict, characters: Dict[int, Character], db: Session):
         # 故事对话使用的 LLM 客户端
@@ -50,10 +54,16 @@ class LLMService:
     def process_user_message(
         self,
         conversation: Conversation,
-        user_message: str
+        user_message: str,
+        concurrent: bool = False
     ) -> Tuple[List[Dict[str, str]], bool]:
         """处理用户消息并返回AI回复
         
+        Args:
+            conversation: 对话对象
+            user_message: 用户消息
+            concurrent: 是否同时生成多个角色的回复（角色之间互相看不到本轮的回复）
+        
         Returns:
             Tuple[List[Dict[str, str]], bool]: 
             - AI回复消息列表，每个消息包含：
@@ -70,16 +80,9 @@ class LLMService:
         # 选择下一组说话的角色
         next_speakers = self._select_next_speakers(api_messages)
         
-        # 生成所有选中角色的回复
-        all_ai_messages = []
+        # 查找角色ID
+        speaker_roles = []
         for speaker in next_speakers:
-            # 将之前的回复添加到API消息中
-            current_api_messages = api_messages + [
-                {"role": "assistant", "content": f"[{msg['name']}:] {msg['content']}"}
-                for msg in all_ai_messages
-            ]
-            
-            # 查找角色ID
             character_id = None
             for char_id, char in self.characters.items():
                 if char.name == speaker:
@@ -87,10 +90,29 @@ class LLMService:
                     break
                     
             if character_id is not None:
-                ai_messages = self._generate_character_response(f"character_{character_id}", current_api_messages)
-                all_ai_messages.extend(ai_messages)
+                speaker_roles.append(f"character_{character_id}")
             else:
-                print(f"警告：未找到角色 {speaker}")  # 添加日志，方便调试
+                logger.warning("Speaker %s not found in story characters", speaker)
+        
+        # 生成所有选中角色的回复
+        all_ai_messages = []
+        if concurrent and len(speaker_roles) > 1:
+            # 各角色基于相同的上下文同时生成，结果按选择顺序返回
+            with ThreadPoolExecutor(max_workers=len(speaker_roles)) as executor:
+                futures = [
+                    executor.submit(self._generate_character_response, role, api_messages)
+                    for role in speaker_roles
+                ]
+                for future in futures:
+                    all_ai_messages.extend(future.result())
+        else:
+            for role in speaker_roles:
+                # 将之前的回复添加到API消息中
+                current_api_messages = api_messages + [
+                    {"role": "assistant", "content": f"[{msg['name']}:] {msg['content']}"}
+                    for msg in all_ai_messages
+                ]
+                all_ai_messages.extend(self._generate_character_response(role, current_api_messages))
         
         # 所有选中的角色都回复完毕后，返回所有消息并指示需要用户输入
         return all_ai_messages, True
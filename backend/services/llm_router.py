@@ -0,0 +1,232 @@
+"""LLM模型路由
+
+在进程内为每个 llm_id 统计进行中的请求数、EWMA延迟、近期错误率和限流余量，
+按 power-of-two-choices 或最少进行中请求选择模型，替代随机选择和按使用次数排序。
+"""
+import random
+import re
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple
+
+from config.settings import settings
+from models.llm import LLM
+
+_DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """解析限流响应头中的时间，如 "1s"、"6m0s"、"20ms" 或纯数字秒数
+
+    Args:
+        value: 响应头的值
+
+    Returns:
+        Optional[float]: 秒数，无法解析时返回None
+    """
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_PATTERN.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+
+
+@dataclass
+class ModelLoad:
+    """单个模型的负载统计"""
+    llm_id: str
+    in_flight: int = 0
+    ewma_latency: Optional[float] = None
+    error_rate: float = 0.0
+    requests: int = 0
+    rate_limit_limit: Optional[int] = None
+    rate_limit_remaining: Optional[int] = None
+    rate_limit_reset_at: float = 0.0
+    rate_limited_until: float = 0.0
+
+    def headroom(self, now: float) -> Optional[float]:
+        """限流余量比例，没有可用的限流信息时返回None"""
+        if self.rate_limited_until > now:
+            return 0.0
+        if self.rate_limit_limit and self.rate_limit_remaining is not None and self.rate_limit_reset_at > now:
+            return self.rate_limit_remaining / self.rate_limit_limit
+        return None
+
+    def score(self, now: float) -> float:
+        """预估的请求代价，越小越优先"""
+        latency = self.ewma_latency if self.ewma_latency is not None else settings.LLM_ROUTER_DEFAULT_LATENCY
+        cost = latency * (self.in_flight + 1) * (1 + settings.LLM_ROUTER_ERROR_PENALTY * self.error_rate)
+        headroom = self.headroom(now)
+        if headroom is not None:
+            cost /= max(headroom, 0.01)
+        return cost
+
+
+class LLMRouter:
+    """LLM模型路由器"""
+
+    def __init__(self):
+        self.loads: Dict[str, ModelLoad] = {}
+        self._models: Dict[str, Tuple[float, List[LLM]]] = {}
+
+    def load(self, llm_id: str) -> ModelLoad:
+        """获取指定模型的负载统计"""
+        if llm_id not in self.loads:
+            self.loads[llm_id] = ModelLoad(llm_id)
+        return self.loads[llm_id]
+
+    async def models(self, llm_type: str) -> List[LLM]:
+        """获取指定类型的可用模型，结果缓存 LLM_ROUTER_CACHE_SECONDS 秒
+
+        Args:
+            llm_type: 模型类型
+
+        Returns:
+            List[LLM]: 状态为active的模型列表
+        """
+        cached = self._models.get(llm_type)
+        if cached and time.monotonic() - cached[0] < settings.LLM_ROUTER_CACHE_SECONDS:
+            return cached[1]
+        models = await LLM.find({"type": llm_type, "status": "active"}).to_list()
+        self._models[llm_type] = (time.monotonic(), models)
+        return models
+
+    def invalidate(self, llm_type: Optional[str] = None):
+        """清除模型列表缓存"""
+        if llm_type is None:
+            self._models.clear()
+        else:
+            self._models.pop(llm_type, None)
+
+    def choose(self, models: Sequence[LLM]) -> Optional[LLM]:
+        """从候选模型中选择一个
+
+        p2c 策略随机抽取两个模型取代价较低者，least_outstanding 策略选择进行中请求最少的模型
+
+        Args:
+            models: 候选模型
+
+        Returns:
+            Optional[LLM]: 选中的模型，没有候选时返回None
+        """
+        if not models:
+            return None
+        now = time.monotonic()
+        if settings.LLM_ROUTER_STRATEGY == "least_outstanding":
+            return min(
+                models,
+                key=lambda m: (self.load(m.llm_id).in_flight, self.load(m.llm_id).score(now), random.random())
+            )
+        if len(models) == 1:
+            return models[0]
+        first, second = random.sample(list(models), 2)
+        if self.load(second.llm_id).score(now) < self.load(first.llm_id).score(now):
+            return second
+        return first
+
+    def rank(self, models: Sequence[LLM]) -> List[LLM]:
+        """为故障切换排列候选模型：首选由 choose 决定，其余按代价升序"""
+        first = self.choose(models)
+        if first is None:
+            return []
+        now = time.monotonic()
+        rest = sorted(
+            (m for m in models if m.llm_id != first.llm_id),
+            key=lambda m: self.load(m.llm_id).score(now)
+        )
+        return [first] + rest
+
+    async def pick(self, llm_type: str) -> Optional[LLM]:
+        """选择一个指定类型的模型
+
+        Args:
+            llm_type: 模型类型（chat/other/t2i/i2t）
+
+        Returns:
+            Optional[LLM]: 选中的模型，没有可用模型时返回None
+        """
+        return self.choose(await self.models(llm_type))
+
+    def acquire(self, llm_id: str):
+        """请求开始"""
+        self.load(llm_id).in_flight += 1
+
+    def release(self, llm_id: str):
+        """请求结束"""
+        load = self.load(llm_id)
+        load.in_flight = max(0, load.in_flight - 1)
+
+    def record(self, llm_id: str, latency: Optional[float], ok: bool):
+        """记录一次调用结果
+
+        Args:
+            llm_id: 模型ID
+            latency: 成功调用的延迟（流式调用为首个片段的延迟）
+            ok: 是否成功
+        """
+        alpha = settings.LLM_ROUTER_EWMA_ALPHA
+        load = self.load(llm_id)
+        load.requests += 1
+        load.error_rate = alpha * (0.0 if ok else 1.0) + (1 - alpha) * load.error_rate
+        if ok and latency is not None:
+            if load.ewma_latency is None:
+                load.ewma_latency = latency
+            else:
+                load.ewma_latency = alpha * latency + (1 - alpha) * load.ewma_latency
+
+    def observe_headers(self, llm_id: str, headers: Mapping[str, str]):
+        """从上游响应头中读取限流余量
+
+        Args:
+            llm_id: 模型ID
+            headers: 响应头
+        """
+        load = self.load(llm_id)
+        now = time.monotonic()
+        limit = headers.get("x-ratelimit-limit-requests")
+        remaining = headers.get("x-ratelimit-remaining-requests")
+        if limit and remaining:
+            try:
+                load.rate_limit_limit = int(limit)
+                load.rate_limit_remaining = int(remaining)
+            except ValueError:
+                return
+            reset = parse_duration(headers.get("x-ratelimit-reset-requests"))
+            load.rate_limit_reset_at = now + (reset if reset is not None else 60)
+
+    def observe_rate_limited(self, llm_id: str, headers: Optional[Mapping[str, str]] = None):
+        """上游返回429时，在 Retry-After 时间内不再优先选择该模型
+
+        Args:
+            llm_id: 模型ID
+            headers: 429响应的响应头
+        """
+        retry_after = parse_duration((headers or {}).get("retry-after"))
+        self.load(llm_id).rate_limited_until = time.monotonic() + (
+            retry_after if retry_after is not None else settings.LLM_ROUTER_RATE_LIMIT_COOLDOWN
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        """所有模型的负载统计"""
+        now = time.monotonic()
+        return {
+            llm_id: {
+                "in_flight": load.in_flight,
+                "ewma_latency": load.ewma_latency,
+                "error_rate": load.error_rate,
+                "requests": load.requests,
+                "headroom": load.headroom(now),
+                "score": load.score(now),
+            }
+            for llm_id, load in self.loads.items()
+        }
+
+
+# 创建全局实例
+llm_router = LLMRouter()
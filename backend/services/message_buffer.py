@@ -0,0 +1,231 @@
+"""对话消息的写缓冲
+
+一次回复流（/generate-response 或 /turn）中的消息先放在缓冲中：
+- 流式生成的回复每隔 MESSAGE_CHECKPOINT_SECONDS 秒把已生成的内容写入一次（partial=True），
+  同时写入缓冲中已完成的消息，进程崩溃时已生成的部分不会丢失
+- 流结束时本次的所有消息合并为一次 bulk_write 写入；未生成完的回复保留 partial=True
+- 客户端断开时流被取消，最终写入在屏蔽取消的作用域中完成；写入失败的消息留在缓冲中，应用关闭时重试
+- 应用关闭时写入所有尚未写入的缓冲
+
+消息在加入缓冲时预先分配 _id，检查点和最终写入都按 _id upsert，重复写入是幂等的。
+bulk_write 不会触发文档的插入事件，token_count 在加入缓冲和生成完成时计算。
+"""
+import asyncio
+import logging
+import time
+from contextlib import suppress
+from typing import Any, Dict, List, Optional, Set
+
+import anyio
+from beanie import PydanticObjectId
+from beanie.odm.utils.dump import get_dict
+from pymongo import InsertOne, ReplaceOne
+from pymongo.errors import BulkWriteError
+
+from config.settings import settings
+from models.conversation_message import ConversationMessage
+from utils.tokens import count_tokens
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY_ERROR = 11000
+SEQUENCE_INDEX = "conversation_sequence_unique"
+
+
+class _PendingMessage:
+    """缓冲中的一条消息"""
+
+    def __init__(self, message: ConversationMessage):
+        self.message = message
+        self.checkpointed = False  # 是否已经写入过检查点
+        self.last_checkpoint = time.monotonic()
+
+    def operation(self):
+        """写入这条消息的操作，写入过检查点的消息按 _id 覆盖"""
+        document = get_dict(self.message, to_db=True)
+        if self.checkpointed:
+            return ReplaceOne({"_id": self.message.id}, document, upsert=True)
+        return InsertOne(document)
+
+
+async def _bulk_write(items: List[_PendingMessage], operations: list) -> List[_PendingMessage]:
+    """合并写入
+
+    重试的请求中已经写入过的消息（request_id 重复）视为写入成功。
+
+    Returns:
+        List[_PendingMessage]: 序号冲突而没有写入的消息
+    """
+    try:
+        await ConversationMessage.get_motor_collection().bulk_write(operations, ordered=False)
+    except BulkWriteError as e:
+        conflicts = []
+        for error in e.details.get("writeErrors", []):
+            if error.get("code") != DUPLICATE_KEY_ERROR:
+                raise
+            if SEQUENCE_INDEX in error.get("errmsg", ""):
+                conflicts.append(items[error["index"]])
+        return conflicts
+    return []
+
+
+class ConversationWriteBuffer:
+    """一个回复流的消息写缓冲"""
+
+    def __init__(self, conversation_id: Any, owner: "MessageWriteBuffer"):
+        self.conversation_id = conversation_id
+        self._owner = owner
+        self._pending: Dict[PydanticObjectId, _PendingMessage] = {}
+        self._checkpoint: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+
+    def add(self, message: ConversationMessage) -> ConversationMessage:
+        """加入一条完整的消息
+
+        Args:
+            message: 消息，未分配 _id 时预先分配
+
+        Returns:
+            ConversationMessage: 加入的消息
+        """
+        if message.id is None:
+            message.id = PydanticObjectId()
+        message.token_count = count_tokens(message.content)
+        self._pending[message.id] = _PendingMessage(message)
+        return message
+
+    def start(self, message: ConversationMessage) -> ConversationMessage:
+        """加入一条将要流式生成的消息，生成完成前为 partial"""
+        message.partial = True
+        self.add(message)
+        message.token_count = None  # 检查点中的内容不完整，读取时再计算
+        return message
+
+    def update(self, message: ConversationMessage, content: str):
+        """更新流式生成中的消息内容，距上次检查点超过间隔时在后台写入检查点
+
+        Args:
+            message: 通过 start() 加入的消息
+            content: 目前已生成的全部内容
+        """
+        message.content = content
+        pending = self._pending.get(message.id)
+        if pending is None:
+            return
+        now = time.monotonic()
+        if now - pending.last_checkpoint < settings.MESSAGE_CHECKPOINT_SECONDS:
+            return
+        # 同时只有一个检查点写入，上一次还没有完成时跳过
+        if self._checkpoint and not self._checkpoint.done():
+            return
+        pending.last_checkpoint = now
+        self._checkpoint = asyncio.create_task(self._write_checkpoint(pending))
+
+    def discard(self, message: ConversationMessage):
+        """移除还没有写入的消息"""
+        self._pending.pop(message.id, None)
+
+    def finish(self, message: ConversationMessage, content: str):
+        """流式生成完成"""
+        message.content = content
+        message.partial = False
+        message.token_count = count_tokens(content)
+
+    async def _write_checkpoint(self, streaming: _PendingMessage):
+        # 流式消息写入目前的内容，已完成的消息一并写入并移出缓冲
+        completed = [
+            item for item in self._pending.values()
+            if item is not streaming and not item.message.partial
+        ]
+        items = [*completed, streaming]
+        operations = [item.operation() for item in completed]
+        operations.append(ReplaceOne({"_id": streaming.message.id}, get_dict(streaming.message, to_db=True), upsert=True))
+        try:
+            conflicts = await _bulk_write(items, operations)
+        except Exception as e:
+            # 检查点失败不影响回复，最终写入时会写入全部内容
+            logger.warning("Checkpoint of conversation %s failed: %s", self.conversation_id, e)
+            return
+        # 序号冲突的消息留在缓冲中，最终写入时重新分配序号
+        streaming.checkpointed = streaming not in conflicts
+        written = [item for item in completed if item not in conflicts]
+        for item in written:
+            self._pending.pop(item.message.id, None)
+        self._owner.checkpoints += 1
+        self._owner.messages += len(written)
+
+    async def flush(self):
+        """把缓冲中的消息合并为一次写入"""
+        async with self._flush_lock:
+            if self._checkpoint:
+                # 等待进行中的检查点，避免它覆盖最终内容
+                with suppress(Exception):
+                    await self._checkpoint
+                self._checkpoint = None
+            pending = list(self._pending.values())
+            if not pending:
+                return
+
+            # 写入成功后才移出缓冲，失败时可以重试；已经写入的消息重试时按重复键视为写入成功
+            conflicts = await _bulk_write(pending, [item.operation() for item in pending])
+            # 对话的序号计数落后于已有消息时，逐条校正序号后写入
+            for item in conflicts:
+                await item.message.insert_once()
+            for item in pending:
+                self._pending.pop(item.message.id, None)
+            self._owner.flushes += 1
+            self._owner.messages += len(pending)
+
+    async def close(self):
+        """写入剩余的消息并注销缓冲
+
+        客户端断开时回复流被取消，写入在屏蔽取消的作用域中完成，已生成的内容不会丢失。
+        写入失败时缓冲保持注册，应用关闭时由 stop() 重试。
+        """
+        with anyio.CancelScope(shield=True):
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error("Failed to flush messages of conversation %s: %s", self.conversation_id, e)
+                return
+            self._owner._buffers.discard(self)
+
+
+class MessageWriteBuffer:
+    """所有进行中的回复流的写缓冲"""
+
+    def __init__(self):
+        self._buffers: Set[ConversationWriteBuffer] = set()
+        self.flushes = 0
+        self.messages = 0
+        self.checkpoints = 0
+
+    def open(self, conversation_id: Any) -> ConversationWriteBuffer:
+        """为一个回复流创建写缓冲
+
+        Args:
+            conversation_id: 对话ID
+
+        Returns:
+            ConversationWriteBuffer: 写缓冲，流结束时需要调用 close()
+        """
+        buffer = ConversationWriteBuffer(conversation_id, self)
+        self._buffers.add(buffer)
+        return buffer
+
+    async def stop(self):
+        """应用关闭时写入所有缓冲"""
+        for buffer in list(self._buffers):
+            await buffer.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "open_buffers": len(self._buffers),
+            "flushes": self.flushes,
+            "messages": self.messages,
+            "checkpoints": self.checkpoints,
+        }
+
+
+# 创建全局实例
+message_buffer = MessageWriteBuffer()
@@ -0,0 +1,145 @@
+"""适合上游前缀缓存的提示词布局
+
+DeepSeek 等服务按请求的前缀缓存已计算的上下文，只有逐字相同的前缀才能命中。
+因此提示词按稳定程度排列：最前面是不变的系统块（角色提示词、故事背景、角色列表），
+然后是逐轮增长的历史消息（每条一个消息，只在末尾追加），最后是每轮变化的内容。
+同一角色在同一故事中的连续请求共享系统块和大部分历史消息前缀。
+"""
+import hashlib
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Optional
+
+from models.character import Character
+from models.story import Story
+from services.usage import cached_prompt_tokens, usage_value
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PromptLayout:
+    """按稳定程度组织的提示词
+
+    static 中的块合并为第一条系统消息，messages 为其后的对话消息
+    """
+    static: List[str] = field(default_factory=list)
+    messages: List[Dict[str, str]] = field(default_factory=list)
+
+    def add_static(self, block: Optional[str]):
+        """添加不随对话变化的系统块"""
+        if block:
+            self.static.append(block.strip())
+
+    def add_message(self, role: str, content: str):
+        """追加对话消息，与上一条消息角色相同时合并，保证角色交替"""
+        if self.messages and self.messages[-1]["role"] == role:
+            self.messages[-1]["content"] += f"\n{content}"
+        else:
+            self.messages.append({"role": role, "content": content})
+
+    @property
+    def system_prompt(self) -> str:
+        return "\n\n".join(self.static)
+
+    @property
+    def prefix_hash(self) -> str:
+        """静态前缀的哈希，相同哈希的请求可以命中同一份上游缓存"""
+        return hashlib.sha1(self.system_prompt.encode("utf-8")).hexdigest()[:12]
+
+    @property
+    def text(self) -> str:
+        """全部文本，用于估算token数"""
+        return "\n".join([self.system_prompt, *(msg["content"] for msg in self.messages)])
+
+    def build(self) -> List[Dict[str, str]]:
+        """生成请求的 messages 参数"""
+        return [{"role": "system", "content": self.system_prompt}, *self.messages]
+
+
+def story_context(story: Optional[Story], characters: Iterable[Character]) -> Optional[str]:
+    """构建故事背景和角色列表系统块
+
+    Args:
+        story: 故事
+        characters: 故事中的角色
+
+    Returns:
+        Optional[str]: 系统块内容，没有可用信息时为None
+    """
+    sections = []
+    if story and story.generated_background:
+        sections.append(f"# 故事背景\n{story.generated_background}")
+    if story and story.generated_target:
+        sections.append(f"# 故事目标\n{story.generated_target}")
+    # 按名称排序，使角色列表在每次请求中保持一致
+    roster = [f"- {character.name}：{character.description}" for character in sorted(characters, key=lambda c: c.name)]
+    if roster:
+        sections.append("# 故事中的角色\n" + "\n".join(roster))
+    return "\n\n".join(sections) or None
+
+
+@dataclass
+class PrefixCacheEntry:
+    """单个前缀的缓存命中统计"""
+    calls: int = 0
+    prompt_tokens: int = 0
+    cached_tokens: int = 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "prompt_tokens": self.prompt_tokens,
+            "cached_tokens": self.cached_tokens,
+            "hit_rate": self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0,
+        }
+
+
+class PrefixCacheStats:
+    """按模型和前缀哈希统计上游缓存命中的token数"""
+
+    def __init__(self, max_prefixes: int = 256):
+        self.max_prefixes = max_prefixes
+        self._models: Dict[str, PrefixCacheEntry] = {}
+        self._prefixes: "OrderedDict[str, PrefixCacheEntry]" = OrderedDict()
+
+    def record(self, prefix_hash: str, llm_id: str, usage: Any):
+        """记录一次调用返回的 usage
+
+        Args:
+            prefix_hash: 提示词静态前缀的哈希
+            llm_id: 模型ID
+            usage: 上游返回的 usage 字段，为空时忽略
+        """
+        if usage is None:
+            return
+        prompt_tokens = usage_value(usage, "prompt_tokens")
+        cached_tokens = cached_prompt_tokens(usage)
+
+        prefix = self._prefixes.get(prefix_hash)
+        if prefix is None:
+            prefix = self._prefixes[prefix_hash] = PrefixCacheEntry()
+            while len(self._prefixes) > self.max_prefixes:
+                self._prefixes.popitem(last=False)
+        self._prefixes.move_to_end(prefix_hash)
+
+        for entry in (prefix, self._models.setdefault(llm_id, PrefixCacheEntry())):
+            entry.calls += 1
+            entry.prompt_tokens += prompt_tokens
+            entry.cached_tokens += cached_tokens
+
+        logger.debug(
+            "Prompt cache: llm=%s prefix=%s prompt_tokens=%s cached_tokens=%s",
+            llm_id, prefix_hash, prompt_tokens, cached_tokens
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "models": {llm_id: entry.stats() for llm_id, entry in self._models.items()},
+            "prefixes": {prefix: entry.stats() for prefix, entry in reversed(self._prefixes.items())},
+        }
+
+
+# 创建全局实例
+prefix_cache_stats = PrefixCacheStats()
@@ -0,0 +1,141 @@
+"""提示词模板引擎
+
+模板中的 {name} 占位符在加载时解析为片段列表，渲染时一次拼接完成，
+替换值中的花括号不会被再次替换；JSON示例等非标识符形式的花括号按原文保留。
+数据库中的模板（OtherAgent、PromptTemplate、CharacterSystemPromptPost）从 catalog 缓存读取，
+按模板内容编译一次，文档更新后内容变化时重新编译。
+"""
+import hashlib
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, FrozenSet, Iterable, List, Optional, Tuple
+
+from models.character_system_prompt_post import CharacterSystemPromptPost
+from models.other_agent import OtherAgent
+from models.prompt_template import PromptTemplate
+from services.catalog import catalog
+
+_PLACEHOLDER_PATTERN = re.compile(r"\{([A-Za-z_][A-Za-z0-9_]*)\}")
+
+
+def _hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+
+class TemplateError(ValueError):
+    """模板占位符与提供的变量不匹配"""
+
+
+@dataclass(frozen=True)
+class RenderedPrompt:
+    """渲染结果及其哈希，哈希可用作响应缓存的键"""
+    text: str
+    hash: str
+
+
+class CompiledTemplate:
+    """已编译的提示词模板"""
+
+    def __init__(self, source: str, name: str = "template"):
+        self.source = source
+        self.name = name
+        # 偶数位置为原文，奇数位置为占位符名称
+        self.parts: List[str] = _PLACEHOLDER_PATTERN.split(source)
+        self.placeholders: FrozenSet[str] = frozenset(self.parts[1::2])
+        self.source_hash = _hash(source)
+        # 第一个占位符之前的原文在每次渲染中都相同，是可被上游缓存的前缀
+        self.prefix_hash = _hash(self.parts[0])
+
+    def validate(self, names: Iterable[str]):
+        """检查模板只使用了调用方会提供的变量
+
+        Raises:
+            TemplateError: 模板中存在调用方不提供的占位符
+        """
+        unknown = self.placeholders - set(names)
+        if unknown:
+            raise TemplateError(f"Template {self.name} has unknown placeholders: {sorted(unknown)}")
+
+    def render(self, **values: Any) -> str:
+        """渲染模板
+
+        Args:
+            **values: 占位符的值，可以多于模板使用的占位符
+
+        Returns:
+            str: 渲染后的文本
+
+        Raises:
+            TemplateError: 缺少模板使用的占位符
+        """
+        missing = self.placeholders - values.keys()
+        if missing:
+            raise TemplateError(f"Template {self.name} missing values for: {sorted(missing)}")
+        parts = self.parts.copy()
+        for i in range(1, len(parts), 2):
+            parts[i] = str(values[parts[i]])
+        return "".join(parts)
+
+    def render_hashed(self, **values: Any) -> RenderedPrompt:
+        """渲染模板并计算结果的哈希"""
+        text = self.render(**values)
+        return RenderedPrompt(text=text, hash=_hash(text))
+
+
+@lru_cache(maxsize=512)
+def compile_template(source: str, name: str = "template") -> CompiledTemplate:
+    """编译模板，相同的模板文本只编译一次"""
+    return CompiledTemplate(source, name)
+
+
+class PromptTemplateStore:
+    """数据库提示词模板，文档从 catalog 缓存读取，模板按内容编译一次"""
+
+    @staticmethod
+    def _compile(
+        key: Tuple[str, ...],
+        source: Optional[str],
+        names: Optional[Iterable[str]]
+    ) -> Optional[CompiledTemplate]:
+        if source is None:
+            return None
+        template = compile_template(source, ":".join(key))
+        if names is not None:
+            template.validate(names)
+        return template
+
+    async def other_agent(self, agent_id: str, names: Optional[Iterable[str]] = None) -> Optional[CompiledTemplate]:
+        """获取代理的系统提示词模板
+
+        Args:
+            agent_id: 代理ID
+            names: 调用方提供的变量名，提供时检查模板的占位符
+
+        Returns:
+            Optional[CompiledTemplate]: 模板，代理不存在时为None
+
+        Raises:
+            TemplateError: 模板中存在调用方不提供的占位符
+        """
+        agent = (await catalog.get(OtherAgent)).find_one(agent_id=agent_id)
+        return self._compile(("other_agent", agent_id), agent.system_prompt if agent else None, names)
+
+    async def prompt_template(self, type: str, names: Optional[Iterable[str]] = None) -> Optional[CompiledTemplate]:
+        """获取指定类型的提示词模板，参数同 other_agent"""
+        template = (await catalog.get(PromptTemplate)).find_one(type=type)
+        return self._compile(("prompt_template", type), template.content if template else None, names)
+
+    async def system_prompt_post(
+        self,
+        type: str,
+        language: str,
+        names: Optional[Iterable[str]] = None
+    ) -> Optional[CompiledTemplate]:
+        """获取指定类型和语言的角色系统提示词补充，参数同 other_agent"""
+        post = (await catalog.get(CharacterSystemPromptPost)).find_one(type=type, language=language)
+        return self._compile(("system_prompt_post", type, language), post.content if post else None, names)
+
+
+# 创建全局实例
+prompt_templates = PromptTemplateStore()
@@ -0,0 +1,298 @@
+"""上游模型限流
+
+按 llm_id 在客户端限制每分钟请求数（RPM）、每分钟token数（TPM）和并发请求数，
+限额配置在 LLMSettings 中。超出限额的请求在截止时间内排队等待，而不是把429留给用户。
+RPM/TPM 预算默认在进程内维护，配置 UPSTREAM_LIMIT_BACKEND=redis 时通过 REDIS_URL
+在所有 worker 之间共享；并发数限制始终按进程计算。
+"""
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from config.settings import settings
+from models.llm import LLM
+from utils.tokens import count_tokens
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # redis 为可选依赖
+    aioredis = None
+
+logger = logging.getLogger(__name__)
+
+REDIS_KEY_PREFIX = "paw:upstream_limit:"
+
+# 原子地检查并扣减多个令牌桶，全部足够时扣减并返回0，否则返回需要等待的秒数
+# KEYS: 桶的键；ARGV: 每个桶依次为 每秒补充量, 容量, 本次需要的量
+_TOKEN_BUCKET_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local states = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 3 - 2])
+    local capacity = tonumber(ARGV[i * 3 - 1])
+    local amount = tonumber(ARGV[i * 3])
+    local state = redis.call('HMGET', key, 'tokens', 'updated')
+    local tokens = tonumber(state[1]) or capacity
+    local updated = tonumber(state[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+    if tokens < amount then
+        wait = math.max(wait, (amount - tokens) / rate)
+    end
+    states[i] = {tokens, amount, math.ceil(capacity / rate) + 60}
+end
+for i, key in ipairs(KEYS) do
+    local tokens = states[i][1]
+    if wait == 0 then
+        tokens = tokens - states[i][2]
+    end
+    redis.call('HSET', key, 'tokens', tokens, 'updated', now)
+    redis.call('EXPIRE', key, states[i][3])
+end
+return tostring(wait)
+"""
+
+
+def estimate_tokens(text: str) -> int:
+    """估计文本的token数，用于预扣TPM限额"""
+    return count_tokens(text) + 1
+
+
+class RateLimitTimeout(Exception):
+    """在截止时间内没有等到上游限额"""
+    status_code = 429
+
+    def __init__(self, llm_id: str, retry_after: float):
+        super().__init__(f"Upstream rate limit queue timeout for {llm_id}")
+        self.llm_id = llm_id
+        self.retry_after = retry_after
+
+
+@dataclass
+class Bucket:
+    """令牌桶请求：名称, 每分钟限额, 本次需要的量"""
+    name: str
+    per_minute: int
+    amount: float
+
+    @property
+    def rate(self) -> float:
+        return self.per_minute / 60
+
+    @property
+    def cost(self) -> float:
+        # 单次需求超过容量时按容量计算，避免永远无法满足
+        return min(self.amount, self.per_minute)
+
+
+class LocalBucketStore:
+    """进程内的令牌桶"""
+
+    def __init__(self):
+        self._buckets: Dict[str, Tuple[float, float]] = {}  # key -> (tokens, updated)
+
+    async def try_consume(self, llm_id: str, buckets: List[Bucket]) -> float:
+        """尝试扣减所有令牌桶
+
+        Returns:
+            float: 0表示已扣减，否则为需要等待的秒数
+        """
+        now = time.monotonic()
+        states = []
+        wait = 0.0
+        for bucket in buckets:
+            key = f"{llm_id}:{bucket.name}"
+            tokens, updated = self._buckets.get(key, (bucket.per_minute, now))
+            tokens = min(bucket.per_minute, tokens + (now - updated) * bucket.rate)
+            if tokens < bucket.cost:
+                wait = max(wait, (bucket.cost - tokens) / bucket.rate)
+            states.append((key, tokens, bucket.cost))
+        for key, tokens, cost in states:
+            self._buckets[key] = (tokens - cost if wait == 0 else tokens, now)
+        return wait
+
+
+class RedisBucketStore:
+    """Redis 中共享的令牌桶，Redis 不可用时退回进程内令牌桶"""
+
+    def __init__(self, url: str, fallback: LocalBucketStore):
+        self._client = aioredis.from_url(url)
+        self._script = self._client.register_script(_TOKEN_BUCKET_SCRIPT)
+        self._fallback = fallback
+
+    async def try_consume(self, llm_id: str, buckets: List[Bucket]) -> float:
+        keys = [f"{REDIS_KEY_PREFIX}{llm_id}:{bucket.name}" for bucket in buckets]
+        args = []
+        for bucket in buckets:
+            args.extend([bucket.rate, bucket.per_minute, bucket.cost])
+        try:
+            return float(await self._script(keys=keys, args=args))
+        except Exception as e:
+            logger.warning("Redis rate limit unavailable, using local buckets: %s", e)
+            return await self._fallback.try_consume(llm_id, buckets)
+
+
+class ModelLimiter:
+    """单个模型的限流状态与统计"""
+
+    def __init__(self, llm_id: str, max_concurrency: Optional[int]):
+        self.llm_id = llm_id
+        self.set_concurrency(max_concurrency)
+        self.in_use = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.acquired = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def set_concurrency(self, max_concurrency: Optional[int]):
+        """设置并发上限，已获得许可的请求在原信号量上释放"""
+        self.max_concurrency = max_concurrency
+        self.semaphore = asyncio.Semaphore(max_concurrency) if max_concurrency else None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "in_use": self.in_use,
+            "queue_depth": self.waiting,
+            "max_queue_depth": self.max_waiting,
+            "acquired": self.acquired,
+            "timeouts": self.timeouts,
+            "avg_wait": self.total_wait / self.acquired if self.acquired else 0.0,
+            "max_wait": self.max_wait,
+        }
+
+
+class UpstreamRateLimiter:
+    """上游模型限流器"""
+
+    def __init__(self):
+        self.limiters: Dict[str, ModelLimiter] = {}
+        self._local = LocalBucketStore()
+        self._store = None
+
+    @property
+    def store(self):
+        """令牌桶存储，首次使用时按配置创建"""
+        if self._store is None:
+            if settings.UPSTREAM_LIMIT_BACKEND == "redis":
+                if aioredis is None:
+                    logger.warning("redis package not installed, using local rate limit buckets")
+                    self._store = self._local
+                else:
+                    self._store = RedisBucketStore(settings.REDIS_URL, self._local)
+            else:
+                self._store = self._local
+        return self._store
+
+    def limiter(self, llm: LLM) -> ModelLimiter:
+        """获取模型的限流状态，并发上限变化时更新"""
+        limiter = self.limiters.get(llm.llm_id)
+        if limiter is None:
+            limiter = self.limiters[llm.llm_id] = ModelLimiter(llm.llm_id, llm.settings.max_concurrency)
+        elif limiter.max_concurrency != llm.settings.max_concurrency:
+            limiter.set_concurrency(llm.settings.max_concurrency)
+        return limiter
+
+    @staticmethod
+    def _buckets(llm: LLM, tokens: int) -> List[Bucket]:
+        buckets = []
+        if llm.settings.rpm:
+            buckets.append(Bucket("rpm", llm.settings.rpm, 1))
+        if llm.settings.tpm and tokens > 0:
+            buckets.append(Bucket("tpm", llm.settings.tpm, tokens))
+        return buckets
+
+    async def acquire(
+        self,
+        llm: LLM,
+        tokens: int = 0,
+        deadline: Optional[float] = None
+    ) -> Callable[[], None]:
+        """等待上游限额
+
+        Args:
+            llm: 模型
+            tokens: 预估消耗的token数
+            deadline: 最晚开始时间（time.monotonic），默认为 UPSTREAM_QUEUE_TIMEOUT_SECONDS 之后
+
+        Returns:
+            Callable[[], None]: 调用结束后释放并发许可的函数，只能调用一次
+
+        Raises:
+            RateLimitTimeout: 截止时间前无法获得限额
+        """
+        if deadline is None:
+            deadline = time.monotonic() + settings.UPSTREAM_QUEUE_TIMEOUT_SECONDS
+        limiter = self.limiter(llm)
+        semaphore = limiter.semaphore
+        started = time.monotonic()
+
+        limiter.waiting += 1
+        limiter.max_waiting = max(limiter.max_waiting, limiter.waiting)
+        holding = False
+        try:
+            if semaphore:
+                try:
+                    await asyncio.wait_for(semaphore.acquire(), max(0.0, deadline - time.monotonic()))
+                except asyncio.TimeoutError:
+                    raise RateLimitTimeout(llm.llm_id, 1.0)
+                holding = True
+
+            buckets = self._buckets(llm, tokens)
+            while buckets:
+                wait = await self.store.try_consume(llm.llm_id, buckets)
+                if wait <= 0:
+                    break
+                # 等待后仍会超过截止时间则立即放弃，让调用方切换到其他模型
+                if time.monotonic() + wait > deadline:
+                    raise RateLimitTimeout(llm.llm_id, wait)
+                await asyncio.sleep(wait)
+        except BaseException as e:
+            if isinstance(e, RateLimitTimeout):
+                limiter.timeouts += 1
+            if holding:
+                semaphore.release()
+            raise
+        finally:
+            limiter.waiting -= 1
+
+        waited = time.monotonic() - started
+        limiter.acquired += 1
+        limiter.total_wait += waited
+        limiter.max_wait = max(limiter.max_wait, waited)
+        limiter.in_use += 1
+
+        def release():
+            limiter.in_use -= 1
+            if semaphore:
+                semaphore.release()
+
+        return release
+
+    @asynccontextmanager
+    async def limit(
+        self,
+        llm: LLM,
+        tokens: int = 0,
+        deadline: Optional[float] = None
+    ) -> AsyncIterator[None]:
+        """在限额内执行一次上游调用，参数同 acquire"""
+        release = await self.acquire(llm, tokens, deadline)
+        try:
+            yield
+        finally:
+            release()
+
+    def stats(self) -> Dict[str, Any]:
+        """所有模型的排队与限流统计"""
+        return {llm_id: limiter.stats() for llm_id, limiter in self.limiters.items()}
+
+
+# 创建全局实例
+rate_limiter = UpstreamRateLimiter()
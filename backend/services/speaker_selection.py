@@ -0,0 +1,204 @@
+"""说话角色选择策略
+
+按顺序尝试一组确定性的快速策略（点名检测、单候选故事、沿用上一轮模式），
+只有在这些策略都无法确定时才调用LLM；LLM也失败时退回轮询策略。
+每次决策都会记录由哪个策略做出。
+"""
+import logging
+import re
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, List, Optional
+
+from models.chat import HistoryMessage
+from models.conversation_message import MessageRole
+
+logger = logging.getLogger(__name__)
+
+# 旁白角色可能使用的名称
+NARRATOR_NAMES = {"Narrator", "旁白"}
+
+
+@dataclass
+class SpeakerSelectionContext:
+    """一次说话角色选择所需的上下文"""
+    history_length: int
+    history_messages: List[HistoryMessage]
+    user_message: str
+    character_names: List[str]
+    summary: Optional[str] = None  # 历史窗口之前的剧情摘要
+
+    @property
+    def recent_messages(self) -> List[HistoryMessage]:
+        """历史长度限制内的消息"""
+        return self.history_messages[-self.history_length:]
+
+    @property
+    def narrator_name(self) -> Optional[str]:
+        """可选角色中的旁白名称"""
+        return next((name for name in self.character_names if name in NARRATOR_NAMES), None)
+
+    @property
+    def candidates(self) -> List[str]:
+        """除旁白之外的可选角色"""
+        return [name for name in self.character_names if name not in NARRATOR_NAMES]
+
+
+@dataclass
+class SpeakerDecision:
+    """说话角色选择结果"""
+    speakers: List[str]
+    strategy: str  # 做出决策的策略名称
+
+
+class SpeakerStrategy:
+    """说话角色选择策略基类
+
+    子类实现 select，能确定结果时返回角色名称列表，否则返回None交给下一个策略
+    """
+    name = "base"
+
+    async def select(self, ctx: SpeakerSelectionContext) -> Optional[List[str]]:
+        raise NotImplementedError
+
+
+class MentionStrategy(SpeakerStrategy):
+    """点名检测：用户消息中直接提到了角色名称"""
+    name = "mention"
+
+    @staticmethod
+    def find_mentions(text: str, names: List[str]) -> List[str]:
+        """按出现顺序返回文本中提到的角色名称
+
+        拉丁字母名称按单词边界、忽略大小写匹配，其他名称按子串匹配
+        """
+        positions = []
+        for name in names:
+            if not name:
+                continue
+            if re.fullmatch(r"[A-Za-z0-9 _.'-]+", name):
+                match = re.search(rf"\b{re.escape(name)}\b", text, re.IGNORECASE)
+            else:
+                match = re.search(re.escape(name), text)
+            if match:
+                positions.append((match.start(), name))
+        return [name for _, name in sorted(positions)]
+
+    async def select(self, ctx: SpeakerSelectionContext) -> Optional[List[str]]:
+        mentioned = self.find_mentions(ctx.user_message, ctx.character_names)
+        return mentioned or None
+
+
+class SingleCandidateStrategy(SpeakerStrategy):
+    """单候选故事：除旁白外只有一个角色
+
+    旁白连续 narrator_interval 条消息没有出现时，让旁白跟在角色后面推进剧情
+    """
+    name = "single_candidate"
+
+    def __init__(self, narrator_interval: int = 8):
+        self.narrator_interval = narrator_interval
+
+    async def select(self, ctx: SpeakerSelectionContext) -> Optional[List[str]]:
+        candidates = ctx.candidates
+        if len(candidates) != 1:
+            return None
+
+        speakers = [candidates[0]]
+        narrator = ctx.narrator_name
+        if narrator and self.narrator_interval > 0:
+            since_narrator = 0
+            for msg in reversed(ctx.recent_messages):
+                if msg.role == MessageRole.NARRATOR:
+                    break
+                since_narrator += 1
+            if since_narrator >= self.narrator_interval:
+                speakers.append(narrator)
+        return speakers
+
+
+class FollowUpStrategy(SpeakerStrategy):
+    """沿用上一轮模式：上一轮只有一个角色回复，且用户只是简短追问"""
+    name = "follow_up"
+
+    def __init__(self, max_chars: int = 12):
+        self.max_chars = max_chars
+
+    async def select(self, ctx: SpeakerSelectionContext) -> Optional[List[str]]:
+        if self.max_chars <= 0 or len(ctx.user_message.strip()) > self.max_chars:
+            return None
+
+        # 上一轮 = 最后一条用户消息之后的所有回复
+        last_turn = []
+        for msg in reversed(ctx.recent_messages):
+            if msg.role == MessageRole.USER:
+                break
+            last_turn.append(msg)
+
+        speakers = {msg.character_name for msg in last_turn}
+        if len(speakers) != 1:
+            return None
+        speaker = speakers.pop()
+        if speaker in ctx.candidates:
+            return [speaker]
+        return None
+
+
+class LLMStrategy(SpeakerStrategy):
+    """由LLM根据完整上下文选择说话角色，失败时返回None"""
+    name = "llm"
+
+    def __init__(self, select_fn: Callable[[SpeakerSelectionContext], Awaitable[List[str]]]):
+        self.select_fn = select_fn
+
+    async def select(self, ctx: SpeakerSelectionContext) -> Optional[List[str]]:
+        try:
+            return await self.select_fn(ctx)
+        except Exception as e:
+            logger.warning("LLM speaker selection failed: %s", e)
+            return None
+
+
+class RoundRobinStrategy(SpeakerStrategy):
+    """轮询兜底：选择最久没有说话的角色，没有候选角色时选择旁白"""
+    name = "round_robin"
+
+    async def select(self, ctx: SpeakerSelectionContext) -> Optional[List[str]]:
+        candidates = ctx.candidates
+        if not candidates:
+            return [ctx.narrator_name or "Narrator"]
+
+        last_spoken = {name: -1 for name in candidates}
+        for index, msg in enumerate(ctx.history_messages):
+            if msg.character_name in last_spoken:
+                last_spoken[msg.character_name] = index
+        return [min(candidates, key=lambda name: last_spoken[name])]
+
+
+@dataclass
+class SpeakerSelector:
+    """按顺序执行策略链，返回第一个能做出决策的策略结果"""
+    strategies: List[SpeakerStrategy] = field(default_factory=list)
+
+    async def select(self, ctx: SpeakerSelectionContext) -> SpeakerDecision:
+        """选择说话角色
+
+        Args:
+            ctx: 选择上下文
+
+        Returns:
+            SpeakerDecision: 选择结果及做出决策的策略
+        """
+        strategies = list(self.strategies)
+        if not any(isinstance(s, RoundRobinStrategy) for s in strategies):
+            strategies.append(RoundRobinStrategy())
+
+        for strategy in strategies:
+            speakers = await strategy.select(ctx)
+            if speakers:
+                logger.info(
+                    "Speaker selection: strategy=%s speakers=%s candidates=%s",
+                    strategy.name, speakers, ctx.character_names
+                )
+                return SpeakerDecision(speakers=speakers, strategy=strategy.name)
+
+        raise ValueError("No speaker strategy produced a decision")
@@ -0,0 +1,227 @@
+"""推测式回复生成
+
+在说话角色选择进行的同时，提前为最可能的第一个说话角色生成回复。
+预测被确认时直接提交已缓冲的内容继续输出，预测错误时取消生成。
+"""
+import asyncio
+import logging
+import time
+from contextlib import suppress
+from typing import AsyncGenerator, Callable, Dict, Any, Optional
+
+from config.settings import settings
+from models.conversation_message import MessageRole
+from services.speaker_selection import SpeakerSelectionContext, MentionStrategy
+
+logger = logging.getLogger(__name__)
+
+_END = object()  # 生成结束标记
+
+
+class _StreamError:
+    """生成过程中的异常，由提交方重新抛出"""
+
+    def __init__(self, error: Exception):
+        self.error = error
+
+
+class BufferedStream:
+    """在后台运行的回复流
+
+    生成内容写入有界队列，队列满时暂停生成，避免未被消费的回复占用过多额度。
+    result 在生成完成时给出完整回复，供后续角色作为前文使用。
+    """
+
+    def __init__(self, speaker: str, source: AsyncGenerator[str, None], max_buffered: int):
+        self.speaker = speaker
+        self.started_at = time.monotonic()
+        self.generated_chars = 0
+        self.result: asyncio.Future = asyncio.get_running_loop().create_future()
+        # 没有后续角色等待结果时，避免出现未获取异常的警告
+        self.result.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._source = source
+        self._cancelled = False
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_buffered)
+        self._task = asyncio.create_task(self._pump())
+
+    async def _pump(self):
+        """从源生成器读取内容写入队列"""
+        full_response = ""
+        try:
+            async for chunk in self._source:
+                self.generated_chars += len(chunk)
+                full_response += chunk
+                await self._queue.put(chunk)
+            self.result.set_result(full_response)
+            await self._queue.put(_END)
+        except asyncio.CancelledError as e:
+            if not self.result.done():
+                self.result.cancel()
+            if self._cancelled:
+                raise
+            # 源生成器等待的前文被取消，转为普通错误交给消费方
+            await self._queue.put(_StreamError(RuntimeError(f"Reply of {self.speaker} was cancelled: {e}")))
+        except Exception as e:
+            if not self.result.done():
+                self.result.set_exception(e)
+            await self._queue.put(_StreamError(e))
+        finally:
+            with suppress(Exception):
+                await self._source.aclose()
+
+    async def commit(self) -> AsyncGenerator[str, None]:
+        """依次输出已缓冲和后续生成的内容
+
+        Yields:
+            str: 回复内容片段
+        """
+        try:
+            while True:
+                item = await self._queue.get()
+                if item is _END:
+                    return
+                if isinstance(item, _StreamError):
+                    raise item.error
+                yield item
+        finally:
+            # 消费方提前退出（例如客户端断开）时停止后台生成
+            await self.cancel()
+
+    async def cancel(self):
+        """取消生成"""
+        self.cancel_nowait()
+        with suppress(asyncio.CancelledError, Exception):
+            await self._task
+
+    def cancel_nowait(self):
+        """取消生成，不等待后台任务结束
+
+        用于调用方自身正在被取消、无法再等待的清理路径
+        """
+        self._cancelled = True
+        if not self._task.done():
+            self._task.cancel()
+
+
+class SpeculationManager:
+    """管理推测生成的并发预算与命中率统计"""
+
+    def __init__(self, max_concurrent: int, max_buffered_chunks: int):
+        self.max_concurrent = max_concurrent
+        self.max_buffered_chunks = max_buffered_chunks
+        self.active = 0
+        self.attempts = 0
+        self.hits = 0
+        self.misses = 0
+        self.skipped_budget = 0
+        self.abandoned = 0
+        self.wasted_chars = 0
+        self.head_start_seconds = 0.0  # 命中时推测生成领先于角色选择的累计时间
+
+    @staticmethod
+    def predict_speaker(ctx: SpeakerSelectionContext) -> Optional[str]:
+        """预测最可能的第一个说话角色
+
+        优先使用点名和单候选规则，否则取最近一个说话的非旁白角色
+
+        Args:
+            ctx: 选择上下文
+
+        Returns:
+            Optional[str]: 预测的角色名称，无法预测时返回None
+        """
+        mentioned = MentionStrategy.find_mentions(ctx.user_message, ctx.character_names)
+        if mentioned:
+            return mentioned[0]
+
+        candidates = ctx.candidates
+        if len(candidates) == 1:
+            return candidates[0]
+
+        for msg in reversed(ctx.recent_messages):
+            if msg.role == MessageRole.CHARACTER and msg.character_name in candidates:
+                return msg.character_name
+        return None
+
+    def start(
+        self,
+        speaker: str,
+        source_factory: Callable[[], AsyncGenerator[str, None]]
+    ) -> Optional[BufferedStream]:
+        """在预算允许时开始推测生成
+
+        Args:
+            speaker: 预测的角色名称
+            source_factory: 创建该角色回复生成器的函数
+
+        Returns:
+            Optional[BufferedStream]: 推测流，超出预算时返回None
+        """
+        if self.active >= self.max_concurrent:
+            self.skipped_budget += 1
+            return None
+        self.active += 1
+        self.attempts += 1
+        return BufferedStream(speaker, source_factory(), self.max_buffered_chunks)
+
+    async def resolve(self, stream: BufferedStream, confirmed_speaker: Optional[str]) -> bool:
+        """根据角色选择结果确认或取消推测
+
+        Args:
+            stream: 推测流
+            confirmed_speaker: 实际选出的第一个说话角色
+
+        Returns:
+            bool: 推测是否命中
+        """
+        self.active -= 1
+        if confirmed_speaker == stream.speaker:
+            self.hits += 1
+            self.head_start_seconds += time.monotonic() - stream.started_at
+            logger.info("Speculation hit: speaker=%s", stream.speaker)
+            return True
+
+        await stream.cancel()
+        self.misses += 1
+        self.wasted_chars += stream.generated_chars
+        logger.info(
+            "Speculation miss: predicted=%s actual=%s wasted_chars=%d",
+            stream.speaker, confirmed_speaker, stream.generated_chars
+        )
+        return False
+
+    def abandon(self, stream: BufferedStream):
+        """角色选择未完成（例如客户端断开）时放弃推测，同步释放预算
+
+        Args:
+            stream: 推测流
+        """
+        self.active -= 1
+        self.abandoned += 1
+        self.wasted_chars += stream.generated_chars
+        stream.cancel_nowait()
+        logger.info("Speculation abandoned: predicted=%s", stream.speaker)
+
+    def stats(self) -> Dict[str, Any]:
+        """获取推测生成的预算与命中率统计"""
+        resolved = self.hits + self.misses
+        return {
+            "max_concurrent": self.max_concurrent,
+            "max_buffered_chunks": self.max_buffered_chunks,
+            "active": self.active,
+            "attempts": self.attempts,
+            "hits": self.hits,
+            "misses": self.misses,
+            "skipped_budget": self.skipped_budget,
+            "abandoned": self.abandoned,
+            "hit_rate": self.hits / resolved if resolved else 0.0,
+            "wasted_chars": self.wasted_chars,
+            "avg_head_start_seconds": self.head_start_seconds / self.hits if self.hits else 0.0,
+        }
+
+
+# 创建全局实例
+speculation_manager = SpeculationManager(
+    max_concurrent=settings.SPECULATION_MAX_CONCURRENT,
+    max_buffered_chunks=settings.SPECULATION_MAX_BUFFERED_CHUNKS
+)
@@ -0,0 +1,212 @@
+"""故事列表（未开始/已开始）的轻量读取
+
+故事、角色、创建者和背景音乐都用投影只读取列表需要的字段，
+角色、创建者和背景音乐按整页批量查询，不再逐个 fetch 链接文档。
+"""
+import logging
+from typing import Any, Dict, Iterable, List, Optional
+
+from bson import DBRef, ObjectId
+from pydantic import BaseModel, Field
+
+from models.character import Character
+from models.conversation import Conversation
+from models.music import Music
+from models.story import Story
+from models.user import User
+
+logger = logging.getLogger(__name__)
+
+
+class GetStoriesResponse(BaseModel):
+    """获取故事列表响应模型"""
+    id: str = Field(..., description="故事ID")
+    title: str = Field(..., description="故事名称")
+    intro: str = Field(..., description="故事简介(generated_background)")
+    messages: List[Dict[str, str]] = Field(default_factory=list, description="开场白列表，包含content和character_id")
+    likes: str = Field(..., description="点赞数")
+    rewards: str = Field(..., description="打赏数")
+    background: str = Field(..., description="背景图片URL")
+    date: Optional[str] = Field(None, description="创建时间")
+    characters: int = Field(..., description="参与角色数量")
+    avatar_url: Optional[str] = Field(None, description="第一个非Narrator角色的形象图片URL")
+    characterIcons: List[str] = Field(default_factory=list, description="所有参与角色的icon_url列表(不包括Narrator)")
+    characterDetails: List[Dict[str, Any]] = Field(default_factory=list, description="所有角色的详细信息，包含可选的image_url和icon_url")
+    backgroundMusic: Optional[str] = Field(None, description="背景音乐URL")
+    created_by: str = Field(..., description="创建者钱包地址")
+    creator_name: str = Field(..., description="创建者用户名")
+    comments_count: str = Field(..., description="评论数量")
+
+
+# 故事列表需要的故事字段
+STORY_FEED_PROJECTION = {
+    "story_name": 1,
+    "generated_background": 1,
+    "bg_image_url": 1,
+    "characters": 1,
+    "background_music": 1,
+    "opening_messages": 1,
+    "likes": 1,
+    "retweet": 1,
+    "comments_count": 1,
+    "created_by": 1,
+    "created_at": 1,
+}
+
+# 角色详情返回的角色字段
+CHARACTER_FEED_PROJECTION = {"name": 1, "description": 1, "image_url": 1, "icon_url": 1, "character_type": 1}
+
+
+def _ref_id(ref: Any) -> Optional[ObjectId]:
+    """链接字段存储为DBRef，取出被引用文档的ID"""
+    if isinstance(ref, DBRef):
+        return ref.id
+    if isinstance(ref, dict):
+        return ref.get("$id") or ref.get("_id")
+    return ref
+
+
+async def _find_by_ids(collection: Any, ids: Iterable[Any], projection: Dict[str, int]) -> Dict[Any, Dict[str, Any]]:
+    """按ID批量读取文档"""
+    ids = list(set(ids))
+    if not ids:
+        return {}
+    documents = await collection.find({"_id": {"$in": ids}}, projection).to_list(length=None)
+    return {document["_id"]: document for document in documents}
+
+
+async def started_story_ids(user_id: str) -> List[ObjectId]:
+    """用户已开始对话的故事ID，按首次开始的顺序去重"""
+    conversations = await Conversation.get_motor_collection().find(
+        {"user_id": user_id}, {"story": 1}
+    ).to_list(length=None)
+    story_ids = (_ref_id(conversation.get("story")) for conversation in conversations)
+    return list(dict.fromkeys(story_id for story_id in story_ids if story_id is not None))
+
+
+async def find_feed_stories(query: Dict[str, Any], skip: int, limit: int) -> List[Dict[str, Any]]:
+    """按条件分页读取故事列表需要的字段"""
+    return await Story.get_motor_collection().find(
+        query, STORY_FEED_PROJECTION
+    ).sort("_id", 1).skip(skip).limit(limit).to_list(length=limit)
+
+
+def _build_item(
+    story: Dict[str, Any],
+    characters: Dict[Any, Dict[str, Any]],
+    creators: Dict[str, str],
+    music_urls: Dict[Any, str]
+) -> Dict[str, Any]:
+    """组装一个故事的列表项"""
+    story_characters = [
+        characters[character_id]
+        for character_id in map(_ref_id, story.get("characters", []))
+        if character_id in characters
+    ]
+
+    # 第一个有形象图片的非Narrator角色作为avatar_url
+    avatar_url = None
+    character_icons = []
+    character_details = []
+    for character in story_characters:
+        if character["name"].lower() != "narrator":
+            if avatar_url is None:
+                avatar_url = character.get("image_url")
+            if character.get("icon_url"):
+                character_icons.append(character["icon_url"])
+        character_details.append({
+            "id": str(character["_id"]),
+            "name": character["name"],
+            "description": character.get("description"),
+            "image_url": character.get("image_url"),
+            "icon_url": character.get("icon_url"),
+            "character_type": character.get("character_type", "character")
+        })
+    detail_ids = {detail["id"] for detail in character_details}
+
+    messages = []
+    for message in story.get("opening_messages", []):
+        character_id = message.get("character")
+        if isinstance(character_id, int):
+            # 整数为角色列表中的序号（从1开始）
+            if not 0 < character_id <= len(story_characters):
+                logger.warning("Opening message of story %s references missing character #%s", story["_id"], character_id)
+                continue
+            character_id = str(story_characters[character_id - 1]["_id"])
+        if character_id not in detail_ids:
+            logger.warning("Opening message of story %s references unknown character %s", story["_id"], character_id)
+            continue
+        messages.append({"content": message["content"], "character_id": character_id})
+
+    created_by = story["created_by"]
+    created_at = story.get("created_at")
+    return {
+        "id": str(story["_id"]),
+        "title": story["story_name"],
+        "intro": story.get("generated_background") or "",
+        "messages": messages,
+        "likes": str(story.get("likes", 0)),
+        "rewards": str(story.get("retweet", 0)),  # 使用retweet字段作为rewards
+        "background": story.get("bg_image_url") or "",
+        "date": created_at.strftime("%Y-%m-%d") if created_at else None,
+        "characters": len([c for c in story_characters if c["name"].lower() != "narrator"]),
+        "avatar_url": avatar_url,
+        "characterIcons": character_icons,
+        "characterDetails": character_details,
+        "backgroundMusic": music_urls.get(_ref_id(story.get("background_music"))),
+        "created_by": created_by,
+        "creator_name": creators.get(created_by) or created_by[-8:],
+        "comments_count": str(story.get("comments_count", 0))
+    }
+
+
+async def build_story_feed(stories: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """批量读取关联数据并组装故事列表
+
+    Args:
+        stories: 按 STORY_FEED_PROJECTION 读取的故事原始文档
+
+    Returns:
+        List[Dict[str, Any]]: 与 GetStoriesResponse 字段一致的列表项，处理出错的故事被跳过
+    """
+    characters = await _find_by_ids(
+        Character.get_motor_collection(),
+        (_ref_id(ref) for story in stories for ref in story.get("characters", [])),
+        CHARACTER_FEED_PROJECTION
+    )
+    music = await _find_by_ids(
+        Music.get_motor_collection(),
+        (_ref_id(story.get("background_music")) for story in stories if story.get("background_music")),
+        {"url": 1}
+    )
+    music_urls = {music_id: document.get("url") for music_id, document in music.items()}
+
+    wallets = list({story["created_by"] for story in stories})
+    users = await User.get_motor_collection().find(
+        {"wallet_address": {"$in": wallets}, "wallet_type": "ethereum"},
+        {"wallet_address": 1, "username": 1}
+    ).to_list(length=None) if wallets else []
+    creators = {user["wallet_address"]: user.get("username") for user in users}
+
+    items = []
+    for story in stories:
+        try:
+            items.append(_build_item(story, characters, creators, music_urls))
+        except Exception:
+            logger.exception("Failed to build feed item for story %s", story.get("_id"))
+    return items
+
+
+async def get_unstarted_stories(user_id: str, skip: int, limit: int) -> List[Dict[str, Any]]:
+    """用户未开始对话的故事列表"""
+    started = await started_story_ids(user_id)
+    query = {"_id": {"$nin": started}} if started else {}
+    return await build_story_feed(await find_feed_stories(query, skip, limit))
+
+
+async def get_started_stories(user_id: str, skip: int, limit: int) -> List[Dict[str, Any]]:
+    """用户已开始对话的故事列表"""
+    started = await started_story_ids(user_id)
+    if not started:
+        return []
+    return await build_story_feed(await find_feed_stories({"_id": {"$in": started}}, skip, limit))
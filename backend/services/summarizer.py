@@ -0,0 +1,142 @@
+"""对话滚动摘要
+
+把滑出历史窗口的消息在后台分批合并到 Conversation.current_context 中，
+Conversation.summary_sequence 记录已合并的最后一条消息序号，每条消息只会被合并一次。
+生成提示词时以摘要代替更早的历史消息，提示词长度不随对话变长而增长。
+"""
+import asyncio
+import logging
+from datetime import datetime
+from typing import Dict, List, Optional, Set
+
+from beanie import PydanticObjectId
+
+from config.settings import settings
+from models.chat import HistoryMessage
+from models.conversation import Conversation
+from models.conversation_message import ConversationMessage
+from services.chat import ChatService
+
+logger = logging.getLogger(__name__)
+
+
+class ConversationSummarizer:
+    """对话摘要生成器"""
+
+    def __init__(self):
+        self._tasks: Dict[PydanticObjectId, asyncio.Task] = {}
+        self._pending: Set[PydanticObjectId] = set()  # 生成期间又有新消息的对话
+        self._history_starts: Dict[PydanticObjectId, int] = {}  # 对话最近一次提示词的历史窗口起点
+        self._semaphore = asyncio.Semaphore(settings.SUMMARY_MAX_CONCURRENT)
+        self.summarized = 0
+        self.failures = 0
+
+    @staticmethod
+    def unsummarized(conversation: Conversation, messages: List[HistoryMessage]) -> List[HistoryMessage]:
+        """去掉已合并到摘要中的历史消息
+
+        Args:
+            conversation: 对话
+            messages: 客户端提交的历史消息
+
+        Returns:
+            List[HistoryMessage]: 序号大于摘要高水位的消息
+        """
+        return [msg for msg in messages if msg.sequence > conversation.summary_sequence]
+
+    def schedule(self, conversation_id: PydanticObjectId, history_start: Optional[int]):
+        """在后台更新对话摘要，同一对话同时只有一个任务
+
+        Args:
+            conversation_id: 对话ID
+            history_start: 刚生成的提示词中历史窗口的起点（见 ChatService.history_start），
+                只有序号更小、已不在提示词中的消息会被合并；为空时不需要合并
+        """
+        if not settings.SUMMARY_ENABLED or history_start is None:
+            return
+        self._history_starts[conversation_id] = history_start
+        if conversation_id in self._tasks:
+            self._pending.add(conversation_id)
+            return
+        task = asyncio.create_task(self._run(conversation_id))
+        self._tasks[conversation_id] = task
+        task.add_done_callback(lambda _: self._done(conversation_id))
+
+    def _done(self, conversation_id: PydanticObjectId):
+        self._tasks.pop(conversation_id, None)
+        if conversation_id in self._pending:
+            self._pending.discard(conversation_id)
+            self.schedule(conversation_id, self._history_starts.get(conversation_id))
+        else:
+            self._history_starts.pop(conversation_id, None)
+
+    async def _run(self, conversation_id: PydanticObjectId):
+        try:
+            async with self._semaphore:
+                while await self.summarize(conversation_id, self._history_starts[conversation_id]):
+                    pass
+        except Exception:
+            self.failures += 1
+            logger.exception("Failed to summarize conversation %s", conversation_id)
+
+    async def summarize(self, conversation_id: PydanticObjectId, history_start: int) -> bool:
+        """把滑出历史窗口的一批消息合并到摘要中
+
+        Args:
+            conversation_id: 对话ID
+            history_start: 提示词中历史窗口的起点，由生成回复时实际装入的历史消息决定
+
+        Returns:
+            bool: 是否合并了消息，为True时可能还有剩余的消息需要合并
+        """
+        conversation = await Conversation.get(conversation_id)
+        if not conversation:
+            return False
+
+        messages = await ConversationMessage.find(
+            conversation.message_filter(after=conversation.summary_sequence, before=history_start)
+        ).sort(+ConversationMessage.sequence).limit(settings.SUMMARY_BATCH_MESSAGES).to_list()
+        if len(messages) < settings.SUMMARY_MIN_MESSAGES:
+            return False
+
+        summary = await ChatService().summarize_messages(conversation.current_context, messages)
+        high_water = messages[-1].sequence
+
+        # 只在高水位未被其他worker推进、分支未切换时写入，避免重复合并
+        result = await Conversation.find_one({
+            "_id": conversation.id,
+            "summary_sequence": conversation.summary_sequence,
+            **conversation.branch_guard()
+        }).update({"$set": {
+            "current_context": summary,
+            "summary_sequence": high_water,
+            "updated_at": datetime.utcnow()
+        }})
+        if not result or not result.modified_count:
+            return False
+
+        self.summarized += len(messages)
+        logger.info(
+            "Summarized conversation %s up to sequence %s (%s messages)",
+            conversation.id, high_water, len(messages)
+        )
+        return True
+
+    async def stop(self):
+        """停止所有摘要任务"""
+        tasks = list(self._tasks.values())
+        self._pending.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "running": len(self._tasks),
+            "summarized_messages": self.summarized,
+            "failures": self.failures,
+        }
+
+
+# 创建全局实例
+conversation_summarizer = ConversationSummarizer()
@@ -0,0 +1,238 @@
+"""对话轮次服务
+
+在一次请求内完成说话角色选择与所有角色回复的生成，按顺序通过一个流输出
+"""
+from dataclasses import dataclass, field
+from typing import AsyncGenerator, Dict, List, Optional, Tuple
+
+from models.character import Character
+from models.chat import HistoryMessage
+from services.chat import ChatService
+from services.speaker_selection import SpeakerDecision, SpeakerSelectionContext
+from services.speculation import BufferedStream, speculation_manager
+from config.settings import settings
+
+
+@dataclass
+class TurnEvent:
+    """对话轮次事件
+
+    type:
+        - speakers: 角色选择完成，speakers为本轮说话角色列表
+        - chunk: 角色回复片段
+        - end: 角色回复完成，content为完整回复
+
+    同一角色可能在一轮中多次说话，chunk 和 end 的 index 为回复在本轮中的位置（从0开始）
+    """
+    type: str
+    speaker: Optional[str] = None
+    index: Optional[int] = None
+    content: str = ""
+    speakers: List[str] = field(default_factory=list)
+    strategy: Optional[str] = None
+
+
+class TurnService:
+    """对话轮次服务"""
+
+    def __init__(
+        self,
+        chat_service: Optional[ChatService] = None,
+        summary: Optional[str] = None,
+        story_context: Optional[str] = None
+    ):
+        """初始化对话轮次服务
+
+        Args:
+            chat_service: 对话服务
+            summary: 对话在历史消息之前的剧情摘要
+            story_context: 故事背景和角色列表
+        """
+        self.chat_service = chat_service or ChatService()
+        self.summary = summary
+        self.story_context = story_context
+
+    def _reply_stream(
+        self,
+        character: Character,
+        history_length: int,
+        history_messages: List[HistoryMessage],
+        user_message: str,
+        preceding_replies: List[Tuple[str, str]]
+    ) -> AsyncGenerator[str, None]:
+        """创建角色回复生成器"""
+        return self.chat_service.generate_character_response(
+            character_name=character.name,
+            character_system_prompt=character.system_prompt,
+            history_length=history_length,
+            history_messages=history_messages,
+            user_message=user_message,
+            preceding_replies=preceding_replies,
+            summary=self.summary,
+            story_context=self.story_context
+        )
+
+    async def _pipelined_stream(
+        self,
+        character: Character,
+        history_length: int,
+        history_messages: List[HistoryMessage],
+        user_message: str,
+        previous: List[BufferedStream]
+    ) -> AsyncGenerator[str, None]:
+        """等待之前角色的回复生成完成后，以其内容作为前文生成回复"""
+        preceding_replies = [(stream.speaker, await stream.result) for stream in previous]
+        async for chunk in self._reply_stream(
+            character, history_length, history_messages, user_message, preceding_replies
+        ):
+            yield chunk
+
+    def _start_concurrent(
+        self,
+        speakers: List[str],
+        characters: Dict[str, Character],
+        history_length: int,
+        history_messages: List[HistoryMessage],
+        user_message: str,
+        committed: Optional[BufferedStream],
+        pipelined: bool
+    ) -> List[BufferedStream]:
+        """同时启动所有角色的回复生成
+
+        pipelined为True时，每个角色在之前角色的回复生成完成后才开始，并能看到这些回复；
+        否则所有角色立即独立生成
+        """
+        streams: List[BufferedStream] = []
+        for index, name in enumerate(speakers):
+            if index == 0 and committed:
+                streams.append(committed)
+                continue
+            if pipelined:
+                source = self._pipelined_stream(
+                    characters[name], history_length, history_messages, user_message, list(streams)
+                )
+            else:
+                source = self._reply_stream(
+                    characters[name], history_length, history_messages, user_message, []
+                )
+            streams.append(BufferedStream(name, source, settings.TURN_MAX_BUFFERED_CHUNKS))
+        return streams
+
+    async def run(
+        self,
+        history_length: int,
+        history_messages: List[HistoryMessage],
+        user_message: str,
+        characters: Dict[str, Character],
+        speculative: bool = False,
+        concurrent: bool = False,
+        pipelined: bool = False,
+        planned: Optional[List[str]] = None,
+        completed: Optional[Dict[int, str]] = None
+    ) -> AsyncGenerator[TurnEvent, None]:
+        """执行一个对话轮次
+
+        客户端重试中断的轮次时传入 planned 和 completed：不再选择说话角色，
+        已保存的回复直接输出，只依次生成缺少的回复
+
+        Args:
+            history_length: 历史消息长度限制
+            history_messages: 历史消息列表
+            user_message: 用户输入的消息
+            characters: 故事中的角色，以角色名称为键
+            speculative: 是否在角色选择的同时推测生成第一个角色的回复
+            concurrent: 是否同时生成所有角色的回复，输出仍按角色顺序
+            pipelined: 并行模式下，后面的角色是否等待并参考之前角色的回复
+            planned: 之前已经选定的本轮说话角色
+            completed: 已经保存的回复，以回复在本轮中的位置为键
+
+        Yields:
+            TurnEvent: 对话轮次事件
+        """
+        ctx = SpeakerSelectionContext(
+            history_length=history_length,
+            history_messages=history_messages,
+            user_message=user_message,
+            character_names=list(characters),
+            summary=self.summary
+        )
+
+        completed = completed or {}
+        if planned is not None:
+            # 续写时按原顺序生成，不推测也不并行
+            speculative = concurrent = False
+
+        # 推测第一个说话角色，与角色选择并行生成
+        stream = None
+        if speculative:
+            predicted = speculation_manager.predict_speaker(ctx)
+            if predicted in characters:
+                stream = speculation_manager.start(
+                    predicted,
+                    lambda: self._reply_stream(
+                        characters[predicted], history_length, history_messages, user_message, []
+                    )
+                )
+
+        committed = None
+        resolved = False
+        streams: List[BufferedStream] = []
+        try:
+            if planned is not None:
+                decision = SpeakerDecision(speakers=planned, strategy="resume")
+            else:
+                decision = await self.chat_service.select_next_speakers_decision(
+                    history_length=history_length,
+                    history_messages=history_messages,
+                    user_message=user_message,
+                    character_names=ctx.character_names,
+                    summary=self.summary
+                )
+
+            speakers = [name for name in decision.speakers if name in characters]
+            if stream:
+                resolved = True
+                if await speculation_manager.resolve(stream, speakers[0] if speakers else None):
+                    committed = stream
+
+            yield TurnEvent(type="speakers", speakers=speakers, strategy=decision.strategy)
+
+            if concurrent:
+                streams = self._start_concurrent(
+                    speakers, characters, history_length, history_messages,
+                    user_message, committed, pipelined
+                )
+
+            replies: List[Tuple[str, str]] = []
+            for index, name in enumerate(speakers):
+                if index in completed:
+                    content = completed[index]
+                    replies.append((name, content))
+                    yield TurnEvent(type="chunk", speaker=name, index=index, content=content)
+                    yield TurnEvent(type="end", speaker=name, index=index, content=content)
+                    continue
+                if streams:
+                    source = streams[index].commit()
+                elif index == 0 and committed:
+                    source = committed.commit()
+                else:
+                    source = self._reply_stream(
+                        characters[name], history_length, history_messages, user_message, list(replies)
+                    )
+
+                full_response = ""
+                async for chunk in source:
+                    full_response += chunk
+                    yield TurnEvent(type="chunk", speaker=name, index=index, content=chunk)
+
+                replies.append((name, full_response))
+                yield TurnEvent(type="end", speaker=name, index=index, content=full_response)
+        finally:
+            # 此处可能正处于取消（客户端断开）中，不能再等待，全部同步清理
+            # 角色选择失败或被取消时推测流尚未确认，需要放弃并释放预算
+            if stream and not resolved:
+                speculation_manager.abandon(stream)
+            # 已启动但未被消费的回复流需要停止
+            for pending in [committed, *streams]:
+                if pending:
+                    pending.cancel_nowait()
@@ -0,0 +1,502 @@
+"""上游LLM调用容错
+
+为每个 llm_id 维护熔断器（按错误率和慢调用率触发），失败时以带抖动的指数退避
+切换到同类型的其他模型，并可在超过 p95 延迟后发起对冲请求。
+"""
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from contextlib import suppress
+from contextvars import ContextVar
+from typing import Any, AsyncGenerator, Awaitable, Callable, Deque, Dict, List, Optional, Tuple, TypeVar
+
+from config.settings import settings
+from models.llm import LLM
+from services.llm_router import llm_router
+from services.rate_limiter import RateLimitTimeout, rate_limiter
+from utils.metrics import upstream_request_duration_seconds
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# 不会因为换一个模型而成功的错误状态码，不重试也不计入熔断
+NON_RETRYABLE_STATUS = {400, 404, 413, 422}
+
+_EMPTY = object()  # 空流标记
+
+# 当前尝试的计时起点，只在 _attempt 的任务内有效
+_attempt_started: ContextVar[Optional[List[float]]] = ContextVar("upstream_attempt_started", default=None)
+
+
+def mark_upstream_start():
+    """把当前尝试的计时起点重置为现在
+
+    发起调用的函数在拿到本地限流许可后调用，排队等待的时间不计入上游延迟，
+    避免本地拥塞触发熔断、拉高对冲延迟和路由的延迟统计
+    """
+    started = _attempt_started.get()
+    if started is not None:
+        started[0] = time.monotonic()
+
+
+class CircuitOpenError(Exception):
+    """所有候选模型都被熔断器拒绝，没有发出请求"""
+    status_code = 503
+
+    def __init__(self, llm_type: str, retry_after: float):
+        super().__init__(f"All upstream models of type {llm_type} are unavailable (circuit open)")
+        self.llm_type = llm_type
+        self.retry_after = retry_after
+
+
+def is_retryable(error: Exception) -> bool:
+    """判断错误是否值得切换模型重试
+
+    Args:
+        error: 调用时抛出的异常
+
+    Returns:
+        bool: 是否可重试
+    """
+    status_code = getattr(error, "status_code", None)
+    return status_code not in NON_RETRYABLE_STATUS
+
+
+def backoff_delay(attempt: int) -> float:
+    """计算带完全抖动的指数退避时间
+
+    Args:
+        attempt: 已失败的次数，从0开始
+
+    Returns:
+        float: 等待秒数
+    """
+    cap = min(settings.UPSTREAM_BACKOFF_MAX, settings.UPSTREAM_BACKOFF_BASE * (2 ** attempt))
+    return random.uniform(0, cap)
+
+
+class CircuitBreaker:
+    """单个上游模型的熔断器
+
+    在最近 window_size 次调用中，错误率或慢调用率超过阈值时断开，
+    断开 open_seconds 后进入半开状态，只放行一个探测请求
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, llm_id: str):
+        self.llm_id = llm_id
+        self.state = self.CLOSED
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.outcomes: Deque[Tuple[bool, Optional[float]]] = deque(maxlen=settings.UPSTREAM_BREAKER_WINDOW)
+
+    def available(self) -> bool:
+        """是否可能放行请求（不改变状态）"""
+        if self.state == self.OPEN:
+            return time.monotonic() - self.opened_at >= settings.UPSTREAM_BREAKER_OPEN_SECONDS
+        if self.state == self.HALF_OPEN:
+            return not self.probe_in_flight
+        return True
+
+    def allow(self) -> bool:
+        """申请放行一个请求"""
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < settings.UPSTREAM_BREAKER_OPEN_SECONDS:
+                return False
+            self.state = self.HALF_OPEN
+            self.probe_in_flight = False
+        if self.state == self.HALF_OPEN:
+            if self.probe_in_flight:
+                return False
+            self.probe_in_flight = True
+        return True
+
+    def record_success(self, latency: float):
+        """记录一次成功调用及其延迟（流式调用为首个片段的延迟）"""
+        if self.state == self.HALF_OPEN:
+            logger.info("Circuit closed: llm_id=%s", self.llm_id)
+            self.state = self.CLOSED
+            self.probe_in_flight = False
+            self.outcomes.clear()
+        self.outcomes.append((True, latency))
+        self._evaluate()
+
+    def record_failure(self):
+        """记录一次失败调用"""
+        self.outcomes.append((False, None))
+        if self.state == self.HALF_OPEN:
+            self._open()
+            return
+        self._evaluate()
+
+    def p95_latency(self) -> Optional[float]:
+        """最近成功调用的p95延迟"""
+        latencies = sorted(latency for ok, latency in self.outcomes if ok)
+        if len(latencies) < settings.UPSTREAM_BREAKER_MIN_CALLS:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+
+    def retry_after(self) -> float:
+        """距离断开状态结束、可以再次探测的秒数"""
+        if self.state != self.OPEN:
+            return 0.0
+        return max(0.0, settings.UPSTREAM_BREAKER_OPEN_SECONDS - (time.monotonic() - self.opened_at))
+
+    def release_probe(self):
+        """探测请求没有记录成功或失败就结束时（被取消、本地限流超时、不可重试的错误）放回探测机会"""
+        if self.state == self.HALF_OPEN:
+            self.probe_in_flight = False
+
+    def _evaluate(self):
+        """根据窗口内的结果判断是否需要断开"""
+        if self.state != self.CLOSED or len(self.outcomes) < settings.UPSTREAM_BREAKER_MIN_CALLS:
+            return
+        total = len(self.outcomes)
+        failures = sum(1 for ok, _ in self.outcomes if not ok)
+        slow_calls = sum(
+            1 for ok, latency in self.outcomes
+            if ok and latency is not None and latency >= settings.UPSTREAM_BREAKER_SLOW_CALL_SECONDS
+        )
+        if (failures / total >= settings.UPSTREAM_BREAKER_FAILURE_RATE
+                or slow_calls / total >= settings.UPSTREAM_BREAKER_SLOW_CALL_RATE):
+            self._open()
+
+    def _open(self):
+        logger.warning("Circuit opened: llm_id=%s", self.llm_id)
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+        self.probe_in_flight = False
+
+    def stats(self) -> Dict[str, Any]:
+        """熔断器状态"""
+        total = len(self.outcomes)
+        failures = sum(1 for ok, _ in self.outcomes if not ok)
+        return {
+            "state": self.state,
+            "window_calls": total,
+            "error_rate": failures / total if total else 0.0,
+            "p95_latency": self.p95_latency(),
+        }
+
+
+class UpstreamManager:
+    """上游LLM调用管理
+
+    所有对 LLM 的调用通过 call / stream 发起，由这里负责选模型、熔断、退避重试和对冲
+    """
+
+    def __init__(self):
+        self.breakers: Dict[str, CircuitBreaker] = {}
+
+    def breaker(self, llm_id: str) -> CircuitBreaker:
+        """获取指定模型的熔断器"""
+        if llm_id not in self.breakers:
+            self.breakers[llm_id] = CircuitBreaker(llm_id)
+        return self.breakers[llm_id]
+
+    async def candidates(self, llm_type: str, preferred: Optional[LLM] = None) -> List[LLM]:
+        """获取可用的同类型模型，指定的模型排在最前，其余按 llm_router 的选择排列
+
+        Args:
+            llm_type: 模型类型
+            preferred: 优先使用的模型
+
+        Returns:
+            List[LLM]: 候选模型列表，熔断中的模型被排除
+        """
+        models = llm_router.rank(await llm_router.models(llm_type))
+        if preferred:
+            models = [preferred] + [m for m in models if m.llm_id != preferred.llm_id]
+        available = [m for m in models if self.breaker(m.llm_id).available()]
+        if not available and models:
+            # 全部熔断时仍返回第一个模型，由 _call 经熔断器判断后抛出 CircuitOpenError
+            available = models[:1]
+        return available
+
+    def _hedge_delay(self, llm: LLM) -> Optional[float]:
+        """对冲请求的等待时间，未启用或数据不足时返回None"""
+        if not settings.UPSTREAM_HEDGE_ENABLED:
+            return None
+        p95 = self.breaker(llm.llm_id).p95_latency()
+        if p95 is None:
+            return None
+        return max(p95, settings.UPSTREAM_HEDGE_MIN_DELAY)
+
+    async def _attempt(
+        self,
+        llm: LLM,
+        start: Callable[[LLM], Awaitable[T]],
+        probe: bool = False
+    ) -> T:
+        """对单个模型发起一次调用并记录到熔断器
+
+        Args:
+            llm: 模型
+            start: 发起调用的函数
+            probe: 是否为半开状态下的探测请求
+        """
+        breaker = self.breaker(llm.llm_id)
+        started = [time.monotonic()]  # 由 mark_upstream_start() 在拿到限流许可后重置
+        token = _attempt_started.set(started)
+        try:
+            result = await start(llm)
+        except (asyncio.CancelledError, RateLimitTimeout):
+            # 本地限流排队超时不是上游故障，不计入熔断
+            if probe:
+                breaker.release_probe()
+            raise
+        except Exception as e:
+            upstream_request_duration_seconds.labels(llm_id=llm.llm_id, outcome="error").observe(
+                time.monotonic() - started[0]
+            )
+            if is_retryable(e):
+                breaker.record_failure()
+                llm_router.record(llm.llm_id, None, ok=False)
+            elif probe:
+                breaker.release_probe()
+            if getattr(e, "status_code", None) == 429:
+                response = getattr(e, "response", None)
+                llm_router.observe_rate_limited(llm.llm_id, getattr(response, "headers", None))
+            raise
+        finally:
+            _attempt_started.reset(token)
+        latency = time.monotonic() - started[0]
+        upstream_request_duration_seconds.labels(llm_id=llm.llm_id, outcome="ok").observe(latency)
+        breaker.record_success(latency)
+        llm_router.record(llm.llm_id, latency, ok=True)
+        return result
+
+    async def _hedged(
+        self,
+        primary: LLM,
+        backup: Optional[LLM],
+        start: Callable[[LLM], Awaitable[T]],
+        probe: bool = False,
+        discard: Optional[Callable[[LLM, T], Awaitable[None]]] = None
+    ) -> Tuple[LLM, T]:
+        """发起调用，超过对冲等待时间仍未完成时向备用模型发起第二个请求，取先成功的结果
+
+        两个请求都成功时（同时完成，或取消前已经完成），没有使用的结果交给 discard 释放
+        """
+        winner = None
+        tasks: Dict[asyncio.Task, LLM] = {
+            asyncio.create_task(self._attempt(primary, start, probe)): primary
+        }
+        delay = self._hedge_delay(primary) if backup else None
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                backup_breaker = self.breaker(backup.llm_id)
+                if not done and backup_breaker.allow():
+                    logger.info("Hedging request: primary=%s backup=%s", primary.llm_id, backup.llm_id)
+                    backup_probe = backup_breaker.state == backup_breaker.HALF_OPEN
+                    tasks[asyncio.create_task(self._attempt(backup, start, backup_probe))] = backup
+
+            last_error = None
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        return tasks[task], task.result()
+                    last_error = task.exception()
+            raise last_error
+        finally:
+            for task in tasks:
+                if task is winner:
+                    continue
+                if not task.done():
+                    task.cancel()
+                    with suppress(asyncio.CancelledError, Exception):
+                        await task
+                if discard and not task.cancelled() and task.exception() is None:
+                    with suppress(Exception):
+                        await discard(tasks[task], task.result())
+
+    @staticmethod
+    def _queue_deadline() -> float:
+        """等待上游限额的截止时间，同一次调用的所有候选模型共用"""
+        return time.monotonic() + settings.UPSTREAM_QUEUE_TIMEOUT_SECONDS
+
+    @staticmethod
+    def _estimate_tokens(llm: LLM, prompt_tokens: int) -> int:
+        """预估一次调用消耗的token数，用于TPM限额"""
+        return prompt_tokens + (llm.settings.max_tokens or 0)
+
+    async def call(
+        self,
+        llm_type: str,
+        fn: Callable[[LLM], Awaitable[T]],
+        preferred: Optional[LLM] = None,
+        prompt_tokens: int = 0
+    ) -> Tuple[LLM, T]:
+        """调用上游模型，失败时退避后切换到同类型的其他模型
+
+        Args:
+            llm_type: 模型类型
+            fn: 使用指定模型发起调用的函数
+            preferred: 优先使用的模型
+            prompt_tokens: 预估的输入token数
+
+        Returns:
+            Tuple[LLM, T]: 实际使用的模型和调用结果
+
+        Raises:
+            RateLimitTimeout: 所有候选模型都没有在截止时间内获得限额
+            CircuitOpenError: 所有候选模型都处于熔断中
+            Exception: 所有尝试都失败时抛出最后一个错误
+        """
+        deadline = self._queue_deadline()
+
+        async def tracked(llm: LLM) -> T:
+            release = await rate_limiter.acquire(llm, self._estimate_tokens(llm, prompt_tokens), deadline)
+            mark_upstream_start()
+            llm_router.acquire(llm.llm_id)
+            try:
+                return await fn(llm)
+            finally:
+                llm_router.release(llm.llm_id)
+                release()
+
+        return await self._call(llm_type, tracked, preferred)
+
+    async def _call(
+        self,
+        llm_type: str,
+        fn: Callable[[LLM], Awaitable[T]],
+        preferred: Optional[LLM] = None,
+        discard: Optional[Callable[[LLM, T], Awaitable[None]]] = None
+    ) -> Tuple[LLM, T]:
+        """依次尝试候选模型，失败时退避后切换
+
+        Args:
+            llm_type: 模型类型
+            fn: 使用指定模型发起调用的函数
+            preferred: 优先使用的模型
+            discard: 释放对冲中成功但没有使用的结果
+
+        Returns:
+            Tuple[LLM, T]: 实际使用的模型和调用结果
+
+        Raises:
+            CircuitOpenError: 所有候选模型都被熔断器拒绝，没有发出任何请求
+            Exception: 所有尝试都失败时抛出最后一个错误
+        """
+        candidates = await self.candidates(llm_type, preferred)
+        if not candidates:
+            raise ValueError(f"No available LLM model found for type: {llm_type}")
+
+        last_error = None
+        attempt = 0
+        index = 0
+        refused = 0  # 连续被熔断器拒绝的候选数，一轮候选都被拒绝时停止
+        while attempt < settings.UPSTREAM_MAX_ATTEMPTS and refused < len(candidates):
+            llm = candidates[index % len(candidates)]
+            index += 1
+            breaker = self.breaker(llm.llm_id)
+            if not breaker.allow():
+                # 被熔断器拒绝的候选直接跳过，不占用尝试次数；只有一个候选时同样不发出请求
+                refused += 1
+                continue
+            refused = 0
+            probe = breaker.state == breaker.HALF_OPEN
+            backup = candidates[index % len(candidates)] if len(candidates) > 1 else None
+            try:
+                return await self._hedged(llm, backup, fn, probe, discard)
+            except Exception as e:
+                last_error = e
+                logger.warning(
+                    "Upstream call failed: llm_id=%s attempt=%d error=%s",
+                    llm.llm_id, attempt + 1, e
+                )
+                if not is_retryable(e):
+                    raise
+                # 限流排队超时直接切换到下一个模型，不需要退避
+                if not isinstance(e, RateLimitTimeout):
+                    await asyncio.sleep(backoff_delay(attempt))
+            attempt += 1
+        if last_error is None:
+            raise CircuitOpenError(
+                llm_type, min(self.breaker(llm.llm_id).retry_after() for llm in candidates)
+            )
+        raise last_error
+
+    async def stream(
+        self,
+        llm_type: str,
+        fn: Callable[[LLM], AsyncGenerator[T, None]],
+        preferred: Optional[LLM] = None,
+        prompt_tokens: int = 0
+    ) -> AsyncGenerator[T, None]:
+        """流式调用上游模型
+
+        在收到第一个片段之前可以切换模型和对冲，之后的错误直接抛出，避免重复输出
+
+        Args:
+            llm_type: 模型类型
+            fn: 使用指定模型创建流的函数
+            preferred: 优先使用的模型
+            prompt_tokens: 预估的输入token数
+
+        Yields:
+            T: 流中的片段
+        """
+        deadline = self._queue_deadline()
+        async def open_stream(llm: LLM) -> Tuple[AsyncGenerator[T, None], Any, Optional[Callable[[], None]]]:
+            # 并发许可和进行中的请求数覆盖整个流，成功打开后连同流一起返回，由使用方在流结束时释放
+            release = await rate_limiter.acquire(llm, self._estimate_tokens(llm, prompt_tokens), deadline)
+            mark_upstream_start()
+            llm_router.acquire(llm.llm_id)
+            gen = fn(llm)
+            try:
+                first = await gen.__anext__()
+            except BaseException as e:
+                llm_router.release(llm.llm_id)
+                release()
+                if isinstance(e, StopAsyncIteration):
+                    return gen, _EMPTY, None
+                with suppress(Exception):
+                    await gen.aclose()
+                raise
+            return gen, first, release
+
+        async def close_stream(llm: LLM, opened: Tuple[AsyncGenerator[T, None], Any, Optional[Callable[[], None]]]):
+            # 对冲中落选的流：释放许可和进行中的请求数并关闭
+            gen, _, release = opened
+            if release is None:
+                return
+            llm_router.release(llm.llm_id)
+            release()
+            await gen.aclose()
+
+        llm, (gen, first, release) = await self._call(llm_type, open_stream, preferred, close_stream)
+        if first is _EMPTY:
+            return
+        try:
+            yield first
+            async for item in gen:
+                yield item
+        except Exception as e:
+            if is_retryable(e):
+                self.breaker(llm.llm_id).record_failure()
+                llm_router.record(llm.llm_id, None, ok=False)
+            raise
+        finally:
+            llm_router.release(llm.llm_id)
+            release()
+            with suppress(Exception):
+                await gen.aclose()
+
+    def stats(self) -> Dict[str, Any]:
+        """所有模型的熔断器状态"""
+        return {llm_id: breaker.stats() for llm_id, breaker in self.breakers.items()}
+
+
+# 创建全局实例
+upstream_manager = UpstreamManager()
@@ -0,0 +1,197 @@
+"""模型与API密钥的使用量统计
+
+调用成功后只在内存中累加使用次数和token数，由后台任务定期以
+$inc/$max 的 bulk_write 批量写入，避免每次调用都整文档 save 以及并发覆盖丢失计数。
+"""
+import asyncio
+import logging
+from contextlib import suppress
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from config.settings import settings
+from models.api_key import APIKey
+from models.llm import LLM
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class UsageDelta:
+    """尚未写入数据库的使用量"""
+    requests: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    total_tokens: int = 0
+    cached_tokens: int = 0
+    last_used: Optional[datetime] = None
+
+    def merge(self, other: "UsageDelta"):
+        """合并另一份使用量"""
+        self.requests += other.requests
+        self.prompt_tokens += other.prompt_tokens
+        self.completion_tokens += other.completion_tokens
+        self.total_tokens += other.total_tokens
+        self.cached_tokens += other.cached_tokens
+        if other.last_used and (not self.last_used or other.last_used > self.last_used):
+            self.last_used = other.last_used
+
+
+def _field(data: Any, name: str) -> Any:
+    """读取 dict 或 openai 对象的字段"""
+    if data is None:
+        return None
+    return data.get(name) if isinstance(data, dict) else getattr(data, name, None)
+
+
+def usage_value(usage: Any, name: str) -> int:
+    """从上游返回的 usage（dict 或 openai 对象）中读取token数"""
+    return int(_field(usage, name) or 0)
+
+
+def cached_prompt_tokens(usage: Any) -> int:
+    """命中上游前缀缓存的输入token数
+
+    DeepSeek 返回 prompt_cache_hit_tokens，OpenAI 返回 prompt_tokens_details.cached_tokens
+    """
+    hit = _field(usage, "prompt_cache_hit_tokens")
+    if hit is None:
+        hit = _field(_field(usage, "prompt_tokens_details"), "cached_tokens")
+    return int(hit or 0)
+
+
+class UsageAggregator:
+    """使用量聚合器"""
+
+    def __init__(self):
+        self._llms: Dict[str, UsageDelta] = {}
+        self._api_keys: Dict[str, UsageDelta] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    def record_llm(self, llm_id: str, usage: Any = None):
+        """记录一次模型调用
+
+        Args:
+            llm_id: 模型ID
+            usage: 上游返回的 usage 字段，可为空
+        """
+        delta = self._llms.setdefault(llm_id, UsageDelta())
+        delta.requests += 1
+        delta.last_used = datetime.utcnow()
+        self.record_tokens(llm_id, usage)
+
+    def record_tokens(self, llm_id: str, usage: Any):
+        """只记录token数，用于流式响应末尾返回的 usage
+
+        Args:
+            llm_id: 模型ID
+            usage: 上游返回的 usage 字段
+        """
+        if usage is None:
+            return
+        delta = self._llms.setdefault(llm_id, UsageDelta())
+        delta.prompt_tokens += usage_value(usage, "prompt_tokens")
+        delta.completion_tokens += usage_value(usage, "completion_tokens")
+        delta.total_tokens += usage_value(usage, "total_tokens")
+        delta.cached_tokens += cached_prompt_tokens(usage)
+
+    def record_api_key(self, key: str):
+        """记录一次API密钥使用
+
+        Args:
+            key: API密钥
+        """
+        delta = self._api_keys.setdefault(key, UsageDelta())
+        delta.requests += 1
+        delta.last_used = datetime.utcnow()
+
+    def pending_api_key_requests(self, key: str) -> int:
+        """API密钥尚未写入数据库的使用次数"""
+        delta = self._api_keys.get(key)
+        return delta.requests if delta else 0
+
+    @staticmethod
+    def _operations(deltas: Dict[str, UsageDelta], key_field: str, with_tokens: bool) -> List[UpdateOne]:
+        """构建批量更新操作"""
+        operations = []
+        for key, delta in deltas.items():
+            inc = {"usage_count": delta.requests}
+            if with_tokens:
+                inc.update({
+                    "prompt_tokens": delta.prompt_tokens,
+                    "completion_tokens": delta.completion_tokens,
+                    "total_tokens": delta.total_tokens,
+                    "cached_tokens": delta.cached_tokens,
+                })
+            update: Dict[str, Any] = {"$inc": inc}
+            if delta.last_used:
+                update["$max"] = {"last_used": delta.last_used, "updated_at": delta.last_used}
+            operations.append(UpdateOne({key_field: key}, update))
+        return operations
+
+    async def flush(self):
+        """将累积的使用量写入数据库，写入失败的部分放回缓冲区等待下次写入"""
+        async with self._lock:
+            llms, self._llms = self._llms, {}
+            api_keys, self._api_keys = self._api_keys, {}
+
+            for model, deltas, key_field, with_tokens, buffer in (
+                (LLM, llms, "llm_id", True, self._llms),
+                (APIKey, api_keys, "key", False, self._api_keys),
+            ):
+                if not deltas:
+                    continue
+                # 操作与 deltas 的顺序一致，按下标找回写入失败的使用量
+                items = list(deltas.items())
+                try:
+                    await model.get_motor_collection().bulk_write(
+                        self._operations(deltas, key_field, with_tokens),
+                        ordered=False
+                    )
+                    continue
+                except BulkWriteError as e:
+                    # 无序批量写入中其余操作已生效，只放回出错的部分，避免重复计数
+                    failed = sorted({error["index"] for error in e.details.get("writeErrors", [])})
+                    logger.error(
+                        "Failed to flush %d/%d %s usage updates: %s",
+                        len(failed), len(items), model.__name__, e
+                    )
+                    retry = [items[index] for index in failed]
+                except Exception as e:
+                    # 连接失败等情况下没有任何操作生效，全部放回
+                    logger.error("Failed to flush %s usage: %s", model.__name__, e)
+                    retry = items
+                for key, delta in retry:
+                    buffer.setdefault(key, UsageDelta()).merge(delta)
+
+    async def _run(self):
+        """定期写入"""
+        while True:
+            await asyncio.sleep(settings.USAGE_FLUSH_INTERVAL_SECONDS)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error("Usage flush failed: %s", e)
+
+    def start(self):
+        """启动后台写入任务"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """停止后台写入任务，并写入剩余的使用量"""
+        if self._task:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        await self.flush()
+
+
+# 创建全局实例
+usage_aggregator = UsageAggregator()
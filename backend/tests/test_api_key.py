@@ -0,0 +1,36 @@
+"""API密钥轮询的测试"""
+import asyncio
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+BACKEND_DIR = Path(__file__).parent.parent
+sys.path.insert(0, str(BACKEND_DIR))
+
+import models.api_key as api_key  # noqa: E402
+from services.usage import UsageAggregator  # noqa: E402
+
+
+def test_next_available_key_loads_keys_once_and_balances_usage():
+    keys = [SimpleNamespace(key="a", usage_count=3), SimpleNamespace(key="b", usage_count=0)]
+    find = MagicMock()
+
+    async def to_list():
+        return keys
+
+    find.return_value.to_list = to_list
+    api_key._active_keys.invalidate()
+
+    async def pick(count):
+        return [(await api_key.APIKey.get_next_available_key()).key for _ in range(count)]
+
+    with patch.object(api_key.APIKey, "find", find), \
+            patch("services.usage.usage_aggregator", UsageAggregator()):
+        picks = asyncio.run(pick(9))
+
+    # 缓存期间只读取一次数据库，b 先用到与 a 相同的次数后两者交替
+    assert find.call_count == 1
+    assert picks[:3] == ["b", "b", "b"]
+    assert picks.count("a") == 3 and picks.count("b") == 6
+    api_key._active_keys.invalidate()
@@ -0,0 +1,33 @@
+"""日志脱敏的测试"""
+import sys
+from pathlib import Path
+
+import pytest
+
+BACKEND_DIR = Path(__file__).parent.parent
+sys.path.insert(0, str(BACKEND_DIR))
+
+from utils.log import REDACTED, redact  # noqa: E402
+
+
+@pytest.mark.parametrize("text", [
+    "prompt_tokens=1234567 completion_tokens=7654321",
+    "total_tokens: 99999999",
+    '{"max_tokens": 2000000, "token_count": 1234567, "cached_tokens": 1000000}',
+])
+def test_token_usage_is_not_redacted(text):
+    assert redact(text) == text
+
+
+@pytest.mark.parametrize("text, secret", [
+    ("api_key=abcdef123456", "abcdef123456"),
+    ('access_token: "abcdefgh123"', "abcdefgh123"),
+    ("x-api-key=abcdef1234", "abcdef1234"),
+    ("Authorization: Bearer abcdefghijk", "abcdefghijk"),
+    ("password=hunter22", "hunter22"),
+    ("client_secret=abcdefgh", "abcdefgh"),
+])
+def test_secret_values_are_redacted(text, secret):
+    result = redact(text)
+    assert secret not in result
+    assert REDACTED in result
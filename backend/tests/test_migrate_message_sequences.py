@@ -0,0 +1,109 @@
+"""消息序号迁移脚本的测试"""
+import asyncio
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from bson import DBRef, ObjectId
+
+BACKEND_DIR = Path(__file__).parent.parent
+sys.path.insert(0, str(BACKEND_DIR))
+sys.path.insert(0, str(BACKEND_DIR / "scripts"))
+
+import migrate_message_sequences as migration  # noqa: E402
+
+
+class FakeCursor:
+    def __init__(self, documents):
+        self.documents = documents
+
+    async def to_list(self, length=None):
+        return list(self.documents)
+
+
+class FakeResult:
+    def __init__(self, modified_count):
+        self.modified_count = modified_count
+
+
+class FakeCollection:
+    """只实现迁移脚本用到的 find 和 bulk_write，bulk_write 直接作用于内存中的文档"""
+
+    def __init__(self, documents):
+        self.documents = {document["_id"]: document for document in documents}
+
+    def find(self, query, projection=None):
+        return FakeCursor(self.documents.values())
+
+    async def bulk_write(self, operations, ordered=True):
+        modified = 0
+        for operation in operations:
+            document = self.documents.setdefault(operation._filter["_id"], {"_id": operation._filter["_id"]})
+            for field, value in operation._doc["$set"].items():
+                if document.get(field) != value:
+                    document[field] = value
+                    modified += 1
+        return FakeResult(modified)
+
+
+class FakeDatabase:
+    def __init__(self, messages, conversations):
+        self.conversation_messages = FakeCollection(messages)
+        self.conversations = FakeCollection(conversations)
+
+
+def _message(conversation_id, sequence, minutes):
+    message = {
+        "_id": ObjectId(),
+        "conversation": DBRef("conversations", conversation_id),
+        "created_at": datetime(2024, 1, 1) + timedelta(minutes=minutes),
+    }
+    if sequence is not None:
+        message["sequence"] = sequence
+    return message
+
+
+def test_migrate_renumbers_duplicates_and_syncs_last_sequence():
+    clean, duplicated, missing = ObjectId(), ObjectId(), ObjectId()
+    messages = [
+        _message(clean, 1, 0),
+        _message(clean, 2, 1),
+        _message(duplicated, 1, 0),
+        _message(duplicated, 2, 1),
+        _message(duplicated, 2, 2),
+        _message(duplicated, 3, 3),
+        _message(missing, None, 0),
+        _message(missing, 1, 1),
+    ]
+    db = FakeDatabase(messages, [{"_id": clean}, {"_id": duplicated}, {"_id": missing}])
+
+    renumbered, synced = asyncio.run(migration.migrate(db, dry_run=False))
+
+    assert renumbered == 2
+    assert synced == 3
+
+    def sequences(conversation_id):
+        documents = [
+            document for document in db.conversation_messages.documents.values()
+            if document["conversation"].id == conversation_id
+        ]
+        return [document["sequence"] for document in sorted(documents, key=lambda d: d["created_at"])]
+
+    assert sequences(clean) == [1, 2]
+    assert sequences(duplicated) == [1, 2, 3, 4]
+    assert sequences(missing) == [1, 2]
+    assert {c["_id"]: c["last_sequence"] for c in db.conversations.documents.values()} == {
+        clean: 2, duplicated: 4, missing: 2
+    }
+
+
+def test_migrate_dry_run_does_not_write():
+    conversation_id = ObjectId()
+    messages = [_message(conversation_id, 1, 0), _message(conversation_id, 1, 1)]
+    db = FakeDatabase(messages, [{"_id": conversation_id}])
+
+    renumbered, _ = asyncio.run(migration.migrate(db, dry_run=True))
+
+    assert renumbered == 1
+    assert [m["sequence"] for m in db.conversation_messages.documents.values()] == [1, 1]
+    assert "last_sequence" not in db.conversations.documents[conversation_id]
@@ -0,0 +1,140 @@
+"""对话轮次接口在客户端重试时的测试"""
+import asyncio
+import json
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock, patch
+
+BACKEND_DIR = Path(__file__).parent.parent
+sys.path.insert(0, str(BACKEND_DIR))
+
+import routes.story_chat as story_chat  # noqa: E402
+from services.chat import ChatService  # noqa: E402
+
+
+class FakeMessage(SimpleNamespace):
+    """代替 ConversationMessage，只保存字段"""
+    resume_request_messages = AsyncMock()
+
+
+class FakeBuffer:
+    def __init__(self):
+        self.added = []
+        self.started = []
+        self.finished = []
+
+    def add(self, message):
+        self.added.append(message)
+
+    def start(self, message):
+        message.partial = True
+        self.started.append(message)
+        return message
+
+    def update(self, message, content):
+        message.content = content
+
+    def finish(self, message, content):
+        message.content = content
+        message.partial = False
+        self.finished.append(message)
+
+    def discard(self, message):
+        pass
+
+    async def flush(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+def _run_turn(written, generated):
+    """以保存的消息 written 重试请求，返回输出的事件、消息缓冲和生成回复时的参数"""
+    conversation = SimpleNamespace(id="c1", active_branch=0, current_context=None, summary_sequence=0)
+    characters = {name: SimpleNamespace(name=name, system_prompt="") for name in ("A", "B", "C")}
+    buffer = FakeBuffer()
+    calls = []
+
+    async def generate_character_response(self, **kwargs):
+        calls.append(kwargs)
+        for chunk in generated[kwargs["character_name"]]:
+            yield chunk
+
+    FakeMessage.resume_request_messages = AsyncMock(return_value=written)
+    request = story_chat.GenerateTurnRequest(
+        user_message="你好", history_messages=[], conversation_id="c1", request_id="r1"
+    )
+    with patch.object(story_chat, "ConversationMessage", FakeMessage), \
+            patch.object(story_chat.Conversation, "get", AsyncMock(return_value=conversation)), \
+            patch.object(story_chat.Conversation, "allocate_sequences", AsyncMock(side_effect=AssertionError)), \
+            patch.object(story_chat.conversation_archiver, "ensure_hot", AsyncMock()), \
+            patch.object(story_chat, "_get_story", AsyncMock(return_value=SimpleNamespace())), \
+            patch.object(story_chat, "_get_story_characters", AsyncMock(return_value=characters)), \
+            patch.object(story_chat, "story_context", lambda story, characters: ""), \
+            patch.object(story_chat.message_buffer, "open", lambda conversation_id: buffer), \
+            patch.object(story_chat.conversation_summarizer, "schedule", MagicMock()), \
+            patch.object(ChatService, "select_next_speakers_decision", AsyncMock(side_effect=AssertionError)), \
+            patch.object(ChatService, "generate_character_response", generate_character_response):
+
+        async def collect():
+            response = await story_chat.generate_turn(request, current_user=SimpleNamespace())
+            frames = []
+            async for frame in response.body_iterator:
+                frames.append(frame if isinstance(frame, bytes) else frame.encode())
+            return frames
+
+        frames = asyncio.run(collect())
+
+    events = []
+    for frame in frames:
+        for line in frame.decode().splitlines():
+            if line.startswith("data:"):
+                events.append(json.loads(line[len("data:"):]))
+    return events, buffer, calls
+
+
+def test_retry_after_partial_turn_generates_missing_replies():
+    # 第一次请求选定了 A、B、C，只有 A 的回复完整保存，B 中断（部分内容已被删除），C 未开始
+    written = {
+        "r1:user": FakeMessage(content="你好", sequence=10, turn_speakers=["A", "B", "C"]),
+        "r1:1": FakeMessage(content="我是A", character_name="A", sequence=11),
+    }
+    events, buffer, calls = _run_turn(written, {"B": ["我是", "B"], "C": ["我是C"]})
+
+    assert events[0] == {"type": "speakers", "speakers": ["A", "B", "C"], "strategy": "resume"}
+    chunks = {}
+    for event in events:
+        if event["type"] == "chunk":
+            chunks[event["speaker"]] = chunks.get(event["speaker"], "") + event["content"]
+    assert chunks == {"A": "我是A", "B": "我是B", "C": "我是C"}
+    assert [event["speaker"] for event in events if event["type"] == "end"] == ["A", "B", "C"]
+    assert events[-1] == {"type": "done"}
+
+    # 只生成缺少的回复，并以已保存的回复作为前文
+    assert [call["character_name"] for call in calls] == ["B", "C"]
+    assert calls[0]["preceding_replies"] == [("A", "我是A")]
+    assert calls[1]["preceding_replies"] == [("A", "我是A"), ("B", "我是B")]
+
+    # 用户消息不重复写入，缺少的回复使用原来预留的序号
+    assert buffer.added == []
+    assert [(m.character_name, m.sequence, m.request_id, m.content) for m in buffer.finished] == [
+        ("B", 12, "r1:2", "我是B"),
+        ("C", 13, "r1:3", "我是C"),
+    ]
+
+
+def test_retry_after_complete_turn_replays_without_generating():
+    written = {
+        "r1:user": FakeMessage(content="你好", sequence=10, turn_speakers=["A", "B"]),
+        "r1:1": FakeMessage(content="我是A", character_name="A", sequence=11),
+        "r1:2": FakeMessage(content="我是B", character_name="B", sequence=12),
+    }
+    events, buffer, calls = _run_turn(written, {})
+
+    assert calls == []
+    assert buffer.started == []
+    assert events[0]["strategy"] == "replay"
+    assert [event["content"] for event in events if event["type"] == "chunk"] == ["我是A", "我是B"]
+    assert events[-1] == {"type": "done"}
@@ -0,0 +1,61 @@
+"""上游调用容错的测试"""
+import asyncio
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+BACKEND_DIR = Path(__file__).parent.parent
+sys.path.insert(0, str(BACKEND_DIR))
+
+import services.upstream as upstream  # noqa: E402
+from config.settings import settings  # noqa: E402
+
+
+def _llm(llm_id: str):
+    return SimpleNamespace(llm_id=llm_id, settings=SimpleNamespace(max_tokens=0))
+
+
+def test_queue_wait_is_not_recorded_as_upstream_latency():
+    manager = upstream.UpstreamManager()
+    llm = _llm("slow-queue")
+    record = MagicMock()
+
+    async def acquire(*args):
+        await asyncio.sleep(0.3)  # 本地限流排队
+        return lambda: None
+
+    async def request(llm):
+        await asyncio.sleep(0.05)
+        return "ok"
+
+    with patch.object(manager, "candidates", AsyncMock(return_value=[llm])), \
+            patch.object(upstream.rate_limiter, "acquire", acquire), \
+            patch.object(upstream.llm_router, "record", record), \
+            patch.object(settings, "UPSTREAM_HEDGE_ENABLED", False):
+        _, result = asyncio.run(manager.call("chat", request))
+
+    assert result == "ok"
+    latency = record.call_args.args[1]
+    assert 0.05 <= latency < 0.25
+    # 熔断器的慢调用统计同样只看上游耗时
+    assert manager.breaker(llm.llm_id).outcomes[-1] == (True, latency)
+
+
+def test_single_open_circuit_fails_fast():
+    manager = upstream.UpstreamManager()
+    llm = _llm("only-model")
+    breaker = manager.breaker(llm.llm_id)
+    breaker._open()
+    request = AsyncMock(return_value="ok")
+
+    with patch.object(upstream.llm_router, "rank", lambda models: models), \
+            patch.object(upstream.llm_router, "models", AsyncMock(return_value=[llm])):
+        with pytest.raises(upstream.CircuitOpenError) as excinfo:
+            asyncio.run(manager.call("chat", request))
+
+    assert 0 < excinfo.value.retry_after <= settings.UPSTREAM_BREAKER_OPEN_SECONDS
+
+    request.assert_not_called()
@@ -5,6 +5,7 @@ from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 
 from models.user import User
+from utils.tracing import span
 
 security = HTTPBearer()
 
@@ -24,7 +25,8 @@ async def get_current_user(
         HTTPException: 认证失败
     """
     try:
-        user = await User.get_by_token(credentials.credentials)
+        with span("auth"):
+            user = await User.get_by_token(credentials.credentials)
         if not user:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
@@ -1,8 +1,13 @@
+import logging
 import boto3
 from botocore.client import Config
 from config.settings import settings
+from utils.metrics import external_request_duration_seconds
+from utils.tracing import span
 import mimetypes
 
+logger = logging.getLogger(__name__)
+
 class B2Storage:
     """
     Backblaze B2存储工具类
@@ -46,15 +51,19 @@ class B2Storage:
             content_type = mimetypes.guess_type(filename)[0] or f'image/{extension[1:]}'
             
             # 使用put_object直接上传二进制内容
-            self.s3.put_object(
-                Bucket=self.bucket_name,
-                Key=filename,
-                Body=content,
-                ContentType=content_type
-            )
+            with (
+                span("b2.upload", bytes=len(content)),
+                external_request_duration_seconds.labels(service="b2", operation="upload").time()
+            ):
+                self.s3.put_object(
+                    Bucket=self.bucket_name,
+                    Key=filename,
+                    Body=content,
+                    ContentType=content_type
+                )
             return filename
         except Exception as e:
-            print(f"Failed to upload to B2: {str(e)}")
+            logger.error("Failed to upload to B2: %s", e)
             return None
 
     def delete_file(self, filename: str) -> bool:
@@ -74,7 +83,7 @@ class B2Storage:
             )
             return True
         except Exception as e:
-            print(f"Failed to delete from B2: {str(e)}")
+            logger.error("Failed to delete from B2: %s", e)
             return False
 
     def get_url(self, filename: str) -> str:
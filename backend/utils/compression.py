@@ -0,0 +1,55 @@
+"""归档数据的压缩
+
+安装了 zstandard 时使用 zstd，否则使用标准库 zlib。
+压缩结果带有编码名称，解压时按写入时的编码处理，两种编码的归档可以共存。
+"""
+import zlib
+from typing import Tuple
+
+try:
+    import zstandard
+except ImportError:  # zstandard 为可选依赖，未安装时使用zlib
+    zstandard = None
+
+ZSTD = "zstd"
+ZLIB = "zlib"
+
+ZSTD_LEVEL = 10  # 归档写入一次、很少读取，使用较高的压缩级别
+ZLIB_LEVEL = 6
+
+
+def compress(data: bytes) -> Tuple[str, bytes]:
+    """压缩数据
+
+    Args:
+        data: 原始数据
+
+    Returns:
+        Tuple[str, bytes]: 编码名称和压缩后的数据
+    """
+    if zstandard is not None:
+        return ZSTD, zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return ZLIB, zlib.compress(data, ZLIB_LEVEL)
+
+
+def decompress(codec: str, data: bytes) -> bytes:
+    """解压数据
+
+    Args:
+        codec: 压缩时的编码名称
+        data: 压缩后的数据
+
+    Returns:
+        bytes: 原始数据
+
+    Raises:
+        RuntimeError: 数据使用zstd压缩但未安装zstandard
+        ValueError: 未知的编码
+    """
+    if codec == ZSTD:
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to decompress zstd archives")
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == ZLIB:
+        return zlib.decompress(data)
+    raise ValueError(f"Unknown codec: {codec}")
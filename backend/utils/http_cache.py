@@ -0,0 +1,31 @@
+import hashlib
+from typing import Any, Optional
+
+from fastapi import Request, Response
+
+
+def make_etag(*parts: Any) -> str:
+    """由版本信息和查询参数计算ETag"""
+    digest = hashlib.sha1("|".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+    return f'"{digest[:20]}"'
+
+
+def check_etag(request: Request, response: Response, etag: str) -> Optional[Response]:
+    """设置响应的ETag，客户端缓存仍然有效时返回304响应
+
+    Args:
+        request: 请求
+        response: 路由注入的响应对象，用于设置ETag头
+        etag: 当前内容的ETag（含引号）
+
+    Returns:
+        Optional[Response]: If-None-Match 匹配时为304响应，否则为None
+    """
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "private, no-cache"  # 允许缓存，但每次使用前需要重新验证
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        candidates = {value.strip().removeprefix("W/") for value in if_none_match.split(",")}
+        if etag in candidates or "*" in candidates:
+            return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "private, no-cache"})
+    return None
@@ -0,0 +1,147 @@
+"""只读列表接口的轻量读取
+
+列表接口不需要完整的 Beanie 文档：按响应模型生成 MongoDB 投影只读取需要的字段，
+读出的原始字典只做 _id 转换和默认值填充，不再经过 Pydantic 校验，
+最后直接序列化为 JSON 响应（安装了 orjson 时使用 orjson）。
+"""
+import json
+from datetime import date, datetime
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Type
+
+from bson import DBRef, ObjectId
+from fastapi import Response
+from pydantic import BaseModel
+
+try:
+    import orjson
+except ImportError:  # 未安装时使用标准库json
+    orjson = None
+
+
+def _default(value: Any) -> Any:
+    """序列化 orjson / json 不支持的类型"""
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, DBRef):
+        return str(value.id)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(content: Any) -> bytes:
+    """序列化为JSON字节串"""
+    if orjson is not None:
+        return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(
+        content, default=_default, ensure_ascii=False, separators=(",", ":"), allow_nan=False
+    ).encode("utf-8")
+
+
+class LeanJSONResponse(Response):
+    """JSON响应，安装了 orjson 时使用 orjson 序列化
+
+    作为应用的默认响应类；路由直接返回本类时跳过 response_model 的校验和转换。
+    """
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        if isinstance(content, bytes):  # 已序列化的内容
+            return content
+        return dumps(content)
+
+
+def lean_response(content: Any, response: Optional[Response] = None) -> LeanJSONResponse:
+    """构建轻量JSON响应
+
+    Args:
+        content: 原始字典/列表，或已序列化的JSON字节串
+        response: 路由注入的响应对象，其上设置的响应头（如ETag）会被保留
+
+    Returns:
+        LeanJSONResponse: JSON响应
+    """
+    headers = dict(response.headers) if response is not None else None
+    return LeanJSONResponse(content, headers=headers)
+
+
+@lru_cache(maxsize=None)
+def _fields(model: Type[BaseModel]) -> Tuple[Tuple[str, ...], Tuple[Tuple[str, Any], ...]]:
+    """响应模型的字段名和可选字段（不含id）"""
+    names = tuple(model.model_fields)
+    optional = tuple(
+        (name, field)
+        for name, field in model.model_fields.items()
+        if not field.is_required() and name != "id"
+    )
+    return names, optional
+
+
+def projection(model: Type[BaseModel], exclude: Iterable[str] = ()) -> Dict[str, int]:
+    """由响应模型的字段生成MongoDB投影，id 字段对应 _id
+
+    Args:
+        model: 响应模型
+        exclude: 不读取的字段
+
+    Returns:
+        Dict[str, int]: MongoDB投影
+    """
+    names, _ = _fields(model)
+    excluded = set(exclude)
+    return {"_id" if name == "id" else name: 1 for name in names if name not in excluded}
+
+
+def lean_document(
+    model: Type[BaseModel],
+    document: Dict[str, Any],
+    id_key: str = "id",
+    exclude: Iterable[str] = ()
+) -> Dict[str, Any]:
+    """把投影读出的原始文档转换为响应字典，不做校验
+
+    Args:
+        model: 响应模型，用于填充文档中缺少的可选字段
+        document: MongoDB原始文档，会被原地修改
+        id_key: _id 在响应中的键名；Beanie 文档按别名序列化时为 "_id"
+        exclude: 不返回的字段
+
+    Returns:
+        Dict[str, Any]: 响应字典
+    """
+    if "_id" in document:
+        document[id_key] = str(document.pop("_id"))
+    _, optional = _fields(model)
+    for name, field in optional:
+        if name not in document and name not in exclude:
+            document[name] = field.get_default(call_default_factory=True)
+    return document
+
+
+async def find_lean(
+    model: Type[BaseModel],
+    collection: Any,
+    query: Dict[str, Any],
+    sort: Optional[List[Tuple[str, int]]] = None,
+    exclude: Iterable[str] = (),
+    id_key: str = "id"
+) -> List[Dict[str, Any]]:
+    """按响应模型投影查询并转换为响应字典
+
+    Args:
+        model: 响应模型
+        collection: Motor集合
+        query: 查询条件
+        sort: 可选的排序
+        exclude: 不读取的字段
+        id_key: _id 在响应中的键名
+
+    Returns:
+        List[Dict[str, Any]]: 响应字典列表
+    """
+    exclude = frozenset(exclude)
+    cursor = collection.find(query, projection(model, exclude))
+    if sort:
+        cursor = cursor.sort(sort)
+    return [lean_document(model, document, id_key, exclude) async for document in cursor]
@@ -0,0 +1,204 @@
+"""日志管道
+
+日志记录在事件循环中只做格式化和入队，写入由 QueueListener 的后台线程完成：
+- 队列满时丢弃日志并计数，记录日志不会阻塞请求或流式响应
+- settings.LOG_LEVEL 支持按模块设置级别，如 "INFO,services.chat=DEBUG,pymongo=WARNING"
+- DEBUG 日志按 LOG_DEBUG_SAMPLE_RATE 采样；单条日志可以通过 extra={"sample": 0.01} 指定采样率
+- 写入前在后台线程中脱敏：Authorization 头、API key 等形式的密钥和配置中的密钥值替换为 ***
+- LOG_JSON 为 True 时每条日志输出为一行JSON
+"""
+import atexit
+import logging
+import queue
+import re
+import sys
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, List, Optional, Tuple
+
+from config.settings import settings
+from utils.lean import dumps
+
+REDACTED = "***"
+
+# 常见的密钥形式：Bearer令牌、sk-开头的API key、键名包含key/secret/token/password的键值对
+_SECRET_PATTERNS = [
+    # 键名以密钥类词结尾（api_key、access_token、x-api-key、authorization、password、client_secret 等），
+    # prompt_tokens、max_tokens、token_count 这类用量字段不匹配
+    re.compile(
+        r"(?i)([\"']?(?:[\w-]*[_-])?(?:api[_-]?key|token|secret|password|passwd|authorization)(?![\w-])[\"']?"
+        r"\s*[:=]\s*[\"']?)"
+        r"((?:bearer\s+)?[^\s\"',}]{6,})"
+    ),
+    re.compile(r"(?i)(bearer\s+)[A-Za-z0-9._~+/=-]{8,}"),
+    re.compile(r"\bsk-[A-Za-z0-9_-]{8,}"),
+]
+
+# uvicorn自带处理器的日志记录器，改为经过队列写入
+_UVICORN_LOGGERS = ("uvicorn", "uvicorn.error", "uvicorn.access")
+
+_listener: Optional[QueueListener] = None
+
+
+def _configured_secrets() -> List[str]:
+    """配置中的密钥值，日志中出现时原样替换"""
+    secrets = []
+    for name, value in settings.model_dump().items():
+        if isinstance(value, str) and len(value) >= 8 and re.search(r"KEY|SECRET|TOKEN|PASSWORD", name):
+            secrets.append(value)
+    # 长的先替换，避免部分替换后无法匹配
+    return sorted(set(secrets), key=len, reverse=True)
+
+
+def redact(text: str, secrets: Tuple[str, ...] = ()) -> str:
+    """替换文本中的密钥
+
+    Args:
+        text: 日志文本
+        secrets: 需要原样替换的密钥值
+
+    Returns:
+        str: 脱敏后的文本
+    """
+    for secret in secrets:
+        if secret in text:
+            text = text.replace(secret, REDACTED)
+    for pattern in _SECRET_PATTERNS:
+        text = pattern.sub(lambda m: (m.group(1) if m.re.groups else "") + REDACTED, text)
+    return text
+
+
+def parse_levels(spec: str) -> Tuple[int, Dict[str, int]]:
+    """解析日志级别配置
+
+    Args:
+        spec: 如 "INFO,services.chat=DEBUG,pymongo=WARNING"，不带模块名的一项为根级别
+
+    Returns:
+        Tuple[int, Dict[str, int]]: 根级别和各模块的级别
+    """
+    root = logging.INFO
+    modules = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, level = item.rpartition("=")
+        value = logging.getLevelName(level.strip().upper())
+        if not isinstance(value, int):
+            raise ValueError(f"Invalid log level: {item}")
+        if name:
+            modules[name.strip()] = value
+        else:
+            root = value
+    return root, modules
+
+
+class SamplingFilter(logging.Filter):
+    """按调用位置对DEBUG日志采样，在入队前丢弃未采样的日志"""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+        self._counters: Dict[Tuple[str, int], int] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = getattr(record, "sample", None)
+        if rate is None:
+            if record.levelno > logging.DEBUG:
+                return True
+            rate = self.rate
+        if rate >= 1:
+            return True
+        if rate <= 0:
+            return False
+        # 每个调用位置每 1/rate 条保留一条
+        key = (record.pathname, record.lineno)
+        count = self._counters.get(key, 0)
+        self._counters[key] = count + 1
+        return count % max(1, round(1 / rate)) == 0
+
+
+class RedactingFilter(logging.Filter):
+    """写入前脱敏，在监听线程中运行"""
+
+    def __init__(self):
+        super().__init__()
+        self.secrets = tuple(_configured_secrets())
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.msg = redact(record.getMessage(), self.secrets)
+        record.args = None
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    """每条日志一行JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        return dumps({
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }).decode("utf-8")
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """队列满时丢弃日志而不是阻塞或打印错误"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging():
+    """配置日志管道，重复调用时只配置一次"""
+    global _listener
+    if _listener is not None:
+        return
+
+    root_level, module_levels = parse_levels(settings.LOG_LEVEL)
+
+    output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(JSONFormatter() if settings.LOG_JSON else logging.Formatter(settings.LOG_FORMAT))
+    output.addFilter(RedactingFilter())
+
+    log_queue: queue.Queue = queue.Queue(maxsize=settings.LOG_QUEUE_SIZE)
+    handler = NonBlockingQueueHandler(log_queue)
+    handler.addFilter(SamplingFilter(settings.LOG_DEBUG_SAMPLE_RATE))
+
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(root_level)
+    for name, level in module_levels.items():
+        logging.getLogger(name).setLevel(level)
+    # uvicorn的日志也经过队列写入
+    for name in _UVICORN_LOGGERS:
+        uvicorn_logger = logging.getLogger(name)
+        uvicorn_logger.handlers = []
+        uvicorn_logger.propagate = True
+
+    _listener = QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """写完队列中剩余的日志并停止监听线程"""
+    global _listener
+    if _listener is None:
+        return
+    listener, _listener = _listener, None
+    listener.stop()
+
+
+def stats() -> Dict[str, int]:
+    """日志队列的状态"""
+    handler = next((h for h in logging.getLogger().handlers if isinstance(h, NonBlockingQueueHandler)), None)
+    if handler is None:
+        return {}
+    return {"queued": handler.queue.qsize(), "dropped": handler.dropped}
@@ -0,0 +1,526 @@
+"""Prometheus 格式的监控指标
+
+指标保存在进程内，GET /metrics 以 Prometheus 文本格式（0.0.4）输出，由本机的 Prometheus 定期抓取。
+多个 worker 共用一个服务端口时每次抓取只会落到其中一个进程，因此由 WorkerMetricsServer
+让每个 worker 在独立的端口上输出本进程的指标，抓取时按端口（instance）区分。
+
+- 请求延迟按路由模板和状态码统计，SSE 流按响应的 content-type 计入进行中的流数量
+- 上游模型的调用延迟按 llm_id 统计，流式回复额外统计首token时间、输出token数和每秒token数
+- MongoDB命令由 MongoMetricsListener 按命令名统计次数和耗时，连接池的占用和等待由 MongoPoolMetricsListener 统计
+- 事件循环延迟由 EventLoopMonitor 定期测量
+- 去背景的排队数量和ONNX推理耗时、文生图和B2的调用耗时在调用处记录
+- 各服务已有的 stats() 通过 register_stats() 注册，抓取时转换为 gauge
+"""
+import asyncio
+import logging
+import re
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager, suppress
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from pymongo import common, monitoring
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from config.settings import settings
+
+logger = logging.getLogger(__name__)
+
+METRICS_PATH = "/metrics"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# 请求和调用延迟的桶（秒），SSE 流和LLM调用可能持续数十秒
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# MongoDB命令和事件循环延迟的桶（秒）
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+# 流式输出速度的桶（token/秒）
+TOKEN_RATE_BUCKETS = (5, 10, 20, 40, 60, 80, 100, 150, 200, 300)
+
+_INVALID_NAME = re.compile(r"[^a-zA-Z0-9_]")
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Sequence[Tuple[str, str]]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+class _Value:
+    """计数器和gauge的值"""
+
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+    @contextmanager
+    def track(self) -> Iterator[None]:
+        """执行期间加一，用于统计进行中和排队的数量"""
+        self.inc()
+        try:
+            yield
+        finally:
+            self.dec()
+
+    def samples(self) -> List[Tuple[str, List[Tuple[str, str]], float]]:
+        return [("", [], self.value)]
+
+
+class _HistogramValue:
+    """直方图的各桶计数、总和和次数"""
+
+    __slots__ = ("buckets", "counts", "sum", "count", "_lock")
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 最后一个为 +Inf
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        """记录执行耗时（秒），失败时同样记录"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def samples(self) -> List[Tuple[str, List[Tuple[str, str]], float]]:
+        samples = []
+        cumulative = 0
+        for bound, count in zip((*self.buckets, float("inf")), self.counts):
+            cumulative += count
+            samples.append(("_bucket", [("le", _format_value(bound))], cumulative))
+        samples.append(("_sum", [], self.sum))
+        samples.append(("_count", [], self.count))
+        return samples
+
+
+class Metric:
+    """一个指标及其按标签区分的值"""
+
+    def __init__(self, kind: str, name: str, documentation: str, labelnames: Sequence[str], factory: Callable[[], Any]):
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._factory = factory
+        self._values: Dict[Tuple[str, ...], Any] = {}
+        self._lock = threading.Lock()
+
+    def labels(self, **labels: Any):
+        """按标签取值，首次使用时创建
+
+        Args:
+            **labels: 全部标签的值
+
+        Returns:
+            计数器/gauge为 _Value，直方图为 _HistogramValue
+        """
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        value = self._values.get(key)
+        if value is None:
+            with self._lock:
+                value = self._values.setdefault(key, self._factory())
+        return value
+
+    # 没有标签的指标直接调用
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def dec(self, amount: float = 1):
+        self.labels().dec(amount)
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+    def track(self):
+        return self.labels().track()
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in list(self._values.items()):
+            base = list(zip(self.labelnames, key))
+            for suffix, extra, number in value.samples():
+                lines.append(f"{self.name}{suffix}{_format_labels(base + extra)} {_format_value(number)}")
+        return lines
+
+
+class MetricsRegistry:
+    """进程内的指标注册表"""
+
+    def __init__(self, namespace: str):
+        self.namespace = namespace
+        self._metrics: List[Metric] = []
+        self._stats: List[Tuple[str, Callable[[], Dict[str, Any]]]] = []
+
+    def _add(self, kind: str, name: str, documentation: str, labelnames: Sequence[str], factory) -> Metric:
+        metric = Metric(kind, f"{self.namespace}_{name}", documentation, labelnames, factory)
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Metric:
+        return self._add("counter", name, documentation, labelnames, _Value)
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Metric:
+        return self._add("gauge", name, documentation, labelnames, _Value)
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS
+    ) -> Metric:
+        return self._add("histogram", name, documentation, labelnames, lambda: _HistogramValue(buckets))
+
+    def register_stats(self, prefix: str, source: Callable[[], Dict[str, Any]]):
+        """注册服务的 stats()，抓取时其中的数值输出为 gauge，嵌套的字典按键名展开
+
+        Args:
+            prefix: 指标名前缀，如 message_buffer
+            source: 返回统计字典的函数
+        """
+        self._stats.append((prefix, source))
+
+    def _render_stats(self, prefix: str, stats: Dict[str, Any]) -> List[str]:
+        lines = []
+        for key, value in stats.items():
+            name = f"{prefix}_{_INVALID_NAME.sub('_', str(key))}"
+            if isinstance(value, dict):
+                lines.extend(self._render_stats(name, value))
+            elif isinstance(value, (int, float)):
+                lines.append(f"# TYPE {self.namespace}_{name} gauge")
+                lines.append(f"{self.namespace}_{name} {_format_value(value)}")
+        return lines
+
+    def render(self) -> str:
+        """以 Prometheus 文本格式输出全部指标"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for prefix, source in self._stats:
+            try:
+                lines.extend(self._render_stats(prefix, source()))
+            except Exception as e:
+                logger.warning("Failed to collect %s stats: %s", prefix, e)
+        return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    """按路由模板统计请求延迟、进行中的请求和 SSE 流"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["path"] == METRICS_PATH:
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = 500
+        streaming = False
+
+        async def send_with_metrics(message: Message):
+            nonlocal status, streaming
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                content_type = Headers(raw=message.get("headers", [])).get("content-type", "")
+                if content_type.startswith("text/event-stream"):
+                    streaming = True
+                    sse_streams_active.inc()
+            await send(message)
+
+        http_requests_in_progress.inc()
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        finally:
+            http_requests_in_progress.dec()
+            if streaming:
+                sse_streams_active.dec()
+            # 按路由模板统计，未匹配的路径（404、被限流的请求）合并为一项，避免标签数量无限增长
+            route = scope.get("route")
+            template = route.path if route is not None and hasattr(route, "path") else "unmatched"
+            http_request_duration_seconds.labels(
+                method=scope["method"], route=template, status=status
+            ).observe(time.perf_counter() - started)
+
+
+class MongoMetricsListener(monitoring.CommandListener):
+    """按命令名统计MongoDB命令的次数和耗时"""
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        pass
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        self._record(event, "ok")
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        self._record(event, "error")
+
+    @staticmethod
+    def _record(event, outcome: str):
+        mongo_commands_total.labels(command=event.command_name, outcome=outcome).inc()
+        mongo_command_duration_seconds.labels(command=event.command_name).observe(event.duration_micros / 1e6)
+
+
+class MongoPoolMetricsListener(monitoring.ConnectionPoolListener):
+    """统计MongoDB连接池的大小、已借出的连接数和借出连接的等待时间
+
+    已借出连接数接近最大连接数时，命令会在借出连接时排队。
+    pymongo 的事件不带等待时长，开始借出与借出成功在同一线程中依次发生，按线程记录开始时间
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._max_sizes: Dict[str, int] = {}
+
+    @staticmethod
+    def _address(event) -> str:
+        host, port = event.address
+        return f"{host}:{port}"
+
+    def pool_created(self, event: monitoring.PoolCreatedEvent):
+        address = self._address(event)
+        max_size = event.options.get("maxPoolSize", common.MAX_POOL_SIZE)
+        self._max_sizes[address] = max_size
+        mongo_pool_max_connections.labels(address=address).inc(max_size)
+
+    def pool_ready(self, event: monitoring.PoolReadyEvent):
+        pass
+
+    def pool_cleared(self, event: monitoring.PoolClearedEvent):
+        pass
+
+    def pool_closed(self, event: monitoring.PoolClosedEvent):
+        address = self._address(event)
+        mongo_pool_max_connections.labels(address=address).dec(self._max_sizes.get(address, common.MAX_POOL_SIZE))
+
+    def connection_created(self, event: monitoring.ConnectionCreatedEvent):
+        mongo_pool_connections.labels(address=self._address(event)).inc()
+
+    def connection_ready(self, event: monitoring.ConnectionReadyEvent):
+        pass
+
+    def connection_closed(self, event: monitoring.ConnectionClosedEvent):
+        mongo_pool_connections.labels(address=self._address(event)).dec()
+
+    def connection_check_out_started(self, event: monitoring.ConnectionCheckOutStartedEvent):
+        self._local.started = time.perf_counter()
+
+    def connection_check_out_failed(self, event: monitoring.ConnectionCheckOutFailedEvent):
+        address = self._address(event)
+        mongo_pool_checkout_failures_total.labels(address=address, reason=event.reason).inc()
+        self._observe_wait(address)
+
+    def connection_checked_out(self, event: monitoring.ConnectionCheckedOutEvent):
+        address = self._address(event)
+        mongo_pool_checked_out.labels(address=address).inc()
+        self._observe_wait(address)
+
+    def connection_checked_in(self, event: monitoring.ConnectionCheckedInEvent):
+        mongo_pool_checked_out.labels(address=self._address(event)).dec()
+
+    def _observe_wait(self, address: str):
+        started = getattr(self._local, "started", None)
+        if started is not None:
+            self._local.started = None
+            mongo_pool_checkout_wait_seconds.labels(address=address).observe(time.perf_counter() - started)
+
+
+class WorkerMetricsServer:
+    """在独立端口上输出本进程的指标
+
+    gunicorn 的多个 worker 共用服务端口，抓取 /metrics 时由哪个 worker 响应是不确定的。
+    每个 worker 从 METRICS_WORKER_PORT_BASE 开始依次尝试，占用第一个空闲的端口，
+    Prometheus 抓取整个端口范围即可得到所有 worker 的指标；worker 重启后会重新占用空出的端口
+    """
+
+    def __init__(self):
+        self.port: Optional[int] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            while (await asyncio.wait_for(reader.readline(), 5)).strip():
+                pass
+            parts = request_line.split()
+            path = parts[1].split(b"?")[0].decode() if len(parts) > 1 else ""
+            client = (writer.get_extra_info("peername") or ("",))[0]
+            if settings.METRICS_ALLOWED_IPS and client not in settings.METRICS_ALLOWED_IPS:
+                status, body, content_type = "403 Forbidden", b"", "text/plain"
+            elif path != METRICS_PATH:
+                status, body, content_type = "404 Not Found", b"", "text/plain"
+            else:
+                status, body, content_type = "200 OK", registry.render().encode(), CONTENT_TYPE
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError, UnicodeDecodeError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self):
+        """占用第一个空闲端口开始输出指标，未配置 METRICS_WORKER_PORT_BASE 时不启动"""
+        base = settings.METRICS_WORKER_PORT_BASE
+        if not settings.METRICS_ENABLED or not base or self._server:
+            return
+        for port in range(base, base + settings.METRICS_WORKER_PORT_COUNT):
+            try:
+                self._server = await asyncio.start_server(self._handle, settings.METRICS_WORKER_HOST, port)
+            except OSError:
+                continue
+            self.port = port
+            logger.info("Worker metrics listening on %s:%s", settings.METRICS_WORKER_HOST, port)
+            return
+        logger.warning(
+            "No free worker metrics port in %s-%s", base, base + settings.METRICS_WORKER_PORT_COUNT - 1
+        )
+
+    async def stop(self):
+        """停止输出指标并释放端口"""
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+            self.port = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {"port": self.port or 0}
+
+
+class EventLoopMonitor:
+    """定期测量事件循环的延迟：定时器实际唤醒时间比预期晚的秒数"""
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self):
+        interval = settings.METRICS_LOOP_LAG_INTERVAL_SECONDS
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(interval)
+            lag = max(0.0, time.perf_counter() - started - interval)
+            event_loop_lag_seconds.observe(lag)
+            event_loop_lag_last_seconds.set(lag)
+
+    def start(self):
+        """启动测量任务"""
+        if not settings.METRICS_ENABLED:
+            return
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """停止测量任务"""
+        if self._task:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+
+# 创建全局实例
+registry = MetricsRegistry("paw")
+mongo_metrics_listener = MongoMetricsListener()
+mongo_pool_listener = MongoPoolMetricsListener()
+worker_metrics_server = WorkerMetricsServer()
+event_loop_monitor = EventLoopMonitor()
+
+# HTTP请求
+http_request_duration_seconds = registry.histogram(
+    "http_request_duration_seconds", "HTTP请求耗时，SSE为整个流的时长", ("method", "route", "status")
+)
+http_requests_in_progress = registry.gauge("http_requests_in_progress", "正在处理的HTTP请求数")
+sse_streams_active = registry.gauge("sse_streams_active", "正在输出的SSE流数量")
+
+# 上游模型
+upstream_request_duration_seconds = registry.histogram(
+    "upstream_request_duration_seconds", "上游模型单次调用的耗时，流式调用为收到第一个片段的时间", ("llm_id", "outcome")
+)
+llm_time_to_first_token_seconds = registry.histogram(
+    "llm_time_to_first_token_seconds", "角色回复从开始到第一个内容片段的时间", ("llm_id",)
+)
+llm_stream_duration_seconds = registry.histogram(
+    "llm_stream_duration_seconds", "角色回复流的总时长", ("llm_id",)
+)
+llm_stream_tokens_total = registry.counter(
+    "llm_stream_tokens_total", "角色回复流输出的token数，rate()为每秒输出的token数", ("llm_id",)
+)
+llm_stream_tokens_per_second = registry.histogram(
+    "llm_stream_tokens_per_second", "每个角色回复流首token之后的输出速度", ("llm_id",), TOKEN_RATE_BUCKETS
+)
+
+# MongoDB
+mongo_commands_total = registry.counter("mongo_commands_total", "MongoDB命令次数", ("command", "outcome"))
+mongo_command_duration_seconds = registry.histogram(
+    "mongo_command_duration_seconds", "MongoDB命令耗时", ("command",), FAST_BUCKETS
+)
+mongo_pool_max_connections = registry.gauge(
+    "mongo_pool_max_connections", "连接池的最大连接数，与 mongo_pool_checked_out 的比值为连接池占用率", ("address",)
+)
+mongo_pool_connections = registry.gauge("mongo_pool_connections", "连接池中已建立的连接数", ("address",))
+mongo_pool_checked_out = registry.gauge("mongo_pool_checked_out", "正在被命令使用的连接数", ("address",))
+mongo_pool_checkout_wait_seconds = registry.histogram(
+    "mongo_pool_checkout_wait_seconds", "从连接池借出连接的等待时间", ("address",), FAST_BUCKETS
+)
+mongo_pool_checkout_failures_total = registry.counter(
+    "mongo_pool_checkout_failures_total", "借出连接失败的次数，如等待超时", ("address", "reason")
+)
+
+# 事件循环
+event_loop_lag_seconds = registry.histogram("event_loop_lag_seconds", "事件循环延迟", buckets=FAST_BUCKETS)
+event_loop_lag_last_seconds = registry.gauge("event_loop_lag_last_seconds", "最近一次测量的事件循环延迟")
+
+# 图片处理和外部服务
+rmbg_queue_depth = registry.gauge("rmbg_queue_depth", "正在执行和等待执行的去背景任务数")
+rmbg_inference_seconds = registry.histogram("rmbg_inference_seconds", "去背景模型的ONNX推理耗时")
+external_request_duration_seconds = registry.histogram(
+    "external_request_duration_seconds", "外部服务调用耗时", ("service", "operation")
+)
@@ -0,0 +1,216 @@
+"""用户请求限流中间件
+
+按已登录用户的钱包地址（未登录时按IP）限制每个时间窗口内的请求代价总和，
+不同接口按 RATE_LIMIT_ROUTE_COSTS 计算代价，使用滑动窗口计数，超出时返回429和Retry-After。
+计数默认保存在进程内，配置 RATE_LIMIT_BACKEND=redis 时通过 REDIS_URL 在所有 worker 之间共享。
+"""
+import json
+import logging
+import math
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from config.settings import settings
+from models.user import User
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # redis 为可选依赖
+    aioredis = None
+
+logger = logging.getLogger(__name__)
+
+REDIS_KEY_PREFIX = "paw:user_limit:"
+
+# 滑动窗口计数：上一个窗口的计数按剩余比例加权，与当前窗口计数相加
+# KEYS: 当前窗口键, 上一个窗口键；ARGV: 窗口秒数, 限额, 本次代价, 当前窗口已经过的秒数
+# 返回 {是否允许, 剩余额度, 需要等待的秒数}
+_SLIDING_WINDOW_SCRIPT = """
+local window = tonumber(ARGV[1])
+local limit = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local elapsed = tonumber(ARGV[4])
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+local previous = tonumber(redis.call('GET', KEYS[2]) or '0')
+local weighted = previous * (1 - elapsed / window) + current
+if weighted + cost > limit then
+    return {0, 0, tostring(weighted)}
+end
+redis.call('INCRBY', KEYS[1], cost)
+redis.call('EXPIRE', KEYS[1], window * 2)
+return {1, math.floor(limit - weighted - cost), tostring(weighted)}
+"""
+
+
+def _retry_after(previous: float, current: float, cost: int, limit: int, window: float, elapsed: float) -> int:
+    """计算需要等待多久才能容纳本次代价"""
+    if previous > 0 and current + cost <= limit:
+        # 等待上一个窗口的加权计数衰减到足够小
+        excess = previous * (1 - elapsed / window) + current + cost - limit
+        return max(1, math.ceil(excess / previous * window))
+    # 当前窗口已满，需要等到下一个窗口
+    return max(1, math.ceil(window - elapsed))
+
+
+class SlidingWindowCounter:
+    """进程内的滑动窗口计数"""
+
+    def __init__(self):
+        self._counts: Dict[str, Tuple[int, int, int]] = {}  # key -> (窗口编号, 上个窗口计数, 当前窗口计数)
+
+    async def hit(self, key: str, cost: int, limit: int, window: int) -> Tuple[bool, int, int]:
+        """尝试计入一次请求
+
+        Returns:
+            Tuple[bool, int, int]: (是否允许, 剩余额度, 需要等待的秒数)
+        """
+        now = time.time()
+        index = int(now // window)
+        elapsed = now - index * window
+        stored_index, previous, current = self._counts.get(key, (index, 0, 0))
+        if stored_index != index:
+            previous = current if stored_index == index - 1 else 0
+            current = 0
+
+        weighted = previous * (1 - elapsed / window) + current
+        if weighted + cost > limit:
+            self._counts[key] = (index, previous, current)
+            return False, 0, _retry_after(previous, current, cost, limit, window, elapsed)
+
+        self._counts[key] = (index, previous, current + cost)
+        self._evict(index)
+        return True, int(limit - weighted - cost), 0
+
+    def _evict(self, index: int):
+        """计数过多时清理两个窗口之前的键"""
+        if len(self._counts) > 100000:
+            self._counts = {k: v for k, v in self._counts.items() if v[0] >= index - 1}
+
+
+class RedisSlidingWindowCounter:
+    """Redis 中共享的滑动窗口计数，Redis 不可用时退回进程内计数"""
+
+    def __init__(self, url: str, fallback: SlidingWindowCounter):
+        self._client = aioredis.from_url(url)
+        self._script = self._client.register_script(_SLIDING_WINDOW_SCRIPT)
+        self._fallback = fallback
+
+    async def hit(self, key: str, cost: int, limit: int, window: int) -> Tuple[bool, int, int]:
+        now = time.time()
+        index = int(now // window)
+        elapsed = now - index * window
+        try:
+            allowed, remaining, weighted = await self._script(
+                keys=[f"{REDIS_KEY_PREFIX}{key}:{index}", f"{REDIS_KEY_PREFIX}{key}:{index - 1}"],
+                args=[window, limit, cost, elapsed]
+            )
+        except Exception as e:
+            logger.warning("Redis rate limit unavailable, using local counters: %s", e)
+            return await self._fallback.hit(key, cost, limit, window)
+        if allowed:
+            return True, int(remaining), 0
+        # Redis 只返回加权计数，按当前窗口已满估算等待时间
+        return False, 0, max(1, math.ceil(window - elapsed))
+
+
+class RateLimitMiddleware:
+    """按用户和接口代价限流的ASGI中间件"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self._local = SlidingWindowCounter()
+        if settings.RATE_LIMIT_BACKEND == "redis" and aioredis is not None:
+            self.counter = RedisSlidingWindowCounter(settings.REDIS_URL, self._local)
+        else:
+            if settings.RATE_LIMIT_BACKEND == "redis":
+                logger.warning("redis package not installed, using local rate limit counters")
+            self.counter = self._local
+        self._wallets: "OrderedDict[str, Tuple[float, Optional[str]]]" = OrderedDict()
+
+    async def _wallet(self, token: str) -> Optional[str]:
+        """通过访问令牌获取钱包地址，结果缓存 RATE_LIMIT_IDENTITY_CACHE_SECONDS 秒"""
+        cached = self._wallets.get(token)
+        now = time.monotonic()
+        if cached and cached[0] > now:
+            return cached[1]
+        try:
+            user = await User.get_by_token(token)
+            wallet = user.wallet_address if user else None
+        except Exception:
+            wallet = None
+        self._wallets[token] = (now + settings.RATE_LIMIT_IDENTITY_CACHE_SECONDS, wallet)
+        self._wallets.move_to_end(token)
+        while len(self._wallets) > 10000:
+            self._wallets.popitem(last=False)
+        return wallet
+
+    async def _identity(self, scope: Scope) -> str:
+        """限流键：已登录用户为钱包地址，否则为客户端IP"""
+        headers = Headers(scope=scope)
+        authorization = headers.get("authorization", "")
+        if authorization.lower().startswith("bearer "):
+            wallet = await self._wallet(authorization[7:].strip())
+            if wallet:
+                return f"user:{wallet}"
+
+        if settings.RATE_LIMIT_TRUST_FORWARDED:
+            forwarded = headers.get("x-forwarded-for")
+            if forwarded:
+                return f"ip:{forwarded.split(',')[0].strip()}"
+        client = scope.get("client")
+        return f"ip:{client[0] if client else 'unknown'}"
+
+    @staticmethod
+    def _cost(path: str) -> int:
+        """接口代价，未配置的接口为1"""
+        route = path[len(settings.API_V1_PREFIX):] if path.startswith(settings.API_V1_PREFIX) else path
+        return settings.RATE_LIMIT_ROUTE_COSTS.get(route.rstrip("/") or "/", 1)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if (
+            scope["type"] != "http"
+            or not settings.RATE_LIMIT_ENABLED
+            or scope["method"] == "OPTIONS"
+            or not scope["path"].startswith(settings.API_V1_PREFIX)
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        limit = settings.RATE_LIMIT_PER_MINUTE
+        window = settings.RATE_LIMIT_WINDOW_SECONDS
+        identity = await self._identity(scope)
+        allowed, remaining, retry_after = await self.counter.hit(
+            identity, self._cost(scope["path"]), limit, window
+        )
+
+        if not allowed:
+            logger.info("Rate limited: identity=%s path=%s retry_after=%s", identity, scope["path"], retry_after)
+            body = json.dumps({"detail": "Too many requests"}).encode()
+            await send({
+                "type": "http.response.start",
+                "status": 429,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode()),
+                    (b"retry-after", str(retry_after).encode()),
+                    (b"x-ratelimit-limit", str(limit).encode()),
+                    (b"x-ratelimit-remaining", b"0"),
+                ],
+            })
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        async def send_with_headers(message: Message):
+            if message["type"] == "http.response.start":
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [
+                    (b"x-ratelimit-limit", str(limit).encode()),
+                    (b"x-ratelimit-remaining", str(max(0, remaining)).encode()),
+                ]
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
@@ -1,3 +1,4 @@
+import logging
 import io
 import os
 import json
@@ -8,6 +9,11 @@ from threading import Lock
 from typing import Optional
 from pathlib import Path
 
+from utils.metrics import rmbg_inference_seconds, rmbg_queue_depth
+from utils.tracing import span
+
+logger = logging.getLogger(__name__)
+
 class BackgroundRemover:
     """背景去除工具类
     
@@ -122,7 +128,8 @@ class BackgroundRemover:
         Returns:
             bytes: 去除背景后的图片二进制数据
         """
-        with self._lock:  # 使用锁确保单进程执行
+        # 使用锁确保单进程执行，耗时和排队数量包含等待锁的任务
+        with rmbg_queue_depth.track(), span("rmbg", bytes=len(image_bytes)), self._lock:
             try:
                 # 将二进制数据转换为PIL Image
                 image = Image.open(io.BytesIO(image_bytes))
@@ -134,10 +141,11 @@ class BackgroundRemover:
                 input_tensor = self._preprocess_image(image_array)
                 
                 # 模型推理
-                outputs = self._session.run(
-                    [self._output_name], 
-                    {self._input_name: input_tensor}
-                )
+                with span("rmbg.inference"), rmbg_inference_seconds.time():
+                    outputs = self._session.run(
+                        [self._output_name], 
+                        {self._input_name: input_tensor}
+                    )
                 mask = outputs[0]
                 
                 # 后处理掩码
@@ -154,7 +162,7 @@ class BackgroundRemover:
                 return output_buffer.getvalue()
                 
             except Exception as e:
-                print(f"Background removal failed: {str(e)}")
+                logger.warning("Background removal failed: %s", e)
                 return image_bytes  # 如果处理失败，返回原图
 
 # 创建全局实例
@@ -0,0 +1,48 @@
+"""Server-Sent Events 帧编码
+
+帧直接编码为字节串，StreamingResponse 不再对每个片段重新编码；
+JSON 数据使用 utils.lean.dumps（安装了 orjson 时使用 orjson）。
+"""
+from typing import Any, Optional, Union
+
+from utils.lean import dumps
+
+# 流式响应的公共响应头
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    "Content-Type": "text/event-stream",
+    "X-Accel-Buffering": "no"  # 禁用nginx缓冲
+}
+
+
+def sse_frame(data: Any, event: Optional[str] = None, id: Optional[Union[int, str]] = None) -> bytes:
+    """构建SSE帧
+
+    Args:
+        data: 帧数据，str 原样发送，其他类型序列化为JSON；多行数据按规范拆成多个 data 行
+        event: 可选的事件类型
+        id: 可选的事件ID，客户端重连时通过 Last-Event-ID 带回
+
+    Returns:
+        bytes: 以空行结尾的SSE帧
+    """
+    payload = data.encode("utf-8") if isinstance(data, str) else dumps(data)
+    frame = bytearray()
+    if id is not None:
+        frame += b"id: %s\n" % str(id).encode("utf-8")
+    if event:
+        frame += b"event: %s\n" % event.encode("utf-8")
+    for line in payload.split(b"\n"):
+        frame += b"data: " + line + b"\n"
+    frame += b"\n"
+    return bytes(frame)
+
+
+def sse_text(text: str) -> bytes:
+    """构建只有一行 data 的纯文本帧
+
+    /story_chat/generate-response 的客户端直接去掉 "data: " 前缀拼接文本，
+    文本中的换行保留在同一帧中，不拆分为多个 data 行。
+    """
+    return b"data: " + text.encode("utf-8") + b"\n\n"
@@ -0,0 +1,39 @@
+from typing import AsyncGenerator, TypeVar
+
+T = TypeVar("T")
+
+
+async def prefetch_first(source: AsyncGenerator[T, None]) -> AsyncGenerator[T, None]:
+    """预先取出流的第一个片段
+
+    在返回 StreamingResponse 之前调用，使建立上游连接时的错误（限流超时、所有模型都失败等）
+    能以正常的HTTP状态码返回，而不是在响应头发送后中断流
+
+    Args:
+        source: 原始流
+
+    Returns:
+        AsyncGenerator[T, None]: 从第一个片段开始输出的流
+
+    Raises:
+        Exception: 获取第一个片段时的错误
+    """
+    try:
+        first = await source.__anext__()
+    except StopAsyncIteration:
+        return _empty()
+    return _chain(first, source)
+
+
+async def _empty() -> AsyncGenerator[T, None]:
+    return
+    yield
+
+
+async def _chain(first: T, source: AsyncGenerator[T, None]) -> AsyncGenerator[T, None]:
+    try:
+        yield first
+        async for item in source:
+            yield item
+    finally:
+        await source.aclose()
@@ -0,0 +1,65 @@
+import re
+from functools import lru_cache
+from typing import Optional
+
+from config.settings import settings
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken 为可选依赖，未安装时使用估算
+    tiktoken = None
+
+# 中日韩字符，估算时每个字符按一个token计算
+_CJK_PATTERN = re.compile(r"[　-〿぀-ヿ㐀-䶿一-鿿가-힯＀-￯]")
+
+# 只缓存单条消息长度的文本，整段提示词每次都不同，缓存只会占用内存
+_CACHE_MAX_CHARS = 2000
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    """获取tiktoken编码器，不可用时返回None"""
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding(settings.TOKENIZER_ENCODING)
+    except Exception:
+        return None
+
+
+def _estimate(text: str) -> int:
+    """不使用分词器估算token数：中日韩字符每字一个token，其余字符每4个一个token"""
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def count_tokens(text: Optional[str]) -> int:
+    """计算文本的token数
+
+    安装了tiktoken时使用本地分词器，否则按字符类型估算。较短的文本（单条消息、角色名称）会被缓存
+
+    Args:
+        text: 文本
+
+    Returns:
+        int: token数
+    """
+    if not text:
+        return 0
+    if len(text) <= _CACHE_MAX_CHARS:
+        return _count_cached(text)
+    return _count(text)
+
+
+@lru_cache(maxsize=8192)
+def _count_cached(text: str) -> int:
+    """带缓存的token计数"""
+    return _count(text)
+
+
+def _count(text: str) -> int:
+    """使用分词器或估算计算token数"""
+    encoding = _encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return _estimate(text)
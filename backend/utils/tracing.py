@@ -0,0 +1,518 @@
+"""请求级链路追踪
+
+每个HTTP请求由 TracingMiddleware 创建一条链路，链路和当前span保存在contextvar中，请求内的各阶段通过 span() 记录耗时：
+- 认证、LLM调用（首token时间、每秒token数）、去背景和人脸检测、B2上传
+- 每条MongoDB命令由 MongoCommandListener 记录（motor在线程池中执行命令时会复制contextvar）
+
+完成的链路保存在进程内的环形缓冲中，/traces 接口返回最近的慢请求和各阶段耗时的分位数；
+配置 TRACE_OTLP_ENDPOINT 时按 OTLP/HTTP JSON 格式批量发送到采集器。
+响应头发送前完成的阶段写入 Server-Timing 响应头，流式响应开始后的阶段只进入缓冲和导出。
+没有链路时（后台任务、未采样的请求）span() 不做任何记录。
+"""
+import asyncio
+import logging
+import os
+import random
+import re
+import time
+from collections import deque
+from contextlib import contextmanager, suppress
+from contextvars import ContextVar
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple, Union
+
+import httpx
+from pymongo import monitoring
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from config.settings import settings
+
+logger = logging.getLogger(__name__)
+
+# Server-Timing 最多列出的阶段数
+SERVER_TIMING_ENTRIES = 20
+
+# OTLP 的span类型和状态码
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+STATUS_ERROR = 2
+
+_TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+_METRIC_NAME = re.compile(r"[^A-Za-z0-9._-]")
+
+_trace: ContextVar[Optional["Trace"]] = ContextVar("trace", default=None)
+_current_span: ContextVar[Optional[str]] = ContextVar("current_span", default=None)
+
+
+def _new_id(size: int) -> str:
+    return os.urandom(size).hex()
+
+
+def _percentile(values: List[float], q: float) -> float:
+    """已排序数值的分位数"""
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class Span:
+    """链路中的一个阶段"""
+
+    __slots__ = ("trace", "name", "span_id", "parent_id", "start_time", "attributes", "duration_ms", "error", "_start")
+
+    def __init__(
+        self,
+        trace: "Trace",
+        name: str,
+        parent_id: Optional[str],
+        attributes: Dict[str, Any],
+        start_time: Optional[float] = None
+    ):
+        self.trace = trace
+        self.name = name
+        self.span_id = _new_id(8)
+        self.parent_id = parent_id
+        self.start_time = time.time() if start_time is None else start_time
+        self.attributes = attributes
+        self.duration_ms: Optional[float] = None
+        self.error: Optional[str] = None
+        self._start = time.perf_counter()
+
+    def set(self, **attributes: Any):
+        """设置属性"""
+        self.attributes.update(attributes)
+
+    def elapsed_ms(self) -> float:
+        """开始到现在的毫秒数"""
+        return (time.perf_counter() - self._start) * 1000
+
+    def end(self, error: Optional[str] = None, duration_ms: Optional[float] = None):
+        """结束并记录到链路，重复调用时只记录第一次
+
+        Args:
+            error: 失败时的错误类型
+            duration_ms: 指定耗时，默认为开始到现在的时间
+        """
+        if self.duration_ms is not None:
+            return
+        self.duration_ms = self.elapsed_ms() if duration_ms is None else duration_ms
+        self.error = error
+        if self is not self.trace.root:
+            self.trace.add(self)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_time": self.start_time,
+            "duration_ms": round(self.duration_ms, 3) if self.duration_ms is not None else None,
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+
+class _NoopSpan:
+    """没有链路时使用，所有操作为空"""
+
+    __slots__ = ()
+
+    def set(self, **attributes: Any):
+        pass
+
+    def elapsed_ms(self) -> float:
+        return 0.0
+
+    def end(self, error: Optional[str] = None, duration_ms: Optional[float] = None):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Trace:
+    """一个请求的链路"""
+
+    __slots__ = ("trace_id", "root", "spans", "finished", "dropped")
+
+    def __init__(self, name: str, trace_id: Optional[str] = None, parent_id: Optional[str] = None, **attributes: Any):
+        self.trace_id = trace_id or _new_id(16)
+        self.spans: List[Span] = []
+        self.finished = False
+        self.dropped = 0
+        self.root = Span(self, name, parent_id, attributes)
+
+    def add(self, span: Span):
+        """记录完成的阶段，链路结束后完成的阶段（如请求创建的后台任务）不再记录"""
+        if self.finished:
+            return
+        if len(self.spans) >= settings.TRACE_MAX_SPANS:
+            self.dropped += 1
+            return
+        self.spans.append(span)
+
+    def server_timing(self) -> str:
+        """已完成的阶段按名称汇总为 Server-Timing 响应头"""
+        totals: Dict[str, List[float]] = {}
+        for span in self.spans:
+            total = totals.setdefault(span.name, [0.0, 0])
+            total[0] += span.duration_ms
+            total[1] += 1
+        entries = [f"app;dur={self.root.elapsed_ms():.1f}"]
+        for name, (duration, count) in sorted(totals.items(), key=lambda item: -item[1][0])[:SERVER_TIMING_ENTRIES]:
+            entry = f"{_METRIC_NAME.sub('_', name)};dur={duration:.1f}"
+            if count > 1:
+                entry += f';desc="x{count}"'
+            entries.append(entry)
+        return ", ".join(entries)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            **self.root.to_dict(),
+            "dropped_spans": self.dropped,
+            "spans": [span.to_dict() for span in self.spans],
+        }
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Union[Span, _NoopSpan]]:
+    """记录一个阶段的耗时，阶段内的子阶段和MongoDB命令以它为父级
+
+    不能跨越异步生成器的 yield 使用，流式阶段使用 start_span()。
+
+    Args:
+        name: 阶段名称，如 auth、llm.call、mongo.find
+        **attributes: 阶段属性
+
+    Yields:
+        Span: 当前阶段，没有链路时为空操作的对象
+    """
+    trace = _trace.get()
+    if trace is None:
+        yield NOOP_SPAN
+        return
+    current = Span(trace, name, _current_span.get(), attributes)
+    token = _current_span.set(current.span_id)
+    error = None
+    try:
+        yield current
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        _current_span.reset(token)
+        current.end(error=error)
+
+
+def start_span(name: str, **attributes: Any) -> Union[Span, _NoopSpan]:
+    """开始一个不作为父级的阶段，由调用方调用 end() 结束，用于跨越多次 yield 的流式阶段
+
+    Args:
+        name: 阶段名称
+        **attributes: 阶段属性
+
+    Returns:
+        Span: 阶段，没有链路时为空操作的对象
+    """
+    trace = _trace.get()
+    if trace is None:
+        return NOOP_SPAN
+    return Span(trace, name, _current_span.get(), attributes)
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """每条MongoDB命令记录为一个阶段
+
+    事件在执行命令的线程中触发，motor在线程池中执行时会复制调用方的contextvar。
+    """
+
+    def __init__(self):
+        self._collections: Dict[Tuple[Any, int], Optional[str]] = {}
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        if _trace.get() is None:
+            return
+        collection = event.command.get(event.command_name)
+        self._collections[(event.connection_id, event.request_id)] = collection if isinstance(collection, str) else None
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        self._record(event, None)
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        failure = event.failure if isinstance(event.failure, dict) else {}
+        self._record(event, failure.get("codeName") or "MongoError")
+
+    def _record(self, event, error: Optional[str]):
+        collection = self._collections.pop((event.connection_id, event.request_id), None)
+        trace = _trace.get()
+        if trace is None:
+            return
+        duration_ms = event.duration_micros / 1000
+        command = Span(
+            trace,
+            f"mongo.{event.command_name}",
+            _current_span.get(),
+            {"collection": collection},
+            start_time=time.time() - duration_ms / 1000
+        )
+        command.end(error=error, duration_ms=duration_ms)
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    """属性值转换为 OTLP AnyValue"""
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_span(trace: Trace, item: Span) -> Dict[str, Any]:
+    start = int(item.start_time * 1e9)
+    otlp = {
+        "traceId": trace.trace_id,
+        "spanId": item.span_id,
+        "name": item.name,
+        "kind": SPAN_KIND_SERVER if item is trace.root else SPAN_KIND_INTERNAL,
+        "startTimeUnixNano": str(start),
+        "endTimeUnixNano": str(start + int((item.duration_ms or 0) * 1e6)),
+        "attributes": [
+            {"key": key, "value": _otlp_value(value)}
+            for key, value in item.attributes.items() if value is not None
+        ],
+    }
+    if item.parent_id:
+        otlp["parentSpanId"] = item.parent_id
+    if item.error:
+        otlp["status"] = {"code": STATUS_ERROR, "message": item.error}
+    return otlp
+
+
+class OTLPExporter:
+    """按 OTLP/HTTP JSON 格式定期批量发送完成的链路"""
+
+    def __init__(self):
+        self._pending: Deque[Trace] = deque(maxlen=settings.TRACE_EXPORT_QUEUE)
+        self._task: Optional[asyncio.Task] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self.exported = 0
+        self.dropped = 0
+        self.failed = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(settings.TRACE_OTLP_ENDPOINT)
+
+    def enqueue(self, trace: Trace):
+        """加入待发送队列，队列满时丢弃最早的链路"""
+        if not self.enabled:
+            return
+        if len(self._pending) == self._pending.maxlen:
+            self.dropped += 1
+        self._pending.append(trace)
+
+    def payload(self, traces: List[Trace]) -> Dict[str, Any]:
+        """链路转换为 OTLP ExportTraceServiceRequest"""
+        return {
+            "resourceSpans": [{
+                "resource": {
+                    "attributes": [{"key": "service.name", "value": {"stringValue": settings.APP_NAME}}]
+                },
+                "scopeSpans": [{
+                    "scope": {"name": __name__},
+                    "spans": [
+                        _otlp_span(trace, item)
+                        for trace in traces
+                        for item in [trace.root, *trace.spans]
+                    ]
+                }]
+            }]
+        }
+
+    async def flush(self):
+        """发送队列中的链路，失败时丢弃这一批"""
+        while self._pending:
+            batch = [self._pending.popleft() for _ in range(min(len(self._pending), settings.TRACE_EXPORT_BATCH))]
+            try:
+                response = await self._client.post(
+                    settings.TRACE_OTLP_ENDPOINT,
+                    json=self.payload(batch),
+                    headers=settings.TRACE_OTLP_HEADERS
+                )
+                response.raise_for_status()
+                self.exported += len(batch)
+            except Exception as e:
+                self.failed += len(batch)
+                logger.warning("Failed to export %s traces: %s", len(batch), e)
+                return
+
+    async def _run(self):
+        """定期发送"""
+        while True:
+            await asyncio.sleep(settings.TRACE_EXPORT_INTERVAL_SECONDS)
+            await self.flush()
+
+    def start(self):
+        """启动后台发送任务，没有配置采集地址时不启动"""
+        if not self.enabled:
+            return
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=10)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """停止后台发送任务并发送剩余的链路"""
+        if self._task:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        if self._client:
+            await self.flush()
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "pending": len(self._pending),
+            "exported": self.exported,
+            "dropped": self.dropped,
+            "failed": self.failed,
+        }
+
+
+class Tracer:
+    """链路的创建、缓冲和导出"""
+
+    def __init__(self):
+        self._traces: Deque[Trace] = deque(maxlen=settings.TRACE_BUFFER_SIZE)
+        self.exporter = OTLPExporter()
+        self.started = 0
+        self.errors = 0
+
+    def start_trace(self, name: str, traceparent: Optional[str] = None, **attributes: Any) -> Optional[Trace]:
+        """按采样率开始一条链路
+
+        Args:
+            name: 链路名称
+            traceparent: 上游传入的 W3C traceparent 头，有效时沿用其链路ID
+            **attributes: 根阶段的属性
+
+        Returns:
+            Optional[Trace]: 链路，未启用或未采样时为空
+        """
+        if not settings.TRACE_ENABLED or random.random() >= settings.TRACE_SAMPLE_RATE:
+            return None
+        trace_id = parent_id = None
+        match = _TRACEPARENT.match(traceparent or "")
+        if match:
+            trace_id, parent_id = match.groups()
+        self.started += 1
+        return Trace(name, trace_id, parent_id, **attributes)
+
+    def finish(self, trace: Trace, error: Optional[str] = None):
+        """结束链路，放入环形缓冲和导出队列"""
+        trace.root.end(error=error)
+        trace.finished = True
+        if error:
+            self.errors += 1
+        self._traces.append(trace)
+        self.exporter.enqueue(trace)
+
+    def recent(self, limit: int = 20, min_duration_ms: float = 0) -> List[Dict[str, Any]]:
+        """最近完成的链路
+
+        Args:
+            limit: 最多返回的条数
+            min_duration_ms: 只返回总耗时不低于该值的链路
+
+        Returns:
+            List[Dict[str, Any]]: 链路，最新的在前
+        """
+        traces = []
+        for trace in reversed(self._traces):
+            if trace.root.duration_ms >= min_duration_ms:
+                traces.append(trace.to_dict())
+                if len(traces) >= limit:
+                    break
+        return traces
+
+    def stages(self) -> Dict[str, Dict[str, float]]:
+        """缓冲中各阶段耗时的分位数，按p99从高到低排列"""
+        durations: Dict[str, List[float]] = {}
+        for trace in list(self._traces):
+            for item in [trace.root, *trace.spans]:
+                durations.setdefault(item.name, []).append(item.duration_ms)
+        summary = {}
+        for name, values in durations.items():
+            values.sort()
+            summary[name] = {
+                "count": len(values),
+                "p50_ms": round(_percentile(values, 0.5), 3),
+                "p95_ms": round(_percentile(values, 0.95), 3),
+                "p99_ms": round(_percentile(values, 0.99), 3),
+                "max_ms": round(values[-1], 3),
+            }
+        return dict(sorted(summary.items(), key=lambda item: -item[1]["p99_ms"]))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "started": self.started,
+            "errors": self.errors,
+            "buffered": len(self._traces),
+            "export": self.exporter.stats(),
+        }
+
+
+class TracingMiddleware:
+    """为每个HTTP请求创建链路，并在响应头中加入 Server-Timing"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = Headers(scope=scope)
+        trace = tracer.start_trace(
+            f"{scope['method']} {scope['path']}",
+            headers.get("traceparent"),
+            method=scope["method"]
+        )
+        if trace is None:
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_timing(message: Message):
+            if message["type"] == "http.response.start":
+                trace.root.set(status=message["status"])
+                MutableHeaders(scope=message).append("Server-Timing", trace.server_timing())
+            await send(message)
+
+        trace_token = _trace.set(trace)
+        span_token = _current_span.set(trace.root.span_id)
+        error = None
+        try:
+            await self.app(scope, receive, send_with_timing)
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            _current_span.reset(span_token)
+            _trace.reset(trace_token)
+            # 路由匹配后按路径模板命名，同一接口的链路可以汇总
+            route = scope.get("route")
+            if route is not None and hasattr(route, "path"):
+                trace.root.name = f"{scope['method']} {route.path}"
+            if error is None and trace.root.attributes.get("status", 200) >= 500:
+                error = "ServerError"
+            tracer.finish(trace, error)
+
+
+# 创建全局实例
+tracer = Tracer()
+mongo_listener = MongoCommandListener()